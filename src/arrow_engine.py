@@ -0,0 +1,154 @@
+"""
+Lightweight conversion engine for small inputs, built on pyarrow's
+streaming CSV reader. It needs no JVM, reads the TSV in bounded memory
+batches and writes Parquet directly.
+"""
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from loguru import logger
+
+from source_connector import SourceConnector, parse_size
+from parquet_layout import ParquetLayout
+from validation import QuarantineWriter, RowValidator, to_float
+from fingerprint import FP_BYTES, FP_COLUMNS, BINARY_ENCODING, TEXT_ENCODING, encode_fingerprints
+
+ARROW_SCHEMA = pa.schema([
+    pa.field("ID", pa.string()),
+    pa.field("Library_ID", pa.string()),
+    pa.field("Sub_ID_1", pa.string()),
+    pa.field("Sub_ID_2", pa.string()),
+    pa.field("Sub_ID_3", pa.string()),
+    pa.field("MW", pa.float32()),
+    pa.field("LogP", pa.float32()),
+    pa.field("FP1", pa.string()),
+    pa.field("FP2", pa.string()),
+    pa.field("FP3", pa.string()),
+    pa.field("FP4", pa.string()),
+    pa.field("FP5", pa.string()),
+])
+
+
+def arrow_schema_for(fingerprint_encoding: str = TEXT_ENCODING) -> pa.Schema:
+    """
+    Returns the Parquet schema for the given fingerprint encoding. Binary
+    fingerprints are written as FIXED_LEN_BYTE_ARRAY(4096).
+    :param fingerprint_encoding: text or binary
+    """
+    if fingerprint_encoding != BINARY_ENCODING:
+        return ARROW_SCHEMA
+    return pa.schema([pa.field(field.name, pa.binary(FP_BYTES))
+                      if field.name in FP_COLUMNS else field
+                      for field in ARROW_SCHEMA])
+
+
+class ArrowConversionEngine(SourceConnector):
+    """
+    Converts a gzip TSV to Parquet with the same schema and missing column
+    handling as GetLoadData.read_input, one record batch at a time.
+    """
+
+    def __init__(self, config_dict: dict, deduplicator=None):
+        super().__init__(config_dict)
+        self.block_size = parse_size(self.prop(
+            "arrow_block_size", optional=True, default_value="16MB"))
+        self.fingerprint_encoding = self.prop(
+            "fingerprint_encoding", optional=True, default_value=TEXT_ENCODING)
+        self.schema = arrow_schema_for(self.fingerprint_encoding)
+        self.layout = ParquetLayout(config_dict)
+        self.validator = RowValidator(config_dict)
+        self.quarantined_rows = 0
+        self.deduplicator = deduplicator
+        self.duplicate_rows = 0
+
+    def open_reader(self, filename: str):
+        """
+        Opens a streaming reader that returns every column as a string
+        :param filename: path to a .tsv or .tsv.gz file
+        """
+        return pv.open_csv(
+            filename,
+            read_options=pv.ReadOptions(block_size=self.block_size),
+            parse_options=pv.ParseOptions(delimiter="\t"),
+            convert_options=pv.ConvertOptions(
+                column_types={field.name: pa.string() for field in ARROW_SCHEMA},
+                strings_can_be_null=True),
+        )
+
+    def iter_batches(self, filename: str, quarantine_path: str = None, source_file: str = None):
+        """
+        Yields record batches conformed to the output schema. With
+        validation enabled, invalid rows are left out and written to
+        quarantine_path instead; quarantined_rows counts them. With a
+        deduplicator, rows whose ID came from another file are left out and
+        counted in duplicate_rows.
+        :param filename: path to a .tsv or .tsv.gz file
+        :param quarantine_path: the folder rejected rows are written to
+        :param source_file: the name the file is tracked under, recorded
+            with rejected rows
+        """
+        reader = self.open_reader(filename)
+        with QuarantineWriter(quarantine_path, source_file or filename) as quarantine:
+            for batch in reader:
+                if self.validator.enabled:
+                    batch = quarantine.split(self.validator, batch)
+                if self.deduplicator is not None:
+                    rows = batch.num_rows
+                    batch = self.deduplicator.filter_batch(batch, source_file or filename)
+                    self.duplicate_rows += rows - batch.num_rows
+                yield self.conform(batch)
+        self.quarantined_rows = quarantine.rows
+        if self.deduplicator is not None:
+            self.deduplicator.report(source_file or filename, self.duplicate_rows)
+
+    def conform(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        """
+        Casts MW and LogP, adds missing columns as nulls, encodes the
+        fingerprints if needed and orders the columns as in the schema
+        :param batch: a batch as read from the TSV
+        """
+        columns = []
+        for field in self.schema:
+            if field.name not in batch.schema.names:
+                columns.append(pa.nulls(batch.num_rows, type=field.type))
+                continue
+            column = batch.column(field.name)
+            if field.name in ("MW", "LogP"):
+                column = to_float(column)
+            elif field.name in FP_COLUMNS and self.fingerprint_encoding == BINARY_ENCODING:
+                column = pa.array(encode_fingerprints(column.to_pylist()), type=field.type)
+            columns.append(column)
+        return pa.RecordBatch.from_arrays(columns, schema=self.schema)
+
+    def convert(self, filename: str, parquet_file_path: str, quarantine_path: str = None,
+                source_file: str = None) -> str:
+        """
+        Writes the file as Parquet into parquet_file_path, with the row
+        groups, codec and sort order of the ParquetLayout. The output folder
+        is only put in place, with a _SUCCESS marker, once it is complete.
+        :param filename: path to a .tsv or .tsv.gz file
+        :param parquet_file_path: the folder the Parquet output is written to
+        :param quarantine_path: the folder rejected rows are written to
+        :param source_file: the name the file is tracked under
+        """
+        temporary_path = parquet_file_path + ".inprogress"
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        os.makedirs(temporary_path)
+
+        rows = 0
+        with pq.ParquetWriter(os.path.join(temporary_path, "part-00000.parquet"),
+                              self.schema, **self.layout.arrow_options()) as writer:
+            for row_group in self.layout.row_groups(
+                    self.iter_batches(filename, quarantine_path, source_file)):
+                writer.write_table(row_group, row_group_size=row_group.num_rows)
+                rows += row_group.num_rows
+
+        open(os.path.join(temporary_path, "_SUCCESS"), "w").close()
+        shutil.rmtree(parquet_file_path, ignore_errors=True)
+        os.rename(temporary_path, parquet_file_path)
+        logger.info("Arrow engine wrote {rows} rows from {file} to {path}",
+                    rows=rows, file=filename, path=parquet_file_path)
+        return parquet_file_path
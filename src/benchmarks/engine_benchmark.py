@@ -0,0 +1,95 @@
+"""
+Compares the pyarrow conversion engine with the Spark path on small files.
+
+Run from src: python -m benchmarks.engine_benchmark --rows 1000 2000
+"""
+import argparse
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from fingerprint import FP_COLUMNS, FP_LENGTH, FP_MAX_VALUE, fingerprints_to_strings
+
+COLUMNS = ["ID", "Library_ID", "Sub_ID_1", "Sub_ID_2", "Sub_ID_3", "MW", "LogP"] + FP_COLUMNS
+
+
+def write_sample_tsv(path: str, rows: int, seed: int = 0) -> str:
+    """
+    Writes a gzip TSV in the format produced by CreateSampleData
+    :param path: where the .tsv.gz file is written
+    :param rows: the number of rows to write
+    :param seed: seed for the random values
+    """
+    rng = np.random.default_rng(seed)
+    with gzip.open(path, "wt", encoding="utf8") as file:
+        file.write("\t".join(COLUMNS) + "\n")
+        for start in range(0, rows, 500):
+            count = min(500, rows - start)
+            fingerprints = [fingerprints_to_strings(
+                rng.integers(0, FP_MAX_VALUE + 1, (count, FP_LENGTH))) for _ in FP_COLUMNS]
+            for i in range(count):
+                row = [f"ID{start + i:08d}", "LIB1", "a", "b", "c",
+                       f"{rng.uniform(0, 100):.4f}", f"{rng.uniform(0, 10):.4f}"]
+                file.write("\t".join(row + [fp[i] for fp in fingerprints]) + "\n")
+    return path
+
+
+def time_arrow(config_dict: dict, filename: str, output_path: str) -> float:
+    from arrow_engine import ArrowConversionEngine
+
+    start = time.perf_counter()
+    ArrowConversionEngine(config_dict).convert(filename, output_path)
+    return time.perf_counter() - start
+
+
+def time_spark(config_dict: dict, filename: str, output_path: str, session_manager) -> float:
+    from data_process_ingest import GetLoadData
+
+    start = time.perf_counter()
+    get_load_data = GetLoadData(config_dict, session_manager=session_manager)
+    get_load_data.write_distributed(get_load_data.read_input(filename), output_path)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 2000, 10000])
+    parser.add_argument("--skip-spark", action="store_true")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="engine_benchmark_")
+    config_dict = {"connector_config": {"output_dir": work_dir, "repartition": 1}}
+    session_manager = None
+    if not args.skip_spark:
+        from spark_session import SparkSessionManager
+        session_manager = SparkSessionManager(config_dict)
+        session_manager.get_session()
+
+    print(f"{'rows':>8} {'MB':>8} {'arrow s':>9} {'spark cold s':>13} {'spark warm s':>13}")
+    try:
+        for rows in args.rows:
+            filename = write_sample_tsv(os.path.join(work_dir, f"sample_{rows}.tsv.gz"), rows)
+            size_mb = os.path.getsize(filename) / 1024 ** 2
+            arrow_seconds = time_arrow(
+                config_dict, filename, os.path.join(work_dir, f"arrow_{rows}"))
+
+            cold = warm = float("nan")
+            if session_manager is not None:
+                warm = time_spark(config_dict, filename, os.path.join(
+                    work_dir, f"spark_{rows}"), session_manager)
+                # A run that converts just this file also pays for startup
+                cold = session_manager.startup_seconds + warm
+
+            print(f"{rows:>8} {size_mb:>8.2f} {arrow_seconds:>9.3f} {cold:>13.3f} {warm:>13.3f}")
+    finally:
+        if session_manager is not None:
+            session_manager.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Local stand-ins for the GCS and BigQuery clients used by the pipeline, so it
+can be driven end to end without network access or credentials. Only the
+calls the pipeline makes are implemented.
+"""
+import datetime
+import fnmatch
+import os
+import shutil
+import threading
+import time
+
+import pyarrow.parquet as pq
+from google.cloud.exceptions import Conflict, NotFound
+
+
+class FakeBlob:
+    """
+    An object in a FakeBucket, stored as a file under the bucket folder
+    """
+
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    @property
+    def generation(self) -> int:
+        return os.stat(self.path).st_mtime_ns
+
+    @property
+    def updated(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(
+            os.path.getmtime(self.path), tz=datetime.timezone.utc)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def download_to_filename(self, filename: str) -> None:
+        if not self.exists():
+            raise NotFound(self.name)
+        shutil.copyfile(self.path, filename)
+
+    def upload_from_filename(self, filename: str) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+    def delete(self) -> None:
+        if not self.exists():
+            raise NotFound(self.name)
+        os.remove(self.path)
+
+
+class FakeBucket:
+    """
+    A bucket backed by the folder <client root>/<bucket name>
+    """
+
+    def __init__(self, client, name: str):
+        self.client = client
+        self.name = name
+        self.root = os.path.join(client.root, name)
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix: str = None):
+        for root, dirs, files in os.walk(self.root):
+            dirs.sort()
+            for file in sorted(files):
+                name = os.path.relpath(os.path.join(root, file), self.root).replace(os.sep, "/")
+                if prefix is None or name.startswith(prefix):
+                    yield FakeBlob(self, name)
+
+
+class FakeBlobIterator:
+    """
+    The blobs of a listing, iterable directly or page by page like the
+    HTTPIterator returned by storage.Client.list_blobs
+    """
+
+    def __init__(self, blobs, page_size: int):
+        self.blobs = blobs
+        self.page_size = page_size
+        self.num_pages = 0
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    @property
+    def pages(self):
+        page = []
+        for blob in self.blobs:
+            page.append(blob)
+            if len(page) == self.page_size:
+                self.num_pages += 1
+                yield page
+                page = []
+        if page:
+            self.num_pages += 1
+            yield page
+
+
+class FakeStorageClient:
+    """
+    Stand-in for storage.Client; every bucket is a folder under root
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def bucket(self, bucket_name: str) -> FakeBucket:
+        return FakeBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name: str) -> FakeBucket:
+        bucket = self.bucket(bucket_name)
+        if not os.path.isdir(bucket.root):
+            raise NotFound(bucket_name)
+        return bucket
+
+    def list_blobs(self, bucket_or_name, prefix: str = None, delimiter: str = None,
+                   page_size: int = None, match_glob: str = None, **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, FakeBucket) \
+            else self.bucket(bucket_or_name)
+        blobs = bucket.list_blobs(prefix=prefix)
+        if delimiter:
+            start = len(prefix or "")
+            blobs = (blob for blob in blobs if delimiter not in blob.name[start:])
+        if match_glob:
+            blobs = (blob for blob in blobs if fnmatch.fnmatch(blob.name, match_glob))
+        return FakeBlobIterator(blobs, page_size or 1000)
+
+    def resolve(self, uri: str) -> str:
+        bucket_name, name = uri[len("gs://"):].split("/", 1)
+        return self.bucket(bucket_name).blob(name).path
+
+
+class FakeLoadJob:
+    """
+    A load job that finishes job_seconds after it was created
+    """
+
+    def __init__(self, job_id: str, output_rows: int, job_seconds: float):
+        self.job_id = job_id
+        self.output_rows = output_rows
+        self.error_result = None
+        self.created = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.started = self.created
+        self.ended = self.created + datetime.timedelta(seconds=job_seconds)
+
+    def done(self) -> bool:
+        return datetime.datetime.now(tz=datetime.timezone.utc) >= self.ended
+
+    def result(self):
+        remaining = (self.ended - datetime.datetime.now(tz=datetime.timezone.utc)).total_seconds()
+        if remaining > 0:
+            time.sleep(remaining)
+        return self
+
+
+class FakeBigQueryClient:
+    """
+    Stand-in for bigquery.Client that accepts Parquet load jobs. Each job
+    reads the Parquet footers to count the loaded rows and takes
+    job_seconds, to model the latency of real load jobs.
+    """
+
+    def __init__(self, storage_client: FakeStorageClient = None, job_seconds: float = 0.0):
+        self.storage_client = storage_client
+        self.job_seconds = job_seconds
+        self.lock = threading.Lock()
+        self.tables: dict = {}
+        self.jobs: dict = {}
+        self.rows_loaded = 0
+        self.bytes_loaded = 0
+
+    @staticmethod
+    def full_table_id(table) -> str:
+        if isinstance(table, str):
+            return table
+        return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+    def get_table(self, table_id):
+        table_id = self.full_table_id(table_id)
+        if table_id not in self.tables:
+            raise NotFound(table_id)
+        return self.tables[table_id]
+
+    def create_table(self, table):
+        with self.lock:
+            self.tables[self.full_table_id(table)] = table
+        return table
+
+    def get_job(self, job_id: str) -> FakeLoadJob:
+        if job_id not in self.jobs:
+            raise NotFound(job_id)
+        return self.jobs[job_id]
+
+    def start_job(self, job_id: str, table, sources: list) -> FakeLoadJob:
+        self.get_table(table)
+        rows = sum(pq.ParquetFile(source).metadata.num_rows for source in sources)
+        with self.lock:
+            if job_id in self.jobs:
+                raise Conflict(job_id)
+            job = FakeLoadJob(job_id, rows, self.job_seconds)
+            self.jobs[job_id] = job
+            self.rows_loaded += rows
+        return job
+
+    def load_table_from_file(self, file_obj, table, job_id: str = None, job_config=None):
+        with self.lock:
+            self.bytes_loaded += os.fstat(file_obj.fileno()).st_size
+        return self.start_job(job_id, table, [file_obj])
+
+    def load_table_from_uri(self, source_uris, table, job_id: str = None, job_config=None):
+        if isinstance(source_uris, str):
+            source_uris = [source_uris]
+        paths = [self.storage_client.resolve(uri) for uri in source_uris]
+        with self.lock:
+            self.bytes_loaded += sum(os.path.getsize(path) for path in paths)
+        return self.start_job(job_id, table, paths)
@@ -0,0 +1,123 @@
+"""
+Compares Parquet layouts (codec, dictionary encoding, sort by ID, row group
+size): output size and write time for each, and with --config the time
+BigQuery takes to load the output.
+
+Run from src:
+    python -m benchmarks.layout_benchmark --rows 20000 --codecs snappy zstd
+    python -m benchmarks.layout_benchmark --rows 20000 --config configs/gcp_config.yaml
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import pyarrow.parquet as pq
+
+from benchmarks.engine_benchmark import time_arrow, time_spark, write_sample_tsv
+from bq_loader import find_parquet_files
+from metrics import parquet_output_stats
+
+
+def layouts(args) -> list:
+    """
+    Returns (name, layout config) for every combination of the options
+    """
+    combinations = itertools.product(args.codecs, args.row_groups, [True, False], [True, False])
+    return [(f"{codec}-{row_group}-{'dict' if dictionary else 'nodict'}"
+             f"-{'sorted' if sort_by_id else 'unsorted'}", {
+                 "parquet_codec": codec,
+                 "parquet_row_group_size": row_group,
+                 "parquet_dictionary_columns": None if dictionary else [],
+                 "parquet_sort_by_id": sort_by_id,
+             }) for codec, row_group, dictionary, sort_by_id in combinations]
+
+
+def load_seconds(loader, parquet_path: str, table_name: str) -> float:
+    """
+    Loads the output into table_name and returns the job time reported by
+    BigQuery, from creation to end
+    """
+    before = loader.metrics.totals.get("load_job", {}).get("seconds", 0.0)
+    loader.load(parquet_path, table_name=table_name)
+    return loader.metrics.totals.get("load_job", {}).get("seconds", 0.0) - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--input", help="use an existing .tsv.gz instead of generating one")
+    parser.add_argument("--engine", choices=["arrow", "spark"], default="arrow")
+    parser.add_argument("--codecs", nargs="+", default=["snappy", "zstd"])
+    parser.add_argument("--row-groups", nargs="+", default=["128MB"],
+                        help="row group sizes, e.g. 32MB 128MB")
+    parser.add_argument("--config", help="connector config with BigQuery credentials; "
+                                         "outputs are loaded into <bq_table_name>_layout_<name>")
+    parser.add_argument("--output", help="also save the report as JSON")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="layout_benchmark_")
+    filename = args.input or write_sample_tsv(
+        os.path.join(work_dir, "sample.tsv.gz"), args.rows)
+
+    base_config = {}
+    loader = None
+    if args.config:
+        from data_process_ingest import load_yaml
+        from metrics import PipelineMetrics
+        from bq_loader import open_loader
+        base_config = load_yaml(args.config)["connector_config"]
+        loader_config = {"connector_config": dict(base_config, metrics_format="none")}
+        loader = open_loader(loader_config, metrics=PipelineMetrics(loader_config))
+
+    session_manager = None
+    if args.engine == "spark":
+        from spark_session import SparkSessionManager
+        session_manager = SparkSessionManager({"connector_config": {}})
+
+    report = []
+    print(f"{'layout':<34} {'MB':>8} {'row groups':>11} {'write s':>9} {'load s':>8}")
+    try:
+        for name, layout in layouts(args):
+            layout = {key: value for key, value in layout.items() if value is not None}
+            config_dict = {"connector_config": dict(
+                base_config, output_dir=work_dir, repartition=1, **layout)}
+            output_path = os.path.join(work_dir, name)
+            if session_manager is not None:
+                write_seconds = time_spark(config_dict, filename, output_path, session_manager)
+            else:
+                write_seconds = time_arrow(config_dict, filename, output_path)
+
+            stats = parquet_output_stats(output_path)
+            row_groups = sum(pq.ParquetFile(path).metadata.num_row_groups
+                             for path in find_parquet_files(output_path))
+            seconds = None
+            if loader is not None:
+                table_name = f"{loader.prop('bq_table_name')}_layout_{name.replace('-', '_')}"
+                seconds = load_seconds(loader, output_path, table_name)
+
+            report.append(dict(stats, layout=name, row_groups=row_groups,
+                               write_seconds=write_seconds, load_seconds=seconds))
+            load_column = f"{seconds:>8.2f}" if seconds is not None else f"{'-':>8}"
+            print(f"{name:<34} {stats['bytes_out'] / 1024 ** 2:>8.2f} {row_groups:>11} "
+                  f"{write_seconds:>9.2f} {load_column}")
+            shutil.rmtree(output_path, ignore_errors=True)
+    finally:
+        if session_manager is not None:
+            session_manager.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as file:
+            json.dump({"input": args.input or f"{args.rows} generated rows",
+                       "engine": args.engine, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "layouts": report}, file, indent=2)
+        print(f"\nReport saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+End to end benchmark of GCPConnector and GetLoadData against local stand-ins
+for GCS and BigQuery (benchmarks/fakes.py), on data made by CreateSampleData.
+
+Every size is ingested in a fresh process, so peak RSS and Spark startup are
+measured per run. Results are saved as JSON under --results-dir and can be
+compared with an earlier run.
+
+Run from src:
+    python -m benchmarks.pipeline_benchmark --sizes 2000 20MB --label before
+    python -m benchmarks.pipeline_benchmark --sizes 2000 20MB --label after \
+        --compare benchmarks/results/before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+BUCKET_NAME = "benchmark"
+
+
+def benchmark_config(work_dir: str, args) -> dict:
+    """
+    Builds the connector config for one run; everything is kept under work_dir
+    """
+    from_bucket = args.source == "gcs"
+    return {"connector_config": {
+        "type": "gcp",
+        "bucket_name": BUCKET_NAME,
+        "search_folder": "GCP" if from_bucket else os.path.join(work_dir, "data"),
+        "ignore_duplicates": True,
+        "persistence_file_path": os.path.join(work_dir, "state", "download_data.yaml"),
+        "state_backend": "sqlite",
+        "state_path": os.path.join(work_dir, "state", "state.sqlite"),
+        "file_extension": ".tsv.gz",
+        "listing_cache_path": os.path.join(work_dir, "state", "listing.sqlite"),
+        "output_dir": os.path.join(work_dir, "output"),
+        "delete_consumed_files": True,
+        "ingest_mode": args.ingest_mode,
+        "fetch_to_local": from_bucket,
+        "fetch_dir": os.path.join(work_dir, "incoming"),
+        "write_mode": "distributed",
+        "repartition": args.partitions,
+        "arrow_engine_max_bytes": "1TB" if args.engine == "arrow" else 0,
+        "split_min_bytes": 0,
+        "split_dir": os.path.join(work_dir, "split"),
+        "metrics_format": "jsonl",
+        "metrics_path": os.path.join(work_dir, "metrics.jsonl"),
+        "key_path": "unused.json",
+        "project_id": "benchmark",
+        "dataset_id": "benchmark",
+        "bq_table_name": "samples",
+    }}
+
+
+def run_ingest(config_dict: dict, bucket_root: str, job_seconds: float, results) -> None:
+    """
+    Ingests every file found by the connector; runs in a child process
+    """
+    from benchmarks.fakes import FakeBigQueryClient, FakeStorageClient
+    from final import GCPConnector
+
+    storage_client = FakeStorageClient(bucket_root)
+    bigquery_client = FakeBigQueryClient(storage_client, job_seconds=job_seconds)
+
+    start = time.perf_counter()
+    connector = GCPConnector(config_dict, storage_client=storage_client,
+                             bigquery_client=bigquery_client)
+    connector.item_generator()
+    seconds = time.perf_counter() - start
+    summary = connector.metrics.summary()
+    connector.close()
+
+    # ru_maxrss is in KB on Linux; children only count once they exited
+    results.put({
+        "seconds": seconds,
+        "rows": bigquery_client.rows_loaded,
+        "parquet_bytes": bigquery_client.bytes_loaded,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "stages": summary["stages"],
+    })
+
+
+def wait_for_result(process, results, poll_seconds: float = 1.0) -> dict:
+    """
+    Returns the result the child process put on the queue, or raises if
+    the process exited without one, e.g. because it crashed or was killed
+    """
+    while True:
+        try:
+            result = results.get(timeout=poll_seconds)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                # The result may have been put just before the process exited
+                try:
+                    result = results.get(timeout=poll_seconds)
+                    break
+                except queue.Empty:
+                    raise RuntimeError(f"The benchmark process exited with code "
+                                       f"{process.exitcode} without a result") from None
+    process.join()
+    return result
+
+
+def benchmark_size(size, args) -> dict:
+    from create_data import CreateSampleData
+
+    work_dir = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    try:
+        bucket_root = os.path.join(work_dir, "bucket")
+        data_dir = os.path.join(bucket_root, BUCKET_NAME) if args.source == "gcs" \
+            else os.path.join(work_dir, "data")
+        CreateSampleData({
+            "persistence_file_path": data_dir,
+            "sample_data": {f"sample_{index}.tsv.gz": size for index in range(args.files)},
+            "seed": args.seed,
+        })
+        input_bytes = sum(os.path.getsize(os.path.join(data_dir, name))
+                          for name in os.listdir(data_dir))
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        process = context.Process(target=run_ingest, args=(
+            benchmark_config(work_dir, args), bucket_root, args.job_seconds, results))
+        process.start()
+        result = wait_for_result(process, results)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    seconds = result["seconds"]
+    return dict(result, size=size, files=args.files, input_bytes=input_bytes,
+                rows_per_second=round(result["rows"] / seconds, 1),
+                mb_per_second=round(input_bytes / 1024 ** 2 / seconds, 2))
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(runs: list, baseline_path: str) -> None:
+    """
+    Prints the change in throughput and memory against an earlier result file
+    """
+    with open(baseline_path, "r", encoding="utf8") as file:
+        baseline = {str(run["size"]): run for run in json.load(file)["runs"]}
+    print(f"\nCompared with {baseline_path}")
+    print(f"{'size':>10} {'rows/s':>12} {'change':>8} {'peak RSS MB':>12} {'change':>8}")
+    for run in runs:
+        before = baseline.get(str(run["size"]))
+        if before is None:
+            continue
+        rows_change = (run["rows_per_second"] / before["rows_per_second"] - 1) * 100 \
+            if before["rows_per_second"] else float("nan")
+        rss_change = (run["peak_rss_mb"] / before["peak_rss_mb"] - 1) * 100 \
+            if before["peak_rss_mb"] else float("nan")
+        print(f"{run['size']:>10} {run['rows_per_second']:>12.1f} {rows_change:>+7.1f}% "
+              f"{run['peak_rss_mb']:>12.1f} {rss_change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["2000", "10000"],
+                        help="rows per file, or a file size such as 50MB")
+    parser.add_argument("--files", type=int, default=2, help="input files per size")
+    parser.add_argument("--source", choices=["local", "gcs"], default="local",
+                        help="read from a local folder or from the fake bucket")
+    parser.add_argument("--engine", choices=["arrow", "spark"], default="spark")
+    parser.add_argument("--ingest-mode", choices=["sequential", "pipelined"],
+                        default="sequential")
+    parser.add_argument("--partitions", default="auto",
+                        help="output partitions per file, or auto")
+    parser.add_argument("--job-seconds", type=float, default=0.0,
+                        help="simulated latency of every BigQuery load job")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default=time.strftime("%Y%m%d-%H%M%S"))
+    parser.add_argument("--results-dir", default=os.path.join("benchmarks", "results"))
+    parser.add_argument("--compare", help="a result file of an earlier run")
+    args = parser.parse_args()
+    if args.source == "gcs" and args.ingest_mode != "pipelined":
+        # Only the pipelined mode fetches gs:// files before converting them
+        parser.error("--source gcs needs --ingest-mode pipelined")
+
+    sizes = [int(size) if size.isdigit() else size for size in args.sizes]
+    runs = []
+    print(f"{'size':>10} {'rows':>10} {'MB in':>8} {'seconds':>9} {'rows/s':>12} "
+          f"{'MB/s':>8} {'peak RSS MB':>12}")
+    for size in sizes:
+        run = benchmark_size(size, args)
+        runs.append(run)
+        print(f"{size:>10} {run['rows']:>10} {run['input_bytes'] / 1024 ** 2:>8.1f} "
+              f"{run['seconds']:>9.2f} {run['rows_per_second']:>12.1f} "
+              f"{run['mb_per_second']:>8.2f} {run['peak_rss_mb']:>12.1f}")
+        for stage, report in run["stages"].items():
+            print(f"{'':>10} {stage:<18} {report['seconds']:>9.3f}s over {report['runs']} run(s)")
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    result_path = os.path.join(args.results_dir, f"{args.label}.json")
+    with open(result_path, "w", encoding="utf8") as file:
+        json.dump({"label": args.label, "commit": git_commit(), "python": platform.python_version(),
+                   "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "options": vars(args),
+                   "runs": runs}, file, indent=2)
+    print(f"\nResults saved to {result_path}")
+
+    if args.compare:
+        compare(runs, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Measures how splitting a large gzip TSV changes the Spark read time.
+
+Run from src: python -m benchmarks.split_benchmark --rows 200000 --chunk 128MB
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.engine_benchmark import write_sample_tsv
+
+
+def time_read(spark, path: str) -> tuple:
+    """
+    Reads the path like GetLoadData.read_input and counts the rows
+    """
+    start = time.perf_counter()
+    df = spark.read.format("csv").option(
+        "delimiter", "\t").option("header", True).load(path)
+    rows = df.count()
+    return rows, df.rdd.getNumPartitions(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--chunk", default="128MB")
+    parser.add_argument("--codec", default="none", choices=["none", "gzip"])
+    parser.add_argument("--input", help="use an existing .tsv.gz instead of generating one")
+    args = parser.parse_args()
+
+    from gzip_splitter import GzipSplitter
+    from spark_session import SparkSessionManager
+
+    work_dir = tempfile.mkdtemp(prefix="split_benchmark_")
+    config_dict = {"connector_config": {
+        "split_min_bytes": 1, "split_chunk_bytes": args.chunk,
+        "split_codec": args.codec, "split_dir": work_dir}}
+    filename = args.input or write_sample_tsv(
+        os.path.join(work_dir, "large.tsv.gz"), args.rows)
+
+    try:
+        with SparkSessionManager(config_dict) as session_manager:
+            spark = session_manager.get_session()
+            rows, partitions, whole_seconds = time_read(spark, filename)
+
+            start = time.perf_counter()
+            chunk_dir = GzipSplitter(config_dict).split(
+                filename, os.path.join(work_dir, "chunks"))
+            split_seconds = time.perf_counter() - start
+            split_rows, split_partitions, split_read_seconds = time_read(spark, chunk_dir)
+
+        assert rows == split_rows, f"row count changed: {rows} != {split_rows}"
+        print(f"input:  {os.path.getsize(filename) / 1024 ** 2:.1f} MB, {rows} rows, "
+              f"{os.cpu_count()} cores")
+        print(f"whole file: {partitions:>4} read tasks, read {whole_seconds:.2f}s")
+        print(f"split:      {split_partitions:>4} read tasks, split {split_seconds:.2f}s "
+              f"+ read {split_read_seconds:.2f}s = {split_seconds + split_read_seconds:.2f}s")
+        print(f"speedup of the read alone: {whole_seconds / split_read_seconds:.2f}x")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
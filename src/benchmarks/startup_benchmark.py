@@ -0,0 +1,170 @@
+"""
+Startup latency of the pipeline modules and of the CLI. Every measurement
+runs in a fresh interpreter, so nothing is already imported or cached in
+the process: the import time of each module, and the cold start of
+cli.py subcommands from launch to exit. Modules whose dependencies are not
+installed are reported with the error instead of a time.
+
+Results are saved as JSON under --results-dir and can be compared with an
+earlier run.
+
+Run from src:
+    python -m benchmarks.startup_benchmark --label before
+    python -m benchmarks.startup_benchmark --label after --compare benchmarks/results/before.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from benchmarks.pipeline_benchmark import git_commit
+
+MODULES = ["cli", "log_config", "create_data", "state_store", "id_lookup", "arrow_engine",
+           "data_process_ingest", "final"]
+IMPORT_SCRIPT = ("import time; start = time.perf_counter(); import {module}; "
+                 "print(time.perf_counter() - start)")
+
+
+def import_seconds(module: str, repeats: int) -> dict:
+    """
+    Returns the median time to import the module in a fresh interpreter,
+    or the error that stopped it
+    """
+    seconds = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+                                capture_output=True, text=True, check=False)
+        if result.returncode:
+            return {"error": result.stderr.strip().splitlines()[-1]}
+        seconds.append(float(result.stdout.strip().splitlines()[-1]))
+    return {"seconds": statistics.median(seconds), "min_seconds": min(seconds)}
+
+
+def slowest_imports(module: str, top: int) -> list:
+    """
+    Returns the modules that took the longest to import themselves, from
+    python -X importtime
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=False)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        timings.append((int(self_us), name.strip()))
+    return [{"module": name, "self_ms": self_us / 1000}
+            for self_us, name in sorted(timings, reverse=True)[:top]]
+
+
+def cold_start_seconds(arguments: list, repeats: int, cwd: str) -> dict:
+    """
+    Returns the median wall time of running cli.py with the arguments in a
+    fresh interpreter, from launch to exit
+    """
+    cli_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "cli.py")
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, cli_path] + arguments, cwd=cwd,
+                                capture_output=True, text=True, check=False)
+        seconds.append(time.perf_counter() - start)
+        if result.returncode:
+            return {"error": result.stderr.strip().splitlines()[-1]}
+    return {"seconds": statistics.median(seconds), "min_seconds": min(seconds)}
+
+
+def cli_commands(work_dir: str) -> dict:
+    """
+    Writes small configs into work_dir and returns the subcommands to time
+    """
+    sample_config = os.path.join(work_dir, "info_config.yaml")
+    with open(sample_config, "w", encoding="utf8") as file:
+        yaml.safe_dump({"persistence_file_path": os.path.join(work_dir, "data"),
+                        "sample_data": {"sample.tsv.gz": 10}, "workers": 1}, file)
+    gcp_config = os.path.join(work_dir, "gcp_config.yaml")
+    with open(gcp_config, "w", encoding="utf8") as file:
+        yaml.safe_dump({"connector_config": {
+            "persistence_file_path": os.path.join(work_dir, "persistence.yaml"),
+            "state_backend": "sqlite", "state_path": os.path.join(work_dir, "state.sqlite"),
+            "listing_cache_path": os.path.join(work_dir, "listing.sqlite"),
+            "quarantine_dir": os.path.join(work_dir, "quarantine")}}, file)
+    return {
+        "--help": ["--help"],
+        "status": ["status", "--config", gcp_config],
+        "generate": ["generate", "--config", sample_config],
+    }
+
+
+def compare(report: dict, baseline_path: str) -> None:
+    """
+    Prints the change in every timing against an earlier result file
+    """
+    with open(baseline_path, "r", encoding="utf8") as file:
+        baseline = json.load(file)
+    print(f"\nCompared with {baseline_path}")
+    print(f"{'':<28} {'seconds':>9} {'change':>8}")
+    for section, prefix in (("imports", "import"), ("cold_start", "cli.py")):
+        for name, result in report[section].items():
+            before = baseline.get(section, {}).get(name, {})
+            if "seconds" not in result or not before.get("seconds"):
+                continue
+            change = (result["seconds"] / before["seconds"] - 1) * 100
+            print(f"{prefix + ' ' + name:<28} {result['seconds']:>9.3f} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="fresh interpreters per measurement; the median is reported")
+    parser.add_argument("--top", type=int, default=0,
+                        help="also list the N slowest imports of every module")
+    parser.add_argument("--label", default=time.strftime("%Y%m%d-%H%M%S"))
+    parser.add_argument("--results-dir", default=os.path.join("benchmarks", "results"))
+    parser.add_argument("--compare", help="a result file of an earlier run")
+    args = parser.parse_args()
+
+    report = {"imports": {}, "cold_start": {}, "slowest_imports": {}}
+    print(f"{'import':<28} {'seconds':>9}")
+    for module in args.modules:
+        result = report["imports"][module] = import_seconds(module, args.repeats)
+        print(f"{module:<28} {result['seconds']:>9.3f}" if "seconds" in result
+              else f"{module:<28} {'-':>9}   {result['error']}")
+        if args.top and "seconds" in result:
+            report["slowest_imports"][module] = slowest_imports(module, args.top)
+            for entry in report["slowest_imports"][module]:
+                print(f"{'':<4}{entry['module']:<40} {entry['self_ms']:>8.1f} ms")
+
+    print(f"\n{'cli.py cold start':<28} {'seconds':>9}")
+    with tempfile.TemporaryDirectory(prefix="startup_benchmark_") as work_dir:
+        for name, arguments in cli_commands(work_dir).items():
+            result = report["cold_start"][name] = cold_start_seconds(
+                arguments, args.repeats, work_dir)
+            print(f"{name:<28} {result['seconds']:>9.3f}" if "seconds" in result
+                  else f"{name:<28} {'-':>9}   {result['error']}")
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    result_path = os.path.join(args.results_dir, f"{args.label}.json")
+    with open(result_path, "w", encoding="utf8") as file:
+        json.dump(dict(report, label=args.label, commit=git_commit(),
+                       python=platform.python_version(),
+                       created=time.strftime("%Y-%m-%dT%H:%M:%S"), options=vars(args)),
+                  file, indent=2)
+    print(f"\nResults saved to {result_path}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
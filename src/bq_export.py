@@ -0,0 +1,271 @@
+"""
+Bulk export of table rows or query results over the BigQuery Storage Read
+API, as Arrow record batches read from parallel streams
+"""
+import copy
+import itertools
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+from google.cloud import bigquery
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types
+from google.oauth2 import service_account
+
+from source_connector import SourceConnector
+from parquet_layout import ParquetLayout
+
+COMPRESSION_CODECS = {
+    "none": None,
+    "lz4": types.ArrowSerializationOptions.CompressionCodec.LZ4_FRAME,
+    "zstd": types.ArrowSerializationOptions.CompressionCodec.ZSTD,
+}
+# Marks the end of one stream in the batch queue
+STREAM_DONE = object()
+
+
+def quote(value: str) -> str:
+    """
+    Quotes a string for a row restriction, which takes no query parameters
+    """
+    return '"{}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def library_filter(library_ids) -> str:
+    """
+    Returns the row restriction selecting the rows of the given libraries
+    :param library_ids: a Library_ID or a list of them
+    """
+    if isinstance(library_ids, str):
+        library_ids = [library_ids]
+    return f"Library_ID IN ({', '.join(quote(library_id) for library_id in library_ids)})"
+
+
+class BigQueryExporter(SourceConnector):
+    """
+    Reads the table, or the result of a query, over export_streams parallel
+    Storage Read API streams. Only the selected columns are read and the row
+    restriction is applied by BigQuery, so filtered rows never leave it.
+    Batches arrive as Arrow and are either written to one Parquet file per
+    stream, using the configured Parquet layout, or handed to the caller as
+    they arrive, at most export_queue_batches ahead of it.
+
+    Query results are read from the query's destination table, so a query
+    that selects millions of rows is not paged through the REST API.
+    """
+
+    def __init__(self, config_dict: dict, metrics=None, client: bigquery.Client = None,
+                 read_client: bigquery_storage_v1.BigQueryReadClient = None):
+        super().__init__(config_dict)
+        self.metrics = metrics
+        self.project_id = self.prop("project_id")
+        self.dataset_id = self.prop("dataset_id")
+        self.table_name = self.prop("bq_table_name")
+        self.streams = self.prop("export_streams", optional=True, default_value=4)
+        self.queue_batches = self.prop("export_queue_batches", optional=True, default_value=16)
+        self.export_dir = self.prop("export_dir", optional=True, default_value="./exports")
+        compression = self.prop("export_compression", optional=True, default_value="lz4")
+        if compression not in COMPRESSION_CODECS:
+            raise ValueError(f"Unknown export_compression '{compression}', "
+                             f"expected one of {sorted(COMPRESSION_CODECS)}")
+        self.compression = COMPRESSION_CODECS[compression]
+        self.layout = ParquetLayout(config_dict)
+
+        if client is None or read_client is None:
+            credentials = service_account.Credentials.from_service_account_file(
+                self.prop("key_path"), scopes=[
+                    "https://www.googleapis.com/auth/cloud-platform"],
+            )
+            if client is None:
+                client = bigquery.Client(credentials=credentials, project=self.project_id)
+            if read_client is None:
+                read_client = bigquery_storage_v1.BigQueryReadClient(credentials=credentials)
+        self.client = client
+        self.read_client = read_client
+
+    def table_path(self, table: bigquery.TableReference = None) -> str:
+        if table is None:
+            table = bigquery.TableReference.from_string(
+                f"{self.project_id}.{self.dataset_id}.{self.table_name}")
+        return f"projects/{table.project}/datasets/{table.dataset_id}/tables/{table.table_id}"
+
+    def open_session(self, columns: list = None, row_restriction: str = None,
+                     table: bigquery.TableReference = None) -> types.ReadSession:
+        """
+        Creates a read session of at most export_streams streams
+        :param columns: the columns to read, None for all columns
+        :param row_restriction: a SQL filter such as library_filter() returns
+        :param table: the table to read, defaults to the ingest table
+        """
+        read_options = types.ReadSession.TableReadOptions(
+            selected_fields=list(columns or []), row_restriction=row_restriction or "")
+        if self.compression is not None:
+            read_options.arrow_serialization_options = types.ArrowSerializationOptions(
+                buffer_compression=self.compression)
+        session = self.read_client.create_read_session(
+            parent=f"projects/{self.project_id}",
+            read_session=types.ReadSession(table=self.table_path(table),
+                                           data_format=types.DataFormat.ARROW,
+                                           read_options=read_options),
+            max_stream_count=self.streams)
+        logger.info("Opened a read session of {streams} stream(s) on {table}, "
+                    "about {mb:.1f} MB to scan", streams=len(session.streams),
+                    table=session.table, mb=session.estimated_total_bytes_scanned / 1024 ** 2)
+        return session
+
+    def query_session(self, query: str, parameters: list = None) -> types.ReadSession:
+        """
+        Runs a query and opens a read session on its result
+        :param query: the SQL query
+        :param parameters: bigquery.ScalarQueryParameter or ArrayQueryParameter values
+        """
+        query_job = self.client.query(
+            query, job_config=bigquery.QueryJobConfig(query_parameters=parameters or []))
+        query_job.result()
+        logger.info("Query {job} processed {mb:.1f} MB", job=query_job.job_id,
+                    mb=(query_job.total_bytes_processed or 0) / 1024 ** 2)
+        return self.open_session(table=query_job.destination)
+
+    def read_stream(self, session: types.ReadSession, stream_name: str):
+        """
+        Yields the record batches of one stream as they arrive
+        """
+        for page in self.read_client.read_rows(stream_name).rows(session).pages:
+            yield page.to_arrow()
+
+    def iter_batches(self, session: types.ReadSession):
+        """
+        Yields the record batches of all streams, read in parallel, in the
+        order they arrive
+        """
+        batches = queue.Queue(maxsize=self.queue_batches)
+        stopped = threading.Event()
+
+        def read(stream_name):
+            try:
+                for batch in self.read_stream(session, stream_name):
+                    while not stopped.is_set():
+                        try:
+                            batches.put(batch, timeout=1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stopped.is_set():
+                        return
+            finally:
+                batches.put(STREAM_DONE)
+
+        streams = [stream.name for stream in session.streams]
+        with ThreadPoolExecutor(max_workers=max(len(streams), 1)) as executor:
+            futures = [executor.submit(read, stream_name) for stream_name in streams]
+            try:
+                remaining = len(streams)
+                while remaining:
+                    batch = batches.get()
+                    if batch is STREAM_DONE:
+                        remaining -= 1
+                        continue
+                    yield batch
+            finally:
+                stopped.set()
+                # Unblocks readers waiting on a full queue after an early exit
+                while any(not future.done() for future in futures):
+                    try:
+                        batches.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            for future in futures:
+                future.result()
+
+    def consume(self, session: types.ReadSession, consumer=None) -> dict:
+        """
+        Hands every batch to consumer and returns the throughput report
+        :param consumer: called with each pyarrow.RecordBatch, e.g. to update
+            NumPy aggregates; None only counts the rows
+        """
+        start = time.perf_counter()
+        rows, size = 0, 0
+        for batch in self.iter_batches(session):
+            rows += batch.num_rows
+            size += batch.nbytes
+            if consumer is not None:
+                consumer(batch)
+        return self.report(session, rows, size, time.perf_counter() - start)
+
+    def to_dataframe(self, session: types.ReadSession) -> pd.DataFrame:
+        """
+        Reads the whole session into one pandas DataFrame
+        """
+        batches = []
+        self.consume(session, batches.append)
+        if not batches:
+            return pa.ipc.read_schema(pa.py_buffer(
+                session.arrow_schema.serialized_schema)).empty_table().to_pandas()
+        return pa.Table.from_batches(batches).to_pandas()
+
+    def to_parquet(self, session: types.ReadSession, name: str) -> dict:
+        """
+        Writes every stream to its own Parquet file under export_dir/name
+        and returns the throughput report. The streams are written in
+        parallel and an earlier export of the same name is replaced.
+        """
+        output_path = os.path.join(self.export_dir, name)
+        shutil.rmtree(output_path, ignore_errors=True)
+        os.makedirs(output_path)
+
+        def write(index, stream_name):
+            rows, size = 0, 0
+            batches = self.read_stream(session, stream_name)
+            first = next(batches, None)
+            if first is None:
+                return rows, size
+            layout = copy.copy(self.layout)
+            layout.sort_by_id = layout.sort_by_id and "ID" in first.schema.names
+            options = layout.arrow_options()
+            if isinstance(options["use_dictionary"], list):
+                options["use_dictionary"] = [column for column in options["use_dictionary"]
+                                             if column in first.schema.names]
+            with pq.ParquetWriter(os.path.join(output_path, f"part-{index:05d}.parquet"),
+                                  first.schema, **options) as writer:
+                for row_group in layout.row_groups(itertools.chain([first], batches)):
+                    rows += row_group.num_rows
+                    size += row_group.nbytes
+                    writer.write_table(row_group, row_group_size=row_group.num_rows)
+            return rows, size
+
+        start = time.perf_counter()
+        streams = [stream.name for stream in session.streams]
+        with ThreadPoolExecutor(max_workers=max(len(streams), 1)) as executor:
+            totals = list(executor.map(write, range(len(streams)), streams))
+        report = self.report(session, sum(rows for rows, _ in totals),
+                             sum(size for _, size in totals), time.perf_counter() - start)
+        report["path"] = output_path
+        return report
+
+    def report(self, session: types.ReadSession, rows: int, size: int, seconds: float) -> dict:
+        """
+        Logs and returns the rows and bytes read and the throughput
+        """
+        report = {
+            "table": session.table,
+            "streams": len(session.streams),
+            "rows": rows,
+            "bytes": size,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(rows / seconds, 1) if seconds else 0.0,
+            "mb_per_second": round(size / 1024 ** 2 / seconds, 2) if seconds else 0.0,
+        }
+        if self.metrics is not None:
+            self.metrics.record(session.table, "export", seconds, rows=rows, bytes_out=size)
+        logger.info("Exported {rows} rows ({mb:.1f} MB) over {streams} stream(s) in "
+                    "{seconds:.2f}s: {rows_per_second} rows/s, {mb_per_second} MB/s",
+                    mb=size / 1024 ** 2, **report)
+        return report
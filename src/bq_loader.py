@@ -0,0 +1,394 @@
+"""
+Bulk loader that batches Parquet outputs into as few BigQuery load jobs as possible
+"""
+import hashlib
+import os
+import tempfile
+import uuid
+
+import pyarrow.parquet as pq
+
+from loguru import logger
+from google.cloud import bigquery
+from google.cloud import storage
+from google.oauth2 import service_account
+from google.cloud.exceptions import NotFound, Conflict
+
+from source_connector import SourceConnector
+from fingerprint import FP_COLUMNS, BINARY_ENCODING, TEXT_ENCODING
+
+TABLE_SCHEMA = [
+    bigquery.SchemaField("ID", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("Library_ID", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("Sub_ID_1", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("Sub_ID_2", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("Sub_ID_3", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("MW", "FLOAT64", mode="REQUIRED"),
+    bigquery.SchemaField("LogP", "FLOAT64", mode="REQUIRED"),
+    bigquery.SchemaField("FP1", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("FP2", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("FP3", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("FP4", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("FP5", "STRING", mode="NULLABLE"),
+]
+
+
+def table_schema_for(fingerprint_encoding: str = TEXT_ENCODING) -> list:
+    """
+    Returns the table schema for the given fingerprint encoding
+    :param fingerprint_encoding: text for comma separated strings, binary for BYTES
+    """
+    if fingerprint_encoding != BINARY_ENCODING:
+        return list(TABLE_SCHEMA)
+    return [bigquery.SchemaField(field.name, "BYTES", mode=field.mode)
+            if field.name in FP_COLUMNS else field
+            for field in TABLE_SCHEMA]
+
+
+def find_parquet_files(parquet_paths) -> list:
+    """
+    Returns every Parquet file found under the given files or folders
+    :param parquet_paths: a path or a list of paths to Parquet files or folders
+    """
+    if isinstance(parquet_paths, str):
+        parquet_paths = [parquet_paths]
+
+    found = []
+    for parquet_path in parquet_paths:
+        if os.path.isfile(parquet_path):
+            found.append(parquet_path)
+            continue
+        for root, dirs, files in os.walk(parquet_path):
+            for file in sorted(files):
+                if file.endswith(".parquet"):
+                    found.append(os.path.join(root, file))
+    return found
+
+
+class LoadJobError(RuntimeError):
+    """
+    Raised when load jobs of a file failed, after every job was waited on
+    """
+
+
+class BigQueryBulkLoader(SourceConnector):
+    """
+    Creates its GCS and BigQuery clients once, caches table metadata and
+    loads many Parquet files per load job.
+
+    Files are loaded bq_files_per_job at a time (0 for all files in one
+    job). When bq_staging_bucket is set, they are uploaded to GCS and loaded
+    with one load_table_from_uri job. Without a staging bucket, the files of
+    a job are merged into one temporary Parquet file, a row group at a time,
+    and loaded with load_table_from_file, which takes a single file. All
+    jobs are submitted before any of them is waited on.
+
+    The BigQuery and storage clients can be passed in, e.g. to load into
+    local stand-ins for benchmarks.
+    """
+
+    def __init__(self, config_dict: dict, metrics=None, client: bigquery.Client = None,
+                 storage_client: storage.Client = None):
+        super().__init__(config_dict)
+        self.metrics = metrics
+
+        key_path = self.prop("key_path")
+        self.project_id = self.prop("project_id")
+        self.dataset_id = self.prop("dataset_id")
+        self.staging_bucket = self.prop("bq_staging_bucket", optional=True)
+        self.staging_prefix = self.prop(
+            "bq_staging_prefix", optional=True, default_value="staging")
+        self.files_per_job = self.prop(
+            "bq_files_per_job", optional=True, default_value=0)
+        self.fingerprint_encoding = self.prop(
+            "fingerprint_encoding", optional=True, default_value=TEXT_ENCODING)
+        self.job_prefix = self.prop(
+            "bq_job_prefix", optional=True, default_value="ingest")
+        self.max_job_attempts = self.prop(
+            "bq_max_job_attempts", optional=True, default_value=3)
+
+        if client is None or (self.staging_bucket and storage_client is None):
+            credentials = service_account.Credentials.from_service_account_file(
+                key_path, scopes=[
+                    "https://www.googleapis.com/auth/cloud-platform"],
+            )
+            if client is None:
+                client = bigquery.Client(credentials=credentials,
+                                         project=self.project_id)
+            if self.staging_bucket and storage_client is None:
+                storage_client = storage.Client(
+                    credentials=credentials, project=self.project_id)
+        self.client = client
+        self.storage_client = storage_client
+
+        self.tables: dict = {}
+
+    def table_id(self, table_name: str = None) -> str:
+        table_name = table_name or self.prop("bq_table_name")
+        return "{}.{}.{}".format(self.project_id, self.dataset_id, table_name)
+
+    def get_table(self, table_id: str, table_schema: list = None):
+        """
+        Returns the table, creating it on first use. The result is cached so
+        later loads into the same table skip the get_table round trip.
+        :param table_id: the fully qualified table id
+        :param table_schema: schema used when the table has to be created
+        """
+        if table_id in self.tables:
+            return self.tables[table_id]
+
+        table_schema = table_schema or table_schema_for(self.fingerprint_encoding)
+        try:
+            table = self.client.get_table(table_id)
+            logger.info("Table {table_id} already exists.", table_id=table_id)
+
+        except NotFound:
+            table = bigquery.Table(table_id, schema=table_schema)
+            table.clustering_fields = ['ID']
+            table = self.client.create_table(table)
+            logger.info("Created clustered table {table_id}",
+                        table_id=table_id)
+
+        self.tables[table_id] = table
+        return table
+
+    def job_config(self) -> bigquery.LoadJobConfig:
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = bigquery.SourceFormat.PARQUET
+        return job_config
+
+    def chunk(self, items: list) -> list:
+        size = self.files_per_job or len(items) or 1
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def stage_files(self, parquet_files: list) -> list:
+        """
+        Uploads local Parquet files to the staging bucket
+        :param parquet_files: local Parquet file paths
+        """
+        bucket = self.storage_client.bucket(self.staging_bucket)
+        run_prefix = f"{self.staging_prefix}/{uuid.uuid4().hex}"
+        uris = []
+        for index, parquet_file in enumerate(parquet_files):
+            blob = bucket.blob(
+                f"{run_prefix}/{index:05d}-{os.path.basename(parquet_file)}")
+            blob.upload_from_filename(parquet_file)
+            uris.append(f"gs://{self.staging_bucket}/{blob.name}")
+        return uris
+
+    def delete_staged(self, uris: list) -> None:
+        bucket = self.storage_client.bucket(self.staging_bucket)
+        prefix = f"gs://{self.staging_bucket}/"
+        for uri in uris:
+            try:
+                bucket.blob(uri[len(prefix):]).delete()
+            except NotFound:
+                pass
+
+    def plan_units(self, parquet_files: list, table_id: str, source_file: str = None,
+                   source_version: str = None) -> list:
+        """
+        Groups the files into load units, one per load job, each with a
+        deterministic key that is also used as the job id. The key is made
+        from the table, the input file, its version and the paths of the
+        files within the output, which name_parts keeps the same when the
+        output is written again. A retried load of the same version can
+        therefore never insert the same rows twice, while a new version of
+        the input, e.g. an overwritten object or a modified local file, gets
+        new keys and is loaded again.
+        :param parquet_files: local Parquet file paths
+        :param table_id: the destination table id
+        :param source_file: the input file the Parquet files were converted from
+        :param source_version: the version of the input that was converted,
+            e.g. its GCS generation or local size and modification time
+        """
+        batches = self.chunk(parquet_files)
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path))
+                                   for path in parquet_files])
+        units = []
+        for batch in batches:
+            digest = hashlib.sha1("|".join(
+                [table_id, source_file or "", source_version or ""]
+                + [os.path.relpath(os.path.abspath(path), root) for path in batch]
+            ).encode("utf8")).hexdigest()
+            units.append((f"{self.job_prefix}_{digest}", batch))
+        return units
+
+    def start_job(self, job_key: str, create_job):
+        """
+        Starts a load job under a deterministic id. If a job with that id
+        already exists, e.g. because the previous run crashed before its
+        checkpoint was written, that job is reused unless it failed, in
+        which case a numbered retry id is used.
+        :param job_key: the deterministic key of the load unit
+        :param create_job: called with a job id, starts the load job
+        """
+        for attempt in range(self.max_job_attempts):
+            job_id = job_key if attempt == 0 else f"{job_key}_{attempt}"
+            try:
+                return create_job(job_id)
+            except Conflict:
+                job = self.client.get_job(job_id)
+                if not (job.done() and job.error_result):
+                    logger.info("Reusing existing load job {job_id}", job_id=job_id)
+                    return job
+        raise RuntimeError(
+            f"Load job {job_key} failed {self.max_job_attempts} times")
+
+    def submit(self, units: list, table) -> list:
+        """
+        Starts the load jobs for the given units without waiting on them
+        :param units: (job_key, parquet_files) pairs returned by plan_units
+        :param table: the destination table
+        """
+        jobs = []
+        for job_key, parquet_files in units:
+            if self.staging_bucket:
+                uris = self.stage_files(parquet_files)
+                job = self.start_job(job_key, lambda job_id: self.client.load_table_from_uri(
+                    uris, table, job_id=job_id, job_config=self.job_config()))
+                jobs.append((job, job_key, parquet_files, uris))
+                continue
+
+            def create_job(job_id, parquet_files=parquet_files):
+                merged_file = self.merge_files(parquet_files) if len(parquet_files) > 1 \
+                    else None
+                try:
+                    with open(merged_file or parquet_files[0], 'rb') as source_file:
+                        return self.client.load_table_from_file(
+                            source_file, table, job_id=job_id, job_config=self.job_config())
+                finally:
+                    # The file is uploaded by the time the job is created
+                    if merged_file is not None:
+                        os.remove(merged_file)
+            jobs.append((self.start_job(job_key, create_job), job_key, parquet_files, []))
+        return jobs
+
+    @staticmethod
+    def merge_files(parquet_files: list) -> str:
+        """
+        Writes the row groups of several Parquet files into one temporary
+        file, one row group at a time, and returns its path
+        :param parquet_files: local Parquet files with the same columns
+        """
+        schema = pq.read_schema(parquet_files[0])
+        handle, merged_file = tempfile.mkstemp(prefix="bq-load-", suffix=".parquet")
+        os.close(handle)
+        try:
+            with pq.ParquetWriter(merged_file, schema) as writer:
+                for parquet_file in parquet_files:
+                    source = pq.ParquetFile(parquet_file)
+                    for row_group in range(source.num_row_groups):
+                        table = source.read_row_group(row_group)
+                        if not table.schema.equals(schema):
+                            table = table.select(schema.names).cast(schema)
+                        writer.write_table(table)
+        except BaseException:
+            os.remove(merged_file)
+            raise
+        return merged_file
+
+    def wait(self, jobs: list, table_id: str, source_file: str = None, state=None) -> int:
+        """
+        Waits on all submitted jobs and returns the number of rows loaded.
+        Each successful job is checkpointed in the state store. If any job
+        failed, LoadJobError is raised once every job was waited on, so the
+        file is not marked processed and the failed jobs run again on retry.
+        :param jobs: the jobs returned by submit
+        :param table_id: the destination table id, used for logging
+        :param source_file: the input file the jobs belong to
+        :param state: the StateStore that holds the checkpoints
+        """
+        total_rows = 0
+        failed = []
+        for job, job_key, parquet_files, uris in jobs:
+            try:
+                job.result()
+                total_rows += job.output_rows or 0
+                logger.info("Loaded {rows} rows from {count} file(s) into {table_id}.",
+                            rows=job.output_rows, count=len(parquet_files), table_id=table_id)
+                if self.metrics is not None:
+                    self.record_job_metrics(job, parquet_files, source_file)
+                if state is not None and source_file is not None:
+                    state.record_checkpoint(
+                        source_file, "load", job_key, "|".join(parquet_files))
+            except Exception as e:
+                logger.error("Load job {job_id} failed: {error}", job_id=job.job_id, error=e)
+                failed.append(job.job_id)
+
+        if self.staging_bucket:
+            self.delete_staged([uri for job in jobs for uri in job[3]])
+        if failed:
+            raise LoadJobError(
+                f"{len(failed)} of {len(jobs)} load job(s) failed for "
+                f"{source_file or table_id}: {', '.join(failed)}")
+        return total_rows
+
+    def record_job_metrics(self, job, parquet_files: list, source_file: str = None) -> None:
+        """
+        Records the latency of a finished load job from its timestamps:
+        seconds from creation to end, of which queued_seconds before it started
+        """
+        if job.created is None or job.ended is None:
+            return
+        started = job.started or job.created
+        self.metrics.record(
+            source_file or parquet_files[0], "load_job",
+            (job.ended - job.created).total_seconds(),
+            queued_seconds=(started - job.created).total_seconds(),
+            rows=job.output_rows or 0,
+            bytes_in=sum(os.path.getsize(path) for path in parquet_files),
+            partitions=len(parquet_files), job_id=job.job_id)
+
+    def load(self, parquet_paths, table_name: str = None, source_file: str = None,
+             state=None, source_version: str = None) -> int:
+        """
+        Loads every Parquet file under the given paths into the table.
+        With a state store, load jobs that already succeeded for source_file
+        are skipped, so a restarted file only loads what is left.
+        :param parquet_paths: a path or a list of paths to Parquet files or folders
+        :param table_name: overrides bq_table_name from the config
+        :param source_file: the input file the Parquet files were converted from
+        :param state: the StateStore that holds the checkpoints
+        :param source_version: the version of the input, see plan_units
+        """
+        parquet_files = find_parquet_files(parquet_paths)
+        if not parquet_files:
+            return 0
+
+        table_id = self.table_id(table_name)
+        units = self.plan_units(parquet_files, table_id, source_file, source_version)
+        if state is not None and source_file is not None:
+            loaded = state.checkpoints(source_file, "load")
+            if loaded:
+                logger.info("Skipping {count} load job(s) already done for {file}",
+                            count=len([key for key, _ in units if key in loaded]),
+                            file=source_file)
+            units = [unit for unit in units if unit[0] not in loaded]
+        if not units:
+            return 0
+
+        table = self.get_table(table_id)
+        jobs = self.submit(units, table)
+        return self.wait(jobs, table_id, source_file, state)
+
+
+LOAD_MODES = ("load_job", "storage_write")
+
+
+def open_loader(config_dict: dict, load_mode: str = "load_job", **kwargs) -> BigQueryBulkLoader:
+    """
+    Builds the loader for load_mode. storage_write, and the
+    google-cloud-bigquery-storage package it needs, is only imported when
+    that mode is used.
+    :param config_dict: the connector config
+    :param load_mode: load_job or storage_write
+    :param kwargs: passed on to the loader, e.g. metrics or injected clients
+    """
+    if load_mode == "load_job":
+        return BigQueryBulkLoader(config_dict, **kwargs)
+    if load_mode == "storage_write":
+        from storage_write import StorageWriteLoader
+        return StorageWriteLoader(config_dict, **kwargs)
+    raise ValueError(
+        f"Unknown load_mode '{load_mode}', expected one of {sorted(LOAD_MODES)}")
@@ -0,0 +1,165 @@
+"""
+Prefix scoped, paginated listing of the input bucket with a local cache of
+object generations, so later runs only hand out new or changed objects
+"""
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from loguru import logger
+
+from source_connector import SourceConnector
+
+
+class BucketListing(SourceConnector):
+    """
+    Lists the objects under bucket_prefix that end with file_extension, one
+    page of list_page_size objects at a time. With list_delimiter (e.g. "/")
+    only the objects directly under the prefix are listed. Without it the
+    extension is also matched on the server with match_glob.
+
+    Every listed object is recorded, with its generation, update time and
+    size, in the SQLite file listing_cache_path, together with the
+    generation that was last ingested. Objects whose current generation was
+    already ingested are skipped while listing; an object overwritten since
+    it was ingested is listed again.
+    """
+
+    def __init__(self, config_dict: dict, storage_client):
+        super().__init__(config_dict)
+        self.storage_client = storage_client
+        self.bucket_name = self.prop("bucket_name")
+        self.prefix = self.prop("bucket_prefix", optional=True, default_value="") or None
+        self.delimiter = self.prop("list_delimiter", optional=True)
+        self.page_size = self.prop("list_page_size", optional=True, default_value=1000)
+        self.file_extension = self.prop("file_extension", optional=True, default_value=".gz")
+        cache_path = self.prop(
+            "listing_cache_path", optional=True, default_value="./process_data/listing.sqlite")
+        os.makedirs(Path(cache_path).parent, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS objects (
+                name TEXT PRIMARY KEY, generation INTEGER, updated TEXT,
+                size INTEGER, ingested_generation INTEGER)""")
+        self.connection.commit()
+
+    def uri(self, name: str) -> str:
+        return f"gs://{self.bucket_name}/{name}"
+
+    def object_name(self, uri: str) -> str:
+        prefix = f"gs://{self.bucket_name}/"
+        return uri[len(prefix):] if uri.startswith(prefix) else uri
+
+    def list_pages(self, start_offset: str = None):
+        """
+        Yields the pages of matching blobs as they are fetched
+        :param start_offset: only list objects named start_offset or later
+        """
+        match_glob = None if self.delimiter else f"**{self.file_extension}"
+        blobs = self.storage_client.list_blobs(
+            self.bucket_name, prefix=self.prefix, delimiter=self.delimiter,
+            page_size=self.page_size, match_glob=match_glob, start_offset=start_offset,
+            fields="items(name,generation,updated,size),nextPageToken")
+        for page in blobs.pages:
+            yield [blob for blob in page if blob.name.endswith(self.file_extension)]
+
+    def list_files(self, skip_ingested: bool = True, start_offset: str = None):
+        """
+        Yields the gs:// paths of new and changed objects, one page at a time
+        :param skip_ingested: False to also yield objects whose current
+            generation was already ingested
+        :param start_offset: only list objects named start_offset or later,
+            e.g. last_name() to only look for objects added after the last listing
+        """
+        listed = skipped = 0
+        for page in self.list_pages(start_offset):
+            rows = [(blob.name, blob.generation,
+                     blob.updated.isoformat() if blob.updated else None, blob.size)
+                    for blob in page]
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    "INSERT INTO objects (name, generation, updated, size) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET generation = excluded.generation, "
+                    "updated = excluded.updated, size = excluded.size", rows)
+                # Listings are in name order, so a page is one range of names
+                ingested = dict(self.connection.execute(
+                    "SELECT name, ingested_generation FROM objects WHERE name BETWEEN ? AND ?",
+                    (rows[0][0], rows[-1][0]))) if rows else {}
+
+            for name, generation, updated, size in rows:
+                listed += 1
+                if skip_ingested and ingested.get(name) == generation:
+                    skipped += 1
+                    continue
+                yield self.uri(name)
+
+        logger.info("Listed {listed} objects under gs://{bucket}/{prefix}{offset}, "
+                    "{skipped} already ingested", listed=listed,
+                    bucket=self.bucket_name, prefix=self.prefix or "", skipped=skipped,
+                    offset=f" from {start_offset}" if start_offset else "")
+
+    def last_name(self):
+        """
+        Returns the greatest object name under the prefix in the cache, or
+        None before the first listing
+        """
+        prefix = self.prefix or ""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MAX(name) FROM objects WHERE substr(name, 1, ?) = ?",
+                (len(prefix), prefix)).fetchone()
+        return row[0]
+
+    def is_changed(self, uri: str) -> bool:
+        """
+        Returns True if the object was ingested before and has been
+        overwritten since
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT generation, ingested_generation FROM objects WHERE name = ?",
+                (self.object_name(uri),)).fetchone()
+        return row is not None and row[1] is not None and row[0] != row[1]
+
+    def generation(self, uri: str):
+        """
+        Returns the listed generation of an object, None if it was not listed
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT generation FROM objects WHERE name = ?", (self.object_name(uri),)).fetchone()
+        return row[0] if row is not None else None
+
+    def size(self, uri: str):
+        """
+        Returns the listed size of an object, None if it was not listed
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size FROM objects WHERE name = ?", (self.object_name(uri),)).fetchone()
+        return row[0] if row is not None else None
+
+    def mark_ingested(self, uri: str, generation: int = None) -> None:
+        """
+        Records a generation of an object as ingested
+        :param uri: the gs:// path of the object
+        :param generation: the generation that was fetched, defaults to the
+            listed one. An object overwritten after it was fetched keeps a
+            newer listed generation and is handed out again.
+        """
+        with self.lock, self.connection:
+            if generation is None:
+                self.connection.execute(
+                    "UPDATE objects SET ingested_generation = generation WHERE name = ?",
+                    (self.object_name(uri),))
+            else:
+                self.connection.execute(
+                    "UPDATE objects SET ingested_generation = ? WHERE name = ?",
+                    (int(generation), self.object_name(uri)))
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,212 @@
+"""
+Command line entry point for the pipeline. Run from src:
+
+    python cli.py generate [--config configs/info_config.yaml]
+    python cli.py ingest [--config configs/gcp_config.yaml] [--watch]
+    python cli.py lookup ID [ID ...] [--columns MW LogP] [--local]
+    python cli.py export [--library-id L1 ...] [--where SQL | --query SQL] [--columns ID MW]
+    python cli.py status [--config configs/gcp_config.yaml]
+
+Each subcommand imports only the modules it needs when it runs, so
+generate, lookup and status start without loading pyspark or the GCP
+clients they do not use. benchmarks/startup_benchmark.py tracks the
+import and cold start times.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import yaml
+
+GCP_CONFIG = "./configs/gcp_config.yaml"
+SAMPLE_CONFIG = "./configs/info_config.yaml"
+
+
+def load_yaml(yaml_file_path: str) -> dict:
+    """
+    Loads the contents of the yaml file into a dictionary for use by a job
+    :param yaml_file_path: a path to a yaml file with configuration information
+    """
+    data = None
+
+    try:
+        with open(yaml_file_path, "r", encoding="utf8") as file:
+            data = yaml.safe_load(file)
+    except FileNotFoundError as exc:
+        raise FileNotFoundError(
+            f"No config file found at {yaml_file_path}") from exc
+
+    if data is None:
+        raise ValueError("Config File Contains Nothing or Does Not Exist")
+    return data
+
+
+def generate(args) -> None:
+    from create_data import CreateSampleData
+
+    CreateSampleData(load_yaml(args.config or SAMPLE_CONFIG))
+
+
+def ingest(args) -> None:
+    from log_config import configure_logging
+    from final import GCPConnector
+
+    configure_logging()
+    connector = GCPConnector(load_yaml(args.config or GCP_CONFIG))
+    try:
+        if args.watch:
+            connector.watch()
+        else:
+            connector.item_generator()
+    finally:
+        connector.close()
+
+
+def lookup(args) -> None:
+    config_dict = load_yaml(args.config or GCP_CONFIG)
+    if args.local:
+        from parquet_index import LocalIdIndex
+        service = LocalIdIndex(config_dict)
+    else:
+        from id_lookup import IdLookupService
+        service = IdLookupService(config_dict)
+
+    ids = list(args.ids)
+    if args.ids_file:
+        with open(args.ids_file, "r", encoding="utf8") as file:
+            ids.extend(line.strip() for line in file if line.strip())
+    for target_id, row in service.lookup(ids, args.columns).items():
+        print(json.dumps({"ID": target_id, "row": row}, default=str))
+    if not args.local:
+        service.stats()
+
+
+def export(args) -> dict:
+    from bq_export import BigQueryExporter, library_filter
+
+    exporter = BigQueryExporter(load_yaml(args.config or GCP_CONFIG))
+    if args.query:
+        session = exporter.query_session(args.query)
+    else:
+        filters = [f"({args.where})"] if args.where else []
+        if args.library_id:
+            filters.append(library_filter(args.library_id))
+        session = exporter.open_session(args.columns, " AND ".join(filters) or None)
+
+    if args.count_only:
+        report = exporter.consume(session)
+    else:
+        name = args.name or "-".join(args.library_id or []) or time.strftime("%Y%m%d-%H%M%S")
+        report = exporter.to_parquet(session, name)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def count_rows(path: str, query: str) -> list:
+    """
+    Runs a read only query against a SQLite file without creating it
+    """
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return list(connection.execute(query).fetchone())
+    finally:
+        connection.close()
+
+
+def status(args) -> dict:
+    """
+    Prints what the pipeline has done so far: processed files, the bucket
+    listing cache, known IDs and quarantined files. Every store is only
+    read: the state is read with read_processed_files and the SQLite files
+    are opened read only, so nothing is created, migrated or changed
+    (SQLite may still add the -wal and -shm files of a database in WAL mode).
+    """
+    props = load_yaml(args.config or GCP_CONFIG)["connector_config"]
+    report = {}
+
+    backend = props.get("state_backend", "yaml")
+    state_path = props.get("persistence_file_path") if backend == "yaml" \
+        else props.get("state_path", "./process_data/state.sqlite")
+    report["state"] = {"backend": backend, "path": state_path}
+    if state_path and os.path.exists(state_path):
+        from state_store import read_processed_files
+        processed = read_processed_files(backend, state_path, props.get("persistence_file_path"))
+        report["state"].update(processed_files=len(processed), last_processed=processed[-5:])
+
+    listing_path = props.get("listing_cache_path", "./process_data/listing.sqlite")
+    if os.path.exists(listing_path):
+        listed, ingested, pending = count_rows(
+            listing_path, "SELECT COUNT(*), COUNT(ingested_generation), "
+                          "SUM(ingested_generation IS NULL OR ingested_generation != generation) "
+                          "FROM objects")
+        report["listing"] = {"path": listing_path, "objects": listed,
+                             "ingested": ingested, "pending": pending or 0}
+
+    dedup_dir = props.get("dedup_dir", os.path.join(
+        os.path.dirname(props.get("state_path", "./process_data/state.sqlite")) or ".", "ids"))
+    ids_path = os.path.join(dedup_dir, "ids.sqlite")
+    if os.path.exists(ids_path):
+        report["dedup"] = {"path": ids_path,
+                           "known_ids": count_rows(ids_path, "SELECT COUNT(*) FROM ids")[0]}
+
+    quarantine_dir = props.get("quarantine_dir", "./quarantine")
+    if os.path.isdir(quarantine_dir):
+        report["quarantine"] = {"path": quarantine_dir,
+                                "files": sorted(os.listdir(quarantine_dir))}
+
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subcommands.add_parser("generate", help="write sample input files")
+    generate_parser.add_argument("--config", help=f"defaults to {SAMPLE_CONFIG}")
+    generate_parser.set_defaults(run=generate)
+
+    ingest_parser = subcommands.add_parser("ingest", help="ingest files into BigQuery")
+    ingest_parser.add_argument("--config", help=f"defaults to {GCP_CONFIG}")
+    ingest_parser.add_argument("--watch", action="store_true",
+                               help="keep running and ingest new files as they arrive")
+    ingest_parser.set_defaults(run=ingest)
+
+    lookup_parser = subcommands.add_parser("lookup", help="look up rows by ID")
+    lookup_parser.add_argument("ids", nargs="*", help="the IDs to look up")
+    lookup_parser.add_argument("--ids-file", help="a file with one ID per line")
+    lookup_parser.add_argument("--columns", nargs="+", help="the columns to return")
+    lookup_parser.add_argument("--local", action="store_true",
+                               help="serve from the local ID index instead of BigQuery")
+    lookup_parser.add_argument("--config", help=f"defaults to {GCP_CONFIG}")
+    lookup_parser.set_defaults(run=lookup)
+
+    export_parser = subcommands.add_parser(
+        "export", help="export rows to Parquet over the Storage Read API")
+    export_parser.add_argument("--library-id", nargs="+", help="only rows of these libraries")
+    export_parser.add_argument("--where", help="a row restriction, e.g. \"MW > 300\"")
+    export_parser.add_argument("--query", help="export the result of this query instead")
+    export_parser.add_argument("--columns", nargs="+", help="the columns to export")
+    export_parser.add_argument("--name", help="the folder under export_dir to write to")
+    export_parser.add_argument("--count-only", action="store_true",
+                               help="read the rows and report throughput without writing them")
+    export_parser.add_argument("--config", help=f"defaults to {GCP_CONFIG}")
+    export_parser.set_defaults(run=export)
+
+    status_parser = subcommands.add_parser("status", help="show what has been ingested")
+    status_parser.add_argument("--config", help=f"defaults to {GCP_CONFIG}")
+    status_parser.set_defaults(run=status)
+    return parser
+
+
+def main(argv: list = None) -> None:
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,63 +1,178 @@
-import random
+import gzip
+import math
+import os
 import string
-import pandas as pd
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from loguru import logger
 
 import yaml
 
-from local_local import ProcessData
+from source_connector import parse_size
+
+COLUMNS = ["ID", "Library_ID", "Sub_ID_1", "Sub_ID_2", "Sub_ID_3",
+           "MW", "LogP", "FP1", "FP2", "FP3", "FP4", "FP5"]
+ALPHABET = np.frombuffer(
+    (string.ascii_letters + string.digits).encode("ascii"), dtype="S1")
+FINGERPRINT_LENGTH = 2048
+FINGERPRINT_MAX = 1000
+# Text of every possible fingerprint value, so formatting is a table lookup
+FINGERPRINT_TEXT = np.array([str(value) for value in range(FINGERPRINT_MAX + 1)],
+                            dtype=object)
+# Compressed bytes per row until the first chunk of a file is written; rows
+# are about 15 KB at gzip level 1
+ROW_BYTES_ESTIMATE = 16 * 1024
+
 
+def random_strings(rng: np.random.Generator, count: int, length: int) -> np.ndarray:
+    """
+    Generates count random alphanumeric strings of the given length at once
+    """
+    letters = rng.choice(ALPHABET, size=(count, length))
+    return np.frombuffer(letters.tobytes(), dtype=f"S{length}").astype(str)
+
+
+def fingerprint_strings(rng: np.random.Generator, count: int) -> list:
+    """
+    Generates count comma separated fingerprints of 2048 values in 0..1000
+    """
+    values = rng.integers(0, FINGERPRINT_MAX + 1,
+                          size=(count, FINGERPRINT_LENGTH), dtype=np.int16)
+    return [",".join(FINGERPRINT_TEXT[row]) for row in values]
+
+
+def generate_chunk(task: tuple) -> bytes:
+    """
+    Generates one chunk of rows as a gzip member. Gzip members can be
+    concatenated, so chunks made by different processes are simply appended.
+    :param task: (seed, file_index, chunk_index, rows, library_id)
+    """
+    seed, file_index, chunk_index, rows, library_id = task
+    rng = np.random.default_rng([seed, file_index, chunk_index])
+
+    ids = random_strings(rng, rows, 10)
+    sub_ids = [random_strings(rng, rows, 3) for _ in range(3)]
+    mw = rng.uniform(0, 100, rows)
+    logp = rng.uniform(0, 10, rows)
+    fingerprints = [fingerprint_strings(rng, rows) for _ in range(3)]
+    # FP4 and FP5 are only present for about half of the rows
+    for _ in range(2):
+        present = rng.random(rows) < 0.5
+        column = [""] * rows
+        generated = fingerprint_strings(rng, int(present.sum()))
+        for row, value in zip(np.flatnonzero(present), generated):
+            column[row] = value
+        fingerprints.append(column)
+
+    lines = [
+        "\t".join((ids[i], library_id, sub_ids[0][i], sub_ids[1][i], sub_ids[2][i],
+                   repr(float(mw[i])), repr(float(logp[i])),
+                   fingerprints[0][i], fingerprints[1][i], fingerprints[2][i],
+                   fingerprints[3][i], fingerprints[4][i]))
+        for i in range(rows)
+    ]
+    # Level 1 keeps compression from dominating the generation time; mtime=0
+    # keeps the output byte for byte reproducible for a given seed
+    return gzip.compress(("\n".join(lines) + "\n").encode("ascii"),
+                         compresslevel=1, mtime=0)
+
+
+class CreateSampleData:
+    """
+    Generates gzip TSV sample files with NumPy, in chunks written as they
+    are produced, across a process pool.
+
+    Each entry of sample_data maps a file name to a number of rows or to a
+    target file size such as 2GB. batch_size sets the uncompressed size of
+    the chunks, which bounds memory per worker. seed makes the output
+    reproducible and workers sets the size of the process pool.
+    """
 
-class CreateSampleData(ProcessData):
     def __init__(self, config_dict) -> None:
-        super().__init__(config_dict)
         self.config_dict = config_dict
-        self.data_folder = self.configure_from_dict("persistence_file_path")
+        self.data_folder = config_dict["persistence_file_path"]
         self.create_folder()
-        self.batch_size = self.configure_from_dict('batch_size')
-        self.sample_data = self.configure_from_dict("sample_data")
+        self.batch_size = parse_size(config_dict.get("batch_size") or "100MB")
+        self.sample_data = config_dict["sample_data"]
+        self.seed = config_dict.get("seed", 0)
+        self.workers = config_dict.get("workers") or os.cpu_count() or 1
         self.generate_tfv_file()
 
+    def create_folder(self):
+        os.makedirs(self.data_folder, exist_ok=True)
+
     def generate_tfv_file(self):
-        for file_name, nos_rows in self.sample_data.items():
-            print("FILE NAME", file_name)
-            data = self.generate_sample_data(nos_rows)
-            df = pd.DataFrame(data)
-            df.to_csv(f'{self.data_folder}/{file_name}',
-                      sep='\t', compression='gzip', index=False)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for file_index, (file_name, size) in enumerate(self.sample_data.items()):
+                start = time.perf_counter()
+                rows, written = self.write_file(
+                    executor, file_index, f'{self.data_folder}/{file_name}', size)
+                seconds = time.perf_counter() - start
+                logger.info("Wrote {file}: {rows} rows, {mb:.1f} MB in {seconds:.1f}s "
+                            "({rate:.1f} MB/s)", file=file_name, rows=rows,
+                            mb=written / 1024 ** 2, seconds=seconds,
+                            rate=written / 1024 ** 2 / seconds)
+
+    def chunk_rows(self) -> int:
+        # Rows average about 32 KB of text: three fingerprints always, two
+        # present half of the time
+        return max(1, self.batch_size // (32 * 1024))
+
+    def write_file(self, executor, file_index: int, path: str, size) -> tuple:
+        """
+        Writes one sample file. size is a row count (int) or a target file
+        size (string with a unit, e.g. 500MB). Returns (rows, bytes) written.
+        For a target size, each chunk is sized from the bytes still missing,
+        at the bytes per row of the chunks written so far, so the file ends
+        within a few rows of the target instead of up to a chunk past it.
+        """
+        target_rows = size if isinstance(size, int) else None
+        target_bytes = None if target_rows is not None else parse_size(size)
+        library_id = random_strings(
+            np.random.default_rng([self.seed, file_index]), 1, 4)[0]
+        chunk_rows = self.chunk_rows()
+
+        rows_written = rows_submitted = chunk_index = 0
+        with open(path, "wb") as file:
+            file.write(gzip.compress(
+                ("\t".join(COLUMNS) + "\n").encode("ascii"), mtime=0))
+            header_bytes = file.tell()
+            pending = deque()
+
+            def next_rows() -> int:
+                if target_rows is not None:
+                    return min(chunk_rows, target_rows - rows_submitted)
+                row_bytes = (file.tell() - header_bytes) / rows_written if rows_written \
+                    else ROW_BYTES_ESTIMATE
+                missing = target_bytes - file.tell() - (rows_submitted - rows_written) * row_bytes
+                return min(chunk_rows, math.ceil(missing / row_bytes))
+
+            while True:
+                # Keep at most two chunks per worker in flight to bound memory
+                while len(pending) < 2 * self.workers:
+                    rows = next_rows()
+                    if rows <= 0:
+                        break
+                    pending.append((rows, executor.submit(generate_chunk, (
+                        self.seed, file_index, chunk_index, rows, library_id))))
+                    chunk_index += 1
+                    rows_submitted += rows
+                if not pending:
+                    break
+                rows, future = pending.popleft()
+                file.write(future.result())
+                rows_written += rows
+            return rows_written, file.tell()
 
     def generate_random_string(self, length):
-        return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+        return random_strings(np.random.default_rng(), 1, length)[0]
 
     def generate_fingerprint(self):
-        # Generate a list of 2048 random numbers between 0 and 1000
-        fingerprint_values = [random.randint(0, 1000) for _ in range(2048)]
-
-        # Convert the list to a comma-separated string
-        fingerprint_string = ','.join(map(str, fingerprint_values))
-
-        return fingerprint_string
-
-    def generate_sample_data(self, num_rows):
-        lib_id = self.generate_random_string(4)
-        data = []
-        for _ in range(num_rows):
-            row = {
-                'ID': self.generate_random_string(10),
-                'Library_ID': lib_id,
-                'Sub_ID_1': self.generate_random_string(3),
-                'Sub_ID_2': self.generate_random_string(3),
-                'Sub_ID_3': self.generate_random_string(3),
-                'MW': random.uniform(0, 100),
-                'LogP': random.uniform(0, 10),
-                'FP1': self.generate_fingerprint(),
-                'FP2': self.generate_fingerprint(),
-                'FP3': self.generate_fingerprint(),
-                'FP3': self.generate_fingerprint(),
-                'FP4': self.generate_fingerprint() if random.choice([True, False]) else None,
-                'FP5': self.generate_fingerprint() if random.choice([True, False]) else None,
-            }
-            data.append(row)
-        return data
+        # Generate 2048 random numbers between 0 and 1000 as a comma-separated string
+        return fingerprint_strings(np.random.default_rng(), 1)[0]
 
 
 def load_yaml(yaml_file_path: str) -> dict:
@@ -1,254 +1,637 @@
-
-from source_connector import SourceConnector
-from pyspark.sql.utils import AnalysisException
+from source_connector import SourceConnector, parse_size
 from loguru import logger
 import yaml
-from pyspark.sql import SparkSession
-from pyspark.sql.types import StructType, StructField, StringType, FloatType
-from pyspark.sql.functions import col, when
-from pyspark.sql.functions import lit
-
-from google.cloud import storage
 
+import hashlib
 import os
+import shutil
+import sys
 
-from google.cloud import bigquery
-
-from google.oauth2 import service_account
-from google.cloud.exceptions import NotFound
+from arrow_engine import ArrowConversionEngine
+from bq_loader import BigQueryBulkLoader, open_loader
+from gzip_splitter import GzipSplitter
+from metrics import PipelineMetrics, input_size, parquet_output_stats
+from partition_plan import PartitionPlanner
+from parquet_layout import ParquetLayout, name_parts
+from validation import RowValidator, REASONS_COLUMN, SOURCE_COLUMN
+from fingerprint import FP_COLUMNS, BINARY_ENCODING, TEXT_ENCODING
+from log_config import configure_logging
 
-PATH = os.path.join(os.getcwd(), 'my-sile.json')
-os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = PATH
 
-
-log_file_path = os.getenv("LOG_FILE_PATH", "./logs/pipeline_error.log")
-processing_log_file_path = os.getenv(
-    "PROCESSING_LOG_FILE_PATH", "./logs/processing.log")
+def spark_errors() -> tuple:
+    """
+    Returns the Spark exceptions a file is skipped for. pyspark is imported
+    with the Spark path, and no AnalysisException can be raised before it is.
+    """
+    utils = sys.modules.get("pyspark.sql.utils")
+    return (utils.AnalysisException,) if utils is not None else ()
 
 
-ERROR_FORMAT = "{time} | {name} | {level} | {message}"
-INFO_FORMAT = "{time} | {name} | {level} | {message}"
+def output_name(filename: str) -> str:
+    """
+    Returns the name of the output folder for an input file
+    :param filename: the local or gs:// path of the input file
+    """
+    name = filename.rstrip("/").split("/")[-1]
+    for suffix in (".gz", ".tsv"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
 
-# Add a file handler for logging errors
-logger.add(log_file_path, level="ERROR", format=ERROR_FORMAT)
 
-# Add another file handler for logging processing information
-logger.add(processing_log_file_path, level="INFO", format=INFO_FORMAT)
+def batch_name(filenames: list) -> str:
+    """
+    Returns the name a batch of input files is tracked under; the same
+    files in the same order always get the same name
+    """
+    digest = hashlib.sha1("\n".join(filenames).encode("utf8")).hexdigest()
+    return f"batch-{digest[:16]}"
 
 
 class GetLoadData(SourceConnector):
 
-    def __init__(self, config_dict) -> None:
+    def __init__(self, config_dict, spark=None, loader=None, state=None,
+                 session_manager=None, local_index=None, similarity_index=None,
+                 metrics=None, deduplicator=None, source_version=None) -> None:
+        """
+        :param source_version: called with an input file, returns the version
+            being ingested (e.g. its generation), which keys its load jobs
+        """
         super().__init__(config_dict)
-        self.spark = self.initialize_spark()
+        self.config_dict = config_dict
+        # A session handed in by the caller, directly or via a session
+        # manager, is shared across files and must outlive this object;
+        # only a session built here is stopped here.
+        self.owns_spark = spark is None and session_manager is None
+        self.session_manager = session_manager
+        self._spark = spark
+        self.loader = loader
+        self.state = state
+        self.metrics = metrics or PipelineMetrics(config_dict)
+        self.lookup_service = None
+        self.local_index = local_index
+        self.index_enabled = self.prop(
+            "local_index_enabled", optional=True, default_value=False)
+        self.similarity_index = similarity_index
+        self.similarity_enabled = self.prop(
+            "similarity_index_enabled", optional=True, default_value=False)
+        self.fingerprint_encoding = self.prop(
+            "fingerprint_encoding", optional=True, default_value=TEXT_ENCODING)
+        self.load_mode = self.prop("load_mode", optional=True, default_value="load_job")
+        self.validator = RowValidator(config_dict)
+        self.quarantined_rows = 0
+        self.persisted: list = []
+        self.deduplicator = deduplicator
+        self.dedup_enabled = self.prop("dedup_enabled", optional=True, default_value=False)
+        self.duplicate_rows = 0
+        # The rows skip_duplicate_ids checked, counted once the output is written
+        self.dedup_input = None
+        self.source_version = source_version
         # self.download_file(file_name)
 
+    @property
+    def spark(self):
+        # Started on first use, so files converted by the arrow engine never
+        # start a JVM
+        if self._spark is None:
+            if self.session_manager is not None:
+                self._spark = self.session_manager.get_session()
+            else:
+                self._spark = self.initialize_spark()
+        return self._spark
+
     def initialize_spark(self):
         # Create a Spark session
-        spark = SparkSession.builder \
-            .appName("example") \
-            .config("spark.executor.memory", self.prop("executor_memory", 4)) \
-            .config("spark.executor.memoryOverhead", self.prop("executor_memoryOverhea", 2)) \
-            .config("spark.driver.memory", self.prop("driver_memory", 4)) \
-            .config("spark.jars", "https://storage.googleapis.com/hadoop-lib/gcs/gcs-connector-hadoop3-latest.jar")\
-            .getOrCreate()
-        logger.info(
-            "Spark Session created: {info}", info="Spark Session created")
-
-        # Get the Spark configuration
-        conf = spark.sparkContext.getConf()
-
-        # Retrieve the default executor memory
-        default_executor_memory = conf.get(
-            "spark.executor.memory", "Not specified")
-        print(f"Default Executor Memory: {default_executor_memory}")
-
-        # Retrieve the default driver memory
-        default_driver_memory = conf.get(
-            "spark.driver.memory", "Not specified")
-        print(f"Default Driver Memory: {default_driver_memory}")
-        return spark
-
-        # Stop the Spark session
+        from spark_session import SparkSessionManager
+        return SparkSessionManager(self.config_dict).build_session()
 
     def download_file(self, filename) -> None:
-        schema = StructType([
-            StructField("ID", StringType(), False),
-            StructField("Library_ID", StringType()),
-            StructField("Sub_ID_1", StringType()),
-            StructField("Sub_ID_2", StringType()),
-            StructField("Sub_ID_3", StringType()),
-            StructField("MW", FloatType()),
-            StructField("LogP", FloatType()),
-            StructField("FP1", StringType()),
-            StructField("FP2", StringType()),
-            StructField("FP3", StringType()),
-            StructField("FP4", StringType()),
-            StructField("FP5", StringType()),
-
-
-        ])
+        try:
+            with self.metrics.timer(filename, "file", bytes_in=input_size(filename)):
+                if self.streams_batches(filename):
+                    self.stream_file(filename)
+                else:
+                    parquet_file_path = self.convert_file(filename)
+                    self.load_output(parquet_file_path, filename, [filename],
+                                     source_version=self.version_of(filename))
+
+        except spark_errors() as e:
+            logger.error(f"An error occurred: {e}")
 
+        finally:
+            if self.owns_spark and self._spark is not None:
+                self._spark.stop()
+
+        return self.prop("output_dir")
+
+    def download_files(self, filenames: list) -> str:
+        """
+        Converts several small input files with one Spark job and loads
+        the consolidated output
+        :param filenames: the local or gs:// paths of the files
+        """
+        name = batch_name(filenames)
         try:
+            with self.metrics.timer(name, "file", files=len(filenames), bytes_in=sum(
+                    input_size(filename) or 0 for filename in filenames)):
+                parquet_file_path = self.convert_batch(filenames, name)
+                self.load_output(parquet_file_path, name, filenames, source_version="|".join(
+                    self.version_of(filename) or "" for filename in filenames))
+            if self.state is not None:
+                self.state.clear_checkpoints(name)
+
+        except spark_errors() as e:
+            logger.error(f"An error occurred: {e}")
 
-            output_dir = self.prop("output_dir")
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            df_zipped = self.spark.read.format("csv").option(
-                "delimiter", "\t").option("header", True).load(filename)
-            df_zipped = df_zipped.withColumn('MW',df_zipped['MW'].cast(FloatType()))
-            df_zipped = df_zipped.withColumn('LogP',df_zipped['LogP'].cast(FloatType()))
+        finally:
+            if self.owns_spark and self._spark is not None:
+                self._spark.stop()
 
-            # Check for missing columns and add them with None values
-            columns_to_add = (
-                set(schema.fieldNames()) - set(df_zipped.columns))
-            expected_schema = schema.fieldNames()
+        return self.prop("output_dir")
 
-            if columns_to_add:
-                for column in expected_schema:
-                        if column not in df_zipped.columns:
-                            df_zipped = df_zipped.withColumn(column, lit(None))
+    def convert_file(self, filename, source_file=None):
+        """
+        Converts an input file to Parquet and returns the path(s) to load
+        :param filename: the local or gs:// path of the file to convert
+        :param source_file: the name the file is tracked under in the state
+            store, when it differs from filename (e.g. a fetched local copy)
+        """
+        source_file = source_file or filename
+        output_dir = self.prop("output_dir")
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        parquet_file_path = self.checkpointed_output(source_file)
+        if parquet_file_path is not None:
+            return parquet_file_path
+
+        destination = os.path.join(output_dir, output_name(filename))
+        if self.select_engine(filename) == "arrow":
+            with self.metrics.timer(source_file, "arrow_convert",
+                                    bytes_in=input_size(filename)) as stage:
+                engine = self.arrow_engine()
+                parquet_file_path = engine.convert(
+                    filename, destination, self.quarantine_path(source_file), source_file)
+                stage.update(parquet_output_stats(parquet_file_path),
+                             quarantined_rows=engine.quarantined_rows,
+                             duplicate_rows=engine.duplicate_rows)
+        else:
+            with self.metrics.timer(source_file, "split") as stage:
+                read_path = GzipSplitter(self.config_dict).prepare(
+                    filename, output_name(filename))
+                if read_path != filename:
+                    stage.update(bytes_in=input_size(filename), bytes_out=input_size(read_path))
+            try:
+                parquet_file_path = self.spark_write(
+                    read_path, source_file, destination, bytes_in=input_size(read_path))
+            finally:
+                if read_path != filename:
+                    shutil.rmtree(read_path, ignore_errors=True)
+
+        self.finish_output(source_file, parquet_file_path)
+        return parquet_file_path
+
+    def convert_batch(self, filenames: list, batch_name: str):
+        """
+        Converts several input files with one multi-path Spark read and one
+        write, and returns the path(s) to load. Every row keeps the file it
+        was read from for validation and deduplication, so quarantined rows
+        name their own file and IDs are owned by the file they came from.
+        Spark maps the columns of every file by the header of the first, so
+        FileBatcher only batches files whose header lines match.
+        :param filenames: the local or gs:// paths of the files to convert
+        :param batch_name: the name the batch's output and checkpoints are kept under
+        """
+        output_dir = self.prop("output_dir")
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        parquet_file_path = self.checkpointed_output(batch_name)
+        if parquet_file_path is not None:
+            return parquet_file_path
+
+        parquet_file_path = self.spark_write(
+            filenames, batch_name, os.path.join(output_dir, batch_name),
+            bytes_in=sum(input_size(filename) or 0 for filename in filenames),
+            files=len(filenames))
+        self.finish_output(batch_name, parquet_file_path)
+        return parquet_file_path
+
+    def spark_write(self, read_path, source_file: str, destination: str, **fields):
+        """
+        Reads the input with read_input, writes it with the configured
+        write_mode and returns the output path(s). Spark reads lazily, so
+        the read is timed with the write.
+        :param read_path: the local or gs:// path(s) Spark reads
+        :param source_file: the name the output is tracked under
+        :param destination: the output folder
+        :param fields: bytes_in and other values recorded with the stage
+        """
+        write_mode = self.prop(
+            "write_mode", optional=True, default_value="driver")
+        try:
+            if write_mode != "distributed":
+                with self.metrics.timer(source_file, "driver_write", **fields) as stage:
+                    parquet_file_paths = self.write_partitions_on_driver(
+                        self.read_input(read_path, source_file), destination,
+                        input_path=read_path)
+                    stage.update(parquet_output_stats(parquet_file_paths),
+                                 quarantined_rows=self.quarantined_rows)
+                    stage["duplicate_rows"] = self.count_duplicates(source_file, stage["rows"])
+                return parquet_file_paths
+            with self.metrics.timer(source_file, "spark_convert", **fields) as stage:
+                parquet_file_path = self.write_distributed(
+                    self.read_input(read_path, source_file), destination,
+                    input_path=read_path)
+                stage.update(parquet_output_stats(parquet_file_path),
+                             quarantined_rows=self.quarantined_rows)
+                stage["duplicate_rows"] = self.count_duplicates(source_file, stage["rows"])
+            return parquet_file_path
+        finally:
+            for df in self.persisted:
+                df.unpersist()
+            self.persisted = []
 
-            df_repartitioned = df_zipped.repartition(10)
+    def finish_output(self, source_file: str, parquet_file_path: str) -> None:
+        """
+        Checkpoints a written output and adds it to the enabled indexes
+        """
+        self.record_output(source_file, parquet_file_path)
+        if self.index_enabled:
+            with self.metrics.timer(source_file, "local_index") as stage:
+                stage["rows"] = self.get_local_index().add_output(source_file, parquet_file_path)
+        if self.similarity_enabled:
+            with self.metrics.timer(source_file, "similarity_index") as stage:
+                stage["rows"] = self.get_similarity_index().add_output(
+                    source_file, parquet_file_path)
+
+    def streams_batches(self, filename) -> bool:
+        """
+        True when the file's record batches can go straight from the arrow
+        engine to the Storage Write API, without staging Parquet. Parquet is
+        still written when storage_write_stage_parquet is set or a local
+        index needs the outputs.
+        :param filename: the local or gs:// path of the file to convert
+        """
+        return self.load_mode == "storage_write" \
+            and not self.prop("storage_write_stage_parquet", optional=True, default_value=False) \
+            and not (self.index_enabled or self.similarity_enabled) \
+            and self.select_engine(filename) == "arrow"
 
-            for partition_id, partition_df in enumerate(df_repartitioned.rdd.glom().toLocalIterator(), 1):
+    def stream_file(self, filename, source_file=None) -> int:
+        """
+        Streams the converted record batches of a file into BigQuery and
+        returns the number of rows written
+        :param filename: the local path of the file to convert
+        :param source_file: the name the file is tracked under in the state store
+        """
+        source_file = source_file or filename
+        with self.metrics.timer(source_file, "arrow_stream",
+                                bytes_in=input_size(filename)) as stage:
+            engine = self.arrow_engine()
+            stage["rows"] = self.get_loader().load_batches(
+                engine.iter_batches(filename, self.quarantine_path(source_file), source_file),
+                source_file=source_file, state=self.state)
+            stage.update(quarantined_rows=engine.quarantined_rows,
+                         duplicate_rows=engine.duplicate_rows)
+        return stage["rows"]
+
+    def arrow_engine(self) -> ArrowConversionEngine:
+        return ArrowConversionEngine(
+            self.config_dict, deduplicator=self.get_deduplicator() if self.dedup_enabled else None)
+
+    def select_engine(self, filename) -> str:
+        """
+        Picks the arrow engine for local files up to arrow_engine_max_bytes,
+        where starting Spark would cost more than the conversion itself
+        :param filename: the local or gs:// path of the file to convert
+        """
+        max_bytes = parse_size(self.prop(
+            "arrow_engine_max_bytes", optional=True, default_value=0))
+        if max_bytes and not filename.startswith("gs://") \
+                and os.path.getsize(filename) <= max_bytes:
+            return "arrow"
+        return "spark"
+
+    def checkpointed_output(self, filename):
+        """
+        Returns the Parquet output already written for this file by an
+        earlier, interrupted run, or None if it has to be written again
+        :param filename: the input file
+        """
+        if self.state is None:
+            return None
+        parquet_file_path = self.state.checkpoints(filename, "output").get("parquet")
+        if parquet_file_path and os.path.exists(os.path.join(parquet_file_path, "_SUCCESS")):
+            logger.info("Reusing Parquet output {path} for {file}",
+                        path=parquet_file_path, file=filename)
+            return parquet_file_path
+        return None
+
+    def record_output(self, filename, parquet_file_path: str) -> None:
+        if self.state is not None:
+            self.state.record_checkpoint(
+                filename, "output", "parquet", parquet_file_path)
+
+    def read_input(self, filename, source_file=None):
+        """
+        Reads a tab separated input file and conforms it to SCHEMA. With
+        validation enabled, invalid rows are quarantined first and only the
+        valid ones are returned.
+        :param filename: the local or gs:// path of the file to read, or a
+            list of paths read together
+        :param source_file: the name the file is tracked under in the state store
+        """
+        from pyspark.sql.functions import lit
+        from pyspark.sql.types import FloatType, StringType
+        from spark_columns import SCHEMA, source_file_column
 
-                # Convert the list of Rows to a DataFrame
-                partition_df = self.spark.createDataFrame(
-                    partition_df, schema=schema)
+        df_zipped = self.spark.read.format("csv").option(
+            "delimiter", "\t").option("header", True).load(filename)
+        if isinstance(filename, list):
+            df_zipped = df_zipped.withColumn(SOURCE_COLUMN, source_file_column(filename))
 
-                new_folder = f"test_{partition_id}"
+        # Check for missing columns and add them with None values
+        columns_to_add = (
+            set(SCHEMA.fieldNames()) - set(df_zipped.columns))
+        expected_schema = SCHEMA.fieldNames()
 
-                # Write the partition DataFrame to a Parquet file
-                parquet_file_path = os.path.join(
-                    output_dir, new_folder, f"partition_{partition_id}.parquet")
-                partition_df.write.parquet(parquet_file_path)
-                # self.another_function(parquet_file_path)
-                self.insert_data_intobq(parquet_file_path)
+        if columns_to_add:
+            for column in expected_schema:
+                    if column not in df_zipped.columns:
+                        df_zipped = df_zipped.withColumn(column, lit(None).cast(StringType()))
 
-        except AnalysisException as e:
-            logger.error(f"An error occurred: {e}")
+        if self.validator.enabled:
+            df_zipped = self.quarantine_invalid(df_zipped, source_file or filename)
+        if self.dedup_enabled:
+            df_zipped = self.skip_duplicate_ids(df_zipped, source_file or filename)
 
-        finally:
-            self.spark.stop()
+        df_zipped = df_zipped.withColumn('MW',df_zipped['MW'].cast(FloatType()))
+        df_zipped = df_zipped.withColumn('LogP',df_zipped['LogP'].cast(FloatType()))
+        if SOURCE_COLUMN in df_zipped.columns:
+            df_zipped = df_zipped.drop(SOURCE_COLUMN)
+
+        return df_zipped
+
+    def quarantine_path(self, source_file: str) -> str:
+        return self.validator.quarantine_path(output_name(source_file))
+
+    def quarantine_invalid(self, df_raw, source_file: str):
+        """
+        Writes the rows that fail validation, as read plus the reasons and
+        the source file, to the quarantine folder of the file and returns
+        the valid rows. The checked rows are persisted so the input is
+        only parsed once for both outputs.
+        :param df_raw: the input with every column as a string, and the
+            source file of every row when several files are read together
+        :param source_file: the name the file or batch is tracked under
+        """
+        from pyspark import StorageLevel
+        from pyspark.sql.functions import col, lit
+        from spark_columns import validation_reasons
+
+        df_checked = df_raw.withColumn(
+            REASONS_COLUMN, validation_reasons(self.validator.required_columns)
+        ).persist(StorageLevel.MEMORY_AND_DISK)
+        self.persisted.append(df_checked)
+
+        quarantine_path = self.quarantine_path(source_file)
+        df_rejected = df_checked.filter(col(REASONS_COLUMN) != "")
+        if SOURCE_COLUMN not in df_rejected.columns:
+            df_rejected = df_rejected.withColumn(SOURCE_COLUMN, lit(source_file))
+        df_rejected.coalesce(1).write.mode("overwrite").parquet(quarantine_path)
+        self.quarantined_rows = parquet_output_stats(quarantine_path)["rows"]
+        if self.quarantined_rows:
+            logger.warning("Quarantined {rows} invalid rows of {file} to {path}",
+                           rows=self.quarantined_rows, file=source_file, path=quarantine_path)
+        else:
+            shutil.rmtree(quarantine_path, ignore_errors=True)
+        return df_checked.filter(col(REASONS_COLUMN) == "").drop(REASONS_COLUMN)
+
+    def skip_duplicate_ids(self, df, source_file: str):
+        """
+        Returns the rows whose ID was not ingested from another file. Every
+        partition is checked where it is computed, with mapInPandas and an
+        IdDeduplicator opened once per Python worker on dedup_dir, so no
+        IDs are collected on the driver and nothing is broadcast. The
+        workers share dedup_dir through the local filesystem, so Spark has
+        to run on one host (check_single_host). When several files are read
+        together, every row is checked against the file it was read from.
+        The rows checked are persisted, so count_duplicates can count them
+        after the write without parsing the input again.
+        :param df: the input rows
+        :param source_file: the name the file or batch is tracked under
+        """
+        from pyspark import StorageLevel
+        from id_dedup import check_single_host, drop_duplicate_frames
+
+        check_single_host(self.spark.sparkContext.master)
+        # Creates dedup_dir and the filter before the workers open them
+        self.get_deduplicator()
+        config_dict = self.config_dict
+        source_column = SOURCE_COLUMN if SOURCE_COLUMN in df.columns else None
+        if not self.validator.enabled:
+            # With validation the rows already come from a persisted frame
+            df = df.persist(StorageLevel.MEMORY_AND_DISK)
+            self.persisted.append(df)
+        self.dedup_input = df
+
+        def drop_duplicates(frames):
+            return drop_duplicate_frames(frames, config_dict, source_file,
+                                         source_column=source_column)
+
+        return df.mapInPandas(drop_duplicates, schema=df.schema)
+
+    def count_duplicates(self, source_file: str, rows_out: int) -> int:
+        """
+        Returns the rows skipped by skip_duplicate_ids, as the rows it
+        checked less the rows in the written output, and logs them. Unlike
+        a counter updated by the tasks, this is exact when tasks are retried.
+        :param source_file: the name the file or batch is tracked under
+        :param rows_out: the rows in the written output
+        """
+        if self.dedup_input is not None:
+            self.duplicate_rows = self.dedup_input.count() - rows_out
+            self.dedup_input = None
+            self.get_deduplicator().report(source_file, self.duplicate_rows)
+        return self.duplicate_rows
+
+    def encode_fingerprints(self, df_conformed):
+        """
+        Packs FP1-FP5 as binary uint16 arrays when fingerprint_encoding is binary
+        :param df_conformed: a DataFrame with the columns of SCHEMA
+        """
+        if self.fingerprint_encoding != BINARY_ENCODING:
+            return df_conformed
+        from pyspark.sql.functions import col
+        from spark_columns import encode_fingerprint_column
+
+        for column in FP_COLUMNS:
+            df_conformed = df_conformed.withColumn(
+                column, encode_fingerprint_column(col(column)))
+        return df_conformed
+
+    def write_distributed(self, df_zipped, parquet_file_path: str, input_path: str = None) -> str:
+        """
+        Writes the whole DataFrame with a single distributed write.parquet,
+        so rows go straight from the executors to disk without passing
+        through the driver.
+        :param df_zipped: the DataFrame returned by read_input
+        :param parquet_file_path: the folder the Parquet output is written to
+        :param input_path: the path df_zipped was read from, used to size
+            the output partitions
+        """
+        from pyspark.sql.functions import col
+        from spark_columns import SCHEMA
+
+        partition_columns = self.prop(
+            "write_partition_columns", optional=True, default_value=[])
+
+        df_conformed = self.encode_fingerprints(df_zipped.select(
+            [col(field.name).cast(field.dataType) for field in SCHEMA.fields]))
+        plan = self.plan_partitions(df_conformed, input_path or parquet_file_path,
+                                    partition_columns)
+        df_repartitioned = PartitionPlanner.apply(df_conformed, plan, partition_columns)
+        # Sorted files give every row group a narrow ID range, for the
+        # local index and for the table's clustering on ID
+        layout = ParquetLayout(self.config_dict)
+        layout.spark_writer(df_repartitioned).mode("overwrite").parquet(parquet_file_path)
+        name_parts(parquet_file_path)
+        logger.info("Wrote {partitions} partitions to {path} ({layout})",
+                    partitions=plan["partitions"], path=parquet_file_path,
+                    layout=layout.describe())
+        return parquet_file_path
+
+    def plan_partitions(self, df, input_path: str, partition_columns: list = None) -> dict:
+        """
+        Returns the PartitionPlanner plan for a DataFrame read from input_path
+        """
+        return PartitionPlanner(self.config_dict).plan(
+            input_path, df.rdd.getNumPartitions(), spark=self.spark,
+            partition_columns=partition_columns)
+
+    def write_partitions_on_driver(self, df_zipped, output_dir: str, input_path: str = None) -> str:
+        """
+        Collects each partition on the driver and writes it on its own, to
+        output_dir/partition_<n>. Whatever an interrupted attempt left in
+        output_dir is replaced and the part files get deterministic names,
+        so a retried file writes the same files and its load jobs keep their
+        ids. Returns output_dir, marked with _SUCCESS once every partition
+        is written.
+        :param df_zipped: the DataFrame returned by read_input
+        :param output_dir: the folder the partition folders are created in
+        :param input_path: the path df_zipped was read from, used to size
+            the output partitions
+        """
+        from spark_columns import SCHEMA
+
+        plan = self.plan_partitions(df_zipped, input_path or output_dir)
+        df_repartitioned = PartitionPlanner.apply(df_zipped, plan)
+        layout = ParquetLayout(self.config_dict)
+        # Only an unfinished output is written again, see checkpointed_output
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+        for partition_id, partition_df in enumerate(df_repartitioned.rdd.glom().toLocalIterator(), 1):
+
+            # Convert the list of Rows to a DataFrame
+            partition_df = self.encode_fingerprints(self.spark.createDataFrame(
+                partition_df, schema=SCHEMA))
 
+            # Write the partition DataFrame to a Parquet folder
+            parquet_file_path = os.path.join(output_dir, f"partition_{partition_id:05d}")
+            layout.spark_writer(partition_df).mode("overwrite").parquet(parquet_file_path)
+            name_parts(parquet_file_path, f"part-{partition_id:05d}")
+
+        os.makedirs(output_dir, exist_ok=True)
+        open(os.path.join(output_dir, "_SUCCESS"), "w", encoding="utf8").close()
         return output_dir
 
-    # function to show the sample records
-
-    # def another_function(self, parquet_file_path):
-    #     """
-    #     Another function to process the Parquet file.
-
-    #     Parameters:
-    #         - parquet_file_path: Path to the Parquet file
-    #     """
-    #     # Add your logic to process the Parquet file in another function
-    #     print(f"Processing Parquet file: {parquet_file_path}")
-    #     df_parquet = self.spark.read.parquet(parquet_file_path)
-    #     print(df_parquet.select("ID", "Library_ID", "Sub_ID_3").show(4))
-
-    def insert_data_intobq(self, parquet_file_path):
-        storage_client = storage.Client(PATH)
-
-        key_path = self.prop("key_path")
-        project_id = self.prop("project_id")
-        dataset_id = self.prop("dataset_id")
-        table = self.prop("bq_table_name")
-        # table = "wikidata"
-        table_id = "{}.{}.{}".format(project_id, dataset_id, table)
-        print("********* NAME OF TABLE IS", table_id)
-
-        credentials = service_account.Credentials.from_service_account_file(
-            key_path, scopes=[
-                "https://www.googleapis.com/auth/cloud-platform"],
-        )
-        client = bigquery.Client(credentials=credentials,
-                                 project=project_id)
-        table_schema = [
-            bigquery.SchemaField("ID", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("Library_ID", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("Sub_ID_1", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("Sub_ID_2", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("Sub_ID_3", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("MW", "FLOAT64", mode="REQUIRED"),
-            bigquery.SchemaField("LogP", "FLOAT64", mode="REQUIRED"),
-            bigquery.SchemaField("FP1", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("FP2", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("FP3", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("FP4", "STRING", mode="NULLABLE"),
-            bigquery.SchemaField("FP5", "STRING", mode="NULLABLE"),
-
-        ]
-        clustering_fields = 'ID'
-        partitioning_field = 'Library_ID'
-
-        table = bigquery.Table(table_id, schema=table_schema)
+    def get_loader(self) -> BigQueryBulkLoader:
+        if self.loader is None:
+            self.loader = open_loader(self.config_dict, self.load_mode, metrics=self.metrics)
+        return self.loader
+
+    def version_of(self, filename):
+        return self.source_version(filename) if self.source_version is not None else None
+
+    def load_output(self, parquet_file_path, source_file: str, filenames: list,
+                    source_version=None):
+        """
+        Loads a converted output. If the load fails, the output checkpoint
+        and the IDs its files claimed are given up, so a retry converts them
+        again instead of loading rows that other files may claim meanwhile.
+        :param parquet_file_path: the output of the file or batch
+        :param source_file: the name the file or batch is tracked under
+        :param filenames: the input files of the output
+        :param source_version: the version of the input, part of the load job ids
+        """
         try:
-            existing_table = client.get_table(table)
-            print(f'Table {table_id, existing_table.schema} already exists.')
-
-        except NotFound:
-            table = bigquery.Table(table_id, schema=table_schema)
-            table.library_partitioning = partitioning_field
-            table.clustering_fields = clustering_fields
-            table = client.create_table(table)
-            print(
-                "Created clustered table {}.{}.{}".format(
-                    table.project, table.dataset_id, table.table_id
-                )
-            )
-
-        for root, dirs, files in os.walk(parquet_file_path):
-            for file in files:
-                if file.endswith(".parquet"):
-                    parquet_file_path = os.path.join(root, file)
-
-                    # Load the Parquet partition directly into the table
-                    job_config = bigquery.LoadJobConfig()
-                    job_config.source_format = bigquery.SourceFormat.PARQUET
-                    try:
-
-                        with open(parquet_file_path, 'rb') as source_file:
-                            job = client.load_table_from_file(
-                                source_file, table, job_config=job_config)
-
-                        # Wait for the job to complete
-                        job.result()
-
-                        # Print the number of rows inserted
-                        print(
-                            f'Loaded {job.output_rows} rows from {parquet_file_path} into {table_id}.')
-                    except Exception as e:
-                        logger.error(f"An error occurred: {e}")
-
-    def query_data_by_id(self):
-        project_id = self.prop("project_id")
-        dataset_id = self.prop("dataset_id")
-        table = self.prop("bq_table_name")
-        target_id = self.prop("target_id")
-        table_id = "{}.{}.{}".format(project_id, dataset_id, table)
-        table_ref = f"{project_id}.{dataset_id}.{table_id}"
-
-        client = bigquery.Client()
-
-        query = f"""
-            SELECT *
-            FROM `{table_ref}`
-            WHERE ID = '{target_id}'
+            return self.insert_data_intobq(parquet_file_path, source_file=source_file,
+                                           source_version=source_version)
+        except Exception:
+            if self.state is not None:
+                self.state.record_checkpoint(source_file, "output", "parquet", "")
+            if self.dedup_enabled:
+                for filename in filenames:
+                    self.get_deduplicator().release(filename)
+            raise
+
+    def insert_data_intobq(self, parquet_file_path, source_file=None, source_version=None):
         """
+        Loads every Parquet file under the given path(s) into the BigQuery
+        table, batching them into as few load jobs as possible
+        :param parquet_file_path: a path or a list of paths to Parquet files or folders
+        :param source_file: the input file, used to skip load jobs that already succeeded
+        :param source_version: the version of the input, part of the load job ids
+        """
+        with self.metrics.timer(source_file or str(parquet_file_path), "load") as stage:
+            stage["bytes_in"] = parquet_output_stats(parquet_file_path)["bytes_out"]
+            stage["rows"] = self.get_loader().load(
+                parquet_file_path, source_file=source_file, state=self.state,
+                source_version=source_version)
+        return stage["rows"]
+
+    def get_local_index(self):
+        if self.local_index is None:
+            from parquet_index import LocalIdIndex
+            self.local_index = LocalIdIndex(self.config_dict)
+        return self.local_index
+
+    def get_deduplicator(self):
+        if self.deduplicator is None:
+            from id_dedup import IdDeduplicator
+            self.deduplicator = IdDeduplicator(self.config_dict)
+        return self.deduplicator
+
+    def get_similarity_index(self):
+        if self.similarity_index is None:
+            from similarity import FingerprintIndex
+            self.similarity_index = FingerprintIndex(self.config_dict)
+        return self.similarity_index
+
+    def get_lookup_service(self):
+        if self.lookup_service is None:
+            from id_lookup import IdLookupService
+            self.lookup_service = IdLookupService(self.config_dict)
+        return self.lookup_service
+
+    def query_data_by_id(self, target_ids=None, columns=None):
+        """
+        Looks up rows by ID through the batched, cached IdLookupService
+        :param target_ids: an ID or a list of IDs, defaults to target_id from the config
+        :param columns: the columns to return, defaults to all columns
+        """
+        if target_ids is None:
+            target_ids = self.prop("target_id")
+        if isinstance(target_ids, str):
+            target_ids = [target_ids]
 
         try:
-            query_job = client.query(query)
-
-            # Wait for the query to complete
-            results = query_job.result()
+            results = self.get_lookup_service().lookup(target_ids, columns)
 
-            # Iterate over the results and print or process them as needed
-            for row in results:
-                print(row)
+            for target_id, row in results.items():
+                logger.info("{target_id}: {row}", target_id=target_id, row=row)
 
-            # Return the results (you can modify this based on your use case)
             return results
 
         except Exception as e:
@@ -276,6 +659,7 @@ def load_yaml(yaml_file_path: str) -> dict:
 
 if __name__ == "__main__":
 
+    configure_logging()
     CONFIG_FILE_PATH = "./configs/gcp_config.yaml"
     config_dict = load_yaml(CONFIG_FILE_PATH)
     connector = GetLoadData(config_dict)
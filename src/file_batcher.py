@@ -0,0 +1,100 @@
+"""
+Groups small input files into batches that are converted with one
+multi-path Spark read
+"""
+import gzip
+import zlib
+
+from loguru import logger
+
+from source_connector import SourceConnector, parse_size
+
+# Enough of a gs:// object to hold the compressed header line
+HEADER_READ_BYTES = 64 * 1024
+
+
+def read_header(filename: str, storage_client=None):
+    """
+    Returns the header line of a TSV input, plain or gzip, or None if it
+    cannot be read
+    :param filename: the local or gs:// path of the input file
+    :param storage_client: used to read the start of gs:// objects
+    """
+    try:
+        if filename.startswith("gs://"):
+            bucket_name, blob_name = filename[len("gs://"):].split("/", 1)
+            data = storage_client.bucket(bucket_name).blob(blob_name).download_as_bytes(
+                start=0, end=HEADER_READ_BYTES - 1)
+            if filename.endswith(".gz"):
+                data = zlib.decompressobj(wbits=31).decompress(data)
+            if b"\n" not in data:
+                return None
+            line = data.split(b"\n", 1)[0]
+        else:
+            opener = gzip.open if filename.endswith(".gz") else open
+            with opener(filename, "rb") as file:
+                line = file.readline()
+        return line.decode("utf8").rstrip("\r\n")
+    except (OSError, EOFError, UnicodeDecodeError, zlib.error) as e:
+        logger.warning("Could not read the header of {file}: {error}", file=filename, error=e)
+        return None
+
+
+class FileBatcher(SourceConnector):
+    """
+    Batches hold at most batch_max_files files and batch_max_bytes input
+    bytes. Spark maps the columns of every file of a multi-path read by
+    position, using the header of the first file, so only files with the
+    same header line are batched together. Files whose size or header is
+    unknown, files of batch_max_bytes or more and files that single()
+    selects are yielded on their own.
+    """
+
+    def __init__(self, config_dict: dict, size=None, single=None, storage_client=None):
+        """
+        :param config_dict: the connector config
+        :param size: called with a path, returns its size in bytes or None
+        :param single: called with a path, returns True for files that
+            are converted on their own, e.g. by the arrow engine
+        :param storage_client: used to read the headers of gs:// objects
+        """
+        super().__init__(config_dict)
+        self.max_files = self.prop("batch_max_files", optional=True, default_value=1)
+        self.max_bytes = parse_size(self.prop(
+            "batch_max_bytes", optional=True, default_value="256MB"))
+        self.size = size
+        self.single = single
+        self.storage_client = storage_client
+
+    def batches(self, paths):
+        """
+        Yields lists of paths; files are kept in order within a batch
+        :param paths: the files to ingest
+        """
+        # One open batch per distinct header: [files, bytes]
+        open_batches: dict = {}
+        for path in paths:
+            if self.max_files <= 1:
+                yield [path]
+                continue
+            file_bytes = self.size(path) if self.size is not None else None
+            if file_bytes is None or file_bytes >= self.max_bytes \
+                    or (self.single is not None and self.single(path)):
+                yield [path]
+                continue
+            header = read_header(path, self.storage_client)
+            if header is None:
+                yield [path]
+                continue
+
+            batch = open_batches.get(header)
+            if batch is not None and (len(batch[0]) >= self.max_files
+                                      or batch[1] + file_bytes > self.max_bytes):
+                yield batch[0]
+                batch = None
+            if batch is None:
+                batch = open_batches[header] = [[], 0]
+            batch[0].append(path)
+            batch[1] += file_bytes
+        for files, _ in open_batches.values():
+            yield files
@@ -2,58 +2,69 @@
 Iterates over files downloaded from a google cloud bucket based on a
 given config.
 """
+import argparse
+import contextlib
+import itertools
 import os
 import re
+import signal
 from pathlib import Path
 import glob
 from loguru import logger
 import shutil
-from google.cloud import storage
 
-
-import ijson
 import yaml
 
 from source_connector import SourceConnector
+from state_store import open_state_store
 
-from data_process_ingest import GetLoadData
-log_file_path = os.getenv("LOG_FILE_PATH", "./logs/pipeline_error.log")
-processing_log_file_path = os.getenv(
-    "PROCESSING_LOG_FILE_PATH", "./logs/processing.log")
-
-
-ERROR_FORMAT = "{time} | {name} | {level} | {message}"
-INFO_FORMAT = "{time} | {name} | {level} | {message}"
-
-# Add a file handler for logging errors
-logger.add(log_file_path, level="ERROR", format=ERROR_FORMAT)
-
-# Add another file handler for logging processing information
-logger.add(processing_log_file_path, level="INFO", format=INFO_FORMAT)
+from bq_loader import BigQueryBulkLoader, LoadJobError, open_loader
+from bucket_listing import BucketListing
+from metrics import PipelineMetrics, input_size
+from file_batcher import FileBatcher
+from watcher import FileWatcher, file_signature
+from log_config import configure_logging
 
 
 class GCPConnector(SourceConnector):
     """
-    An iterator designed to find and download files from a gcp bucket
+    An iterator designed to find and download files from a gcp bucket.
+    Storage and BigQuery clients can be passed in, e.g. local stand-ins for
+    benchmarks; otherwise they are built from key_path.
     """
 
-    def __init__(self, config_dict: dict):
+    def __init__(self, config_dict: dict, storage_client=None, bigquery_client=None):
         super().__init__(config_dict)
         self.config_dict = config_dict
 
-        self.persistent_data: dict = {}
+        self.state = None
+        self.metrics = PipelineMetrics(config_dict)
+        self.loader = None
+        self.listing = None
+        self.local_index = None
+        self.similarity_index = None
+        self.deduplicator = None
+        # Set while watching, so every batch reuses the same SparkSession
+        self.session_manager = None
+        self.bigquery_client = bigquery_client
+        # An injected storage client also serves the loader's staging bucket
+        self.staging_client = storage_client
 
         self.download_file_paths: list = []
         self.total_files_downloaded = 0
         self.total_files_processed = 0
         self.current_file = None
         self.current_index = 0
+        # The version of each file being ingested, see source_version
+        self.versions: dict = {}
         self.total_object_count = 0
 
-        PATH = os.path.join(os.getcwd(), self.prop("key_path"))
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = PATH
-
-        self.storage_client = storage.Client(PATH)
+        if storage_client is None:
+            from google.cloud import storage
+            PATH = os.path.join(os.getcwd(), self.prop("key_path"))
+            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = PATH
+            storage_client = storage.Client(PATH)
+        self.storage_client = storage_client
 
         bucket_name = self.prop("bucket_name")
 
@@ -76,48 +87,39 @@ class GCPConnector(SourceConnector):
         """
         Create the persistent data structure for the connector to use
         """
-
-        persistence_file = self.prop("persistence_file_path")
-
-        file_path = Path(persistence_file)
-        os.makedirs(file_path.parent, exist_ok=True)
-        file_path.touch(exist_ok=True)
-
-        with open(persistence_file, "r", encoding="utf8") as file:
-            self.persistent_data = yaml.safe_load(file)
-            if self.persistent_data is None:
-                self.persistent_data = {}
-
-    def update_persistent_data(self):
-        """
-        Saves the current contents of the persistent_data
-        dictionary to the specified file in the config
-        """
-        file_path = self.prop("persistence_file_path")
-        with open(file_path, "w", encoding="utf8") as file:
-            yaml.safe_dump(self.persistent_data, file)
+        self.state = open_state_store(
+            self.prop("state_backend", optional=True, default_value="yaml"),
+            self.prop("state_path", optional=True,
+                      default_value="./process_data/state.sqlite"),
+            self.prop("persistence_file_path"))
 
     def find_gcp_files(self) -> None:
         """
-        Searches the GCP bucket/ Local file for any files that match the search parameters
+        Searches the GCP bucket/ Local file for any files that match the search parameters.
+        The bucket is listed lazily, page by page, as download_file_paths is consumed.
         """
         search_folder = self.prop("search_folder")
-        blob_list = glob.glob(os.path.join(search_folder, '*.gz'))
-        if search_folder.lower() == "gcp":
-            blob_list = self.get_file_from_bucket()
-
-        file_extension = self.prop("file_extension")
+        file_extension = self.prop("file_extension", optional=True, default_value=".gz")
         download_file_list = self.prop("download_file_list", optional=True)
 
-        logger.info(
-            "Files are extracted from Bucket: {info}", info="Files are extracted from Bucket")
-
         if download_file_list is not None:
             for file_name in download_file_list:
                 self.download_file_paths.append(file_name)
 
-        self.find_all_files(blob_list)
-
+        if search_folder.lower() == "gcp":
+            logger.info("Files are listed from bucket {bucket}",
+                        bucket=self.prop("bucket_name"))
+            self.total_files_downloaded = len(self.download_file_paths)
+            self.download_file_paths = itertools.chain(
+                self.download_file_paths, self.get_file_from_bucket())
+            return
+
+        found = sorted(glob.glob(os.path.join(search_folder, f"*{file_extension}")))
+        if not found:
+            logger.warning("No {extension} files found in {folder}; file_extension must "
+                           "match the full suffix of the input files",
+                           extension=file_extension, folder=search_folder)
+        self.find_all_files(found)
         self.total_files_downloaded = len(self.download_file_paths)
 
     def find_all_files(self, blob_list):
@@ -132,56 +134,43 @@ class GCPConnector(SourceConnector):
             gcp_path = blob
             self.download_file_paths.append(gcp_path)
 
-    def get_file_from_bucket(self) -> str:
+    def get_file_from_bucket(self):
         """
-        Download a bucket path from the gcp
-        :param file_name: The name of the file to be downloaded.
+        Yields the gs:// paths of the new and changed bucket objects that
+        match bucket_prefix and file_extension (see BucketListing)
         """
+        skip_ingested = bool(self.prop("ignore_duplicates", optional=True))
+        for gcp_path in self.get_listing().list_files(skip_ingested):
+            self.total_files_downloaded += 1
+            yield gcp_path
 
-        pass
-
-        output_dir = self.prop("output_dir")
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        bucket_name = self.prop("bucket_name")
-
-        client = storage.Client()
-
-        # Get the bucket and list all blobs
-        bucket = client.get_bucket(bucket_name)
-        blobs = bucket.list_blobs()
-        gcs_url = f"gs://{bucket_name}"
-        dfs = []
-        for blob in blobs:
-            # Extract file name from blob name
-            file_name = blob.name.split('/')[-1]
-
-            # Skip non-TSV files
-            if not file_name.endswith('.gz'):
-                continue
-
-            file_url = f"{gcs_url}/{file_name}"
-            dfs.append(file_url)
-
-        return dfs
+    def get_listing(self) -> BucketListing:
+        if self.listing is None:
+            self.listing = BucketListing(self.config_dict, self.storage_client)
+        return self.listing
 
     def is_file_duplicate(self, file_name: str) -> bool:
         """
-        Detect wheather a file has been downloaded and ingested before
+        Detect wheather a file has been downloaded and ingested before.
+        A bucket object overwritten since it was ingested is not a duplicate,
+        and neither is a local file whose size or modification time changed
+        since it was ingested.
         :param file_name: the name of the file to be checked
         """
-        result = False
-
-        if "download_file_list" in self.persistent_data and self.persistent_data.get(
-                "download_file_list", None):
-            print("TYPE of PERSISTENT", type(self.persistent_data))
-            result = file_name in self.persistent_data.get(
-                "download_file_list")
-            print("TYPE of PERSISTENTsdfsdfsf", result)
-        else:
-            self.persistent_data["download_file_list"] = []
-
-        return result
+        if self.listing is not None and file_name.startswith("gs://"):
+            if self.listing.is_changed(file_name):
+                return False
+            if self.state.is_processed(file_name):
+                # Lets later listings skip the object without asking the state
+                self.listing.mark_ingested(file_name)
+                return True
+            return False
+        if not self.state.is_processed(file_name):
+            return False
+        # Files ingested before signatures were recorded have none
+        ingested = self.state.checkpoints(file_name, "ingested").get("signature")
+        current = file_signature(file_name)
+        return ingested is None or current is None or ingested == current
 
     def delete_file(self, file_path: str) -> None:
         """
@@ -190,61 +179,256 @@ class GCPConnector(SourceConnector):
         """
 
         try:
-            shutil.rmtree(file_path)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+            else:
+                shutil.rmtree(file_path)
             print(
                 f'The folder {file_path} and its contents have been successfully removed.')
         except OSError as e:
             print(f'Error: {e}')
 
-    def update_persistent_data(self):
+    def item_generator(self, download_file_paths=None):
         """
-        Saves the current contents of the persistent_data
-        dictionary to the specified file in the config
+        A generator function for returning the items found by the connector one at a time.
+        Returns the files that were not marked as processed because their
+        load jobs failed.
+        :param download_file_paths: the files to ingest, defaults to the
+            files found by the connector
         """
-        file_path = self.prop("persistence_file_path")
-        with open(file_path, "w", encoding="utf8") as file:
-            yaml.safe_dump(self.persistent_data, file)
+        if download_file_paths is None:
+            download_file_paths = self.download_file_paths
 
-    def item_generator(self):
-        """
-        A generator function for returning the items found by the connector one at a time
-        """
-        ignore_duplicates = self.prop("ignore_duplicates")
+        if self.prop("ingest_mode", optional=True, default_value="sequential") == "pipelined":
+            from pipeline import IngestPipeline
+            IngestPipeline(self).run(download_file_paths)
+            self.metrics.summary()
+            return self.unfinished(download_file_paths)
 
-        for gcp_path in self.download_file_paths:
+        import ijson
+        from data_process_ingest import GetLoadData
 
-            if self.is_file_duplicate(gcp_path) and ignore_duplicates:
+        ignore_duplicates = self.prop("ignore_duplicates")
 
-                continue
+        loader = self.get_loader()
+        local_index, similarity_index = self.get_indexes()
+
+        with self.spark_sessions() as session_manager:
+            def load_data():
+                return GetLoadData(
+                    self.config_dict, session_manager=session_manager,
+                    loader=loader, state=self.state, local_index=local_index,
+                    similarity_index=similarity_index, metrics=self.metrics,
+                    deduplicator=self.get_deduplicator(), source_version=self.source_version)
+
+            pending = (gcp_path for gcp_path in download_file_paths
+                       if not (self.is_file_duplicate(gcp_path) and ignore_duplicates))
+            for batch in self.file_batches(pending, load_data()):
+                if len(batch) > 1:
+                    try:
+                        folder_name = load_data().download_files(batch)
+                    except LoadJobError as e:
+                        logger.error("Not marking {count} file(s) as processed: {error}",
+                                     count=len(batch), error=e)
+                        continue
+                    self.update_and_clean(batch, folder_name)
+                    continue
+
+                # local_file_name = self.download_file(gcp_path)
+                local_file_name = batch[0]
+
+                try:
+                    file_path = load_data()
+                    folder_name = file_path.download_file(local_file_name)
+
+                except ijson.IncompleteJSONError:
+                    print("Malformed File Found: Skipping")
+                    self.update_and_clean(local_file_name, folder_name)
+                    continue
+                except LoadJobError as e:
+                    logger.error("Not marking {file} as processed: {error}",
+                                 file=local_file_name, error=e)
+                    continue
 
-            # local_file_name = self.download_file(gcp_path)
-            local_file_name = gcp_path
+                self.update_and_clean(local_file_name, folder_name)
 
-            try:
-                file_path = GetLoadData(
-                    self.config_dict)
-                folder_name = file_path.download_file(local_file_name)
+        self.metrics.summary()
+        return self.unfinished(download_file_paths)
 
-            except ijson.IncompleteJSONError:
-                print("Malformed File Found: Skipping")
-                self.update_and_clean(local_file_name, folder_name)
-                continue
+    def file_batches(self, download_file_paths, load_data):
+        """
+        Groups the files to ingest so that small files with the same header
+        line are converted together in one Spark job. See FileBatcher for
+        the limits and for the files that are yielded on their own.
+        :param download_file_paths: the files to ingest, in order
+        :param load_data: used to find the engine each file is converted with
+        """
+        batcher = FileBatcher(
+            self.config_dict,
+            size=lambda path: self.get_listing().size(path) if path.startswith("gs://")
+            else input_size(path),
+            single=lambda path: load_data.select_engine(path) == "arrow",
+            storage_client=self.storage_client)
+        return batcher.batches(download_file_paths)
+
+    def get_indexes(self) -> tuple:
+        """
+        Returns the local ID index and the similarity index, or None for
+        the ones that are not enabled
+        """
+        if self.local_index is None and \
+                self.prop("local_index_enabled", optional=True, default_value=False):
+            from parquet_index import LocalIdIndex
+            self.local_index = LocalIdIndex(self.config_dict)
+        if self.similarity_index is None and \
+                self.prop("similarity_index_enabled", optional=True, default_value=False):
+            from similarity import FingerprintIndex
+            self.similarity_index = FingerprintIndex(self.config_dict)
+        return self.local_index, self.similarity_index
+
+    def get_deduplicator(self):
+        """
+        Returns the IdDeduplicator shared by every file, or None when
+        dedup_enabled is not set
+        """
+        if self.deduplicator is None and \
+                self.prop("dedup_enabled", optional=True, default_value=False):
+            from id_dedup import IdDeduplicator
+            self.deduplicator = IdDeduplicator(self.config_dict)
+        return self.deduplicator
+
+    def spark_sessions(self):
+        """
+        Returns a context that yields the session manager for one run: the
+        long lived one while watching, otherwise one stopped at the end
+        """
+        if self.session_manager is not None:
+            return contextlib.nullcontext(self.session_manager)
+        from spark_session import SparkSessionManager
+        return SparkSessionManager(self.config_dict)
 
-            self.update_and_clean(local_file_name, folder_name)
+    def watch(self) -> None:
+        """
+        Runs until interrupted (SIGINT or SIGTERM), ingesting new files in
+        micro-batches as they arrive (see FileWatcher). The SparkSession,
+        the GCP clients and the indexes are created once and stay warm
+        between batches.
+        """
+        listing = self.get_listing() if self.prop("search_folder").lower() == "gcp" else None
+        ignore_duplicates = self.prop("ignore_duplicates", optional=True)
+        watcher = FileWatcher(self.config_dict, listing=listing,
+                              is_duplicate=self.is_file_duplicate if ignore_duplicates else None)
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signal_number, lambda *_: watcher.stop())
+
+        self.get_loader()
+        self.get_indexes()
+        self.get_deduplicator()
+        from spark_session import SparkSessionManager
+        with SparkSessionManager(self.config_dict) as session_manager:
+            self.session_manager = session_manager
+            if self.prop("watch_warm_spark", optional=True, default_value=True):
+                session_manager.get_session()
+            try:
+                for batch in watcher.batches():
+                    try:
+                        failed = self.item_generator(batch)
+                    except Exception:
+                        logger.exception("Ingesting a batch of {count} file(s) failed, "
+                                         "retrying in {seconds}s", count=len(batch),
+                                         seconds=watcher.retry_seconds)
+                        self.unfinished(batch)
+                        watcher.failed(batch)
+                        continue
+                    if failed:
+                        watcher.failed(failed)
+                    watcher.ingested([path for path in batch if path not in failed])
+            finally:
+                self.session_manager = None
+        logger.info("Stopped watching")
+
+    def get_loader(self) -> BigQueryBulkLoader:
+        if self.loader is None:
+            self.loader = open_loader(
+                self.config_dict,
+                self.prop("load_mode", optional=True, default_value="load_job"),
+                metrics=self.metrics, client=self.bigquery_client,
+                storage_client=self.staging_client)
+        return self.loader
+
+    def close(self) -> None:
+        """
+        Releases the persistence backend, the metrics file, the indexes and
+        the ID deduplicator
+        """
+        self.state.close()
+        self.metrics.close()
+        if self.listing is not None:
+            self.listing.close()
+        if self.local_index is not None:
+            self.local_index.close()
+        if self.deduplicator is not None:
+            self.deduplicator.close()
+
+    def source_version(self, file_name: str):
+        """
+        Returns the version of a file that is being ingested, its listed
+        generation for bucket objects and its signature for local files. The
+        first answer is kept until the file is processed, so every load job
+        of the file is keyed on the same version.
+        :param file_name: the local or gs:// path of the file
+        """
+        if file_name not in self.versions:
+            if file_name.startswith("gs://"):
+                generation = self.get_listing().generation(file_name)
+                version = str(generation) if generation is not None else None
+            else:
+                version = file_signature(file_name)
+            self.versions[file_name] = version
+        return self.versions[file_name]
+
+    def unfinished(self, file_paths) -> list:
+        """
+        Returns the files that were given a version but not processed, and
+        forgets their versions so that a retry reads them again
+        :param file_paths: the files that were ingested
+        """
+        unfinished = [file_name for file_name in file_paths if file_name in self.versions]
+        for file_name in unfinished:
+            del self.versions[file_name]
+        return unfinished
 
-    def update_and_clean(self, file_path_consumed: str, local_file_path: str):
+    def update_and_clean(self, file_path_consumed, local_file_path: str):
         """
         Updates persistent data and deletes the consumed file if required
-        :param file_path_consumed: the file consumed from the aws bucket
-        :param local_file_path: the local file path where that file can be found
+        :param file_path_consumed: the file consumed from the aws bucket, or
+            a list of files consumed together
+        :param local_file_path: the local file path where that file can be found,
+            or a list of paths to delete
         """
         delete_consumed_files = self.prop(
             "delete_consumed_files", optional=True)
-        self.persistent_data["download_file_list"].append(file_path_consumed)
-        self.update_persistent_data()
+        if isinstance(file_path_consumed, str):
+            file_path_consumed = [file_path_consumed]
+        for file_name in file_path_consumed:
+            self.state.mark_processed(file_name)
+            self.state.clear_checkpoints(file_name)
+            version = self.versions.pop(file_name, None)
+            signature = None if file_name.startswith("gs://") \
+                else version or file_signature(file_name)
+            if signature is not None:
+                # Kept until the file is ingested again, see is_file_duplicate
+                self.state.record_checkpoint(file_name, "ingested", "signature", signature)
+            if self.listing is not None and file_name.startswith("gs://"):
+                self.listing.mark_ingested(file_name, version)
+            if self.deduplicator is not None:
+                self.deduplicator.mark_loaded(file_name)
 
         if delete_consumed_files:
-            self.delete_file(local_file_path)
+            if isinstance(local_file_path, str):
+                local_file_path = [local_file_path]
+            for file_path in local_file_path:
+                self.delete_file(file_path)
 
 
 def load_yaml(yaml_file_path: str) -> dict:
@@ -268,7 +452,17 @@ def load_yaml(yaml_file_path: str) -> dict:
 
 if __name__ == "__main__":
 
-    CONFIG_FILE_PATH = "./configs/gcp_config.yaml"
-    config_dict = load_yaml(CONFIG_FILE_PATH)
+    parser = argparse.ArgumentParser(description="Ingest files into BigQuery")
+    parser.add_argument("--config", default="./configs/gcp_config.yaml")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and ingest new files as they arrive")
+    args = parser.parse_args()
+
+    configure_logging()
+    config_dict = load_yaml(args.config)
     connector = GCPConnector(config_dict)
-    generator = connector.item_generator()
+    if args.watch:
+        connector.watch()
+    else:
+        generator = connector.item_generator()
+    connector.close()
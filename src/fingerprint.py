@@ -0,0 +1,140 @@
+"""
+Compact binary encoding for the FP1-FP5 fingerprint columns.
+
+A fingerprint is 2048 integers in 0..1000. The text format stores them as a
+comma separated string (about 8 KB); the binary format packs them as 2048
+little-endian uint16 values (4096 bytes) that decode without parsing.
+"""
+import re
+
+import numpy as np
+
+FP_COLUMNS = ["FP1", "FP2", "FP3", "FP4", "FP5"]
+FP_LENGTH = 2048
+FP_MAX_VALUE = 1000
+FP_DTYPE = np.dtype("<u2")
+FP_BYTES = FP_LENGTH * FP_DTYPE.itemsize
+
+# Comma separated integers; the range is checked on the parsed values
+FINGERPRINT_PATTERN = r"^[0-9]{1,4}(,[0-9]{1,4})*$"
+FINGERPRINT_REGEX = re.compile(FINGERPRINT_PATTERN)
+
+TEXT_ENCODING = "text"
+BINARY_ENCODING = "binary"
+
+
+def parse_fingerprints(values) -> tuple:
+    """
+    Parses comma separated fingerprints into a (n, 2048) uint16 matrix.
+    Returns the matrix and a boolean mask of the rows that were valid;
+    invalid rows (null, malformed, wrong length or out of range values) are
+    zero filled instead of failing the whole batch.
+    :param values: an iterable of comma separated strings or None
+    """
+    values = list(values)
+    matrix = np.zeros((len(values), FP_LENGTH), dtype=FP_DTYPE)
+    valid = np.array([isinstance(value, str) and value.count(",") == FP_LENGTH - 1
+                      and FINGERPRINT_REGEX.fullmatch(value) is not None
+                      for value in values], dtype=bool)
+    if not valid.any():
+        return matrix, valid
+
+    joined = ",".join(value for value, ok in zip(values, valid) if ok)
+    parsed = np.array(joined.split(","), dtype=np.int64).reshape(-1, FP_LENGTH)
+
+    in_range = ((parsed >= 0) & (parsed <= FP_MAX_VALUE)).all(axis=1)
+    rows = np.flatnonzero(valid)
+    matrix[rows[in_range]] = parsed[in_range]
+    valid[rows[~in_range]] = False
+    return matrix, valid
+
+
+def encode_fingerprints(values) -> list:
+    """
+    Encodes comma separated fingerprints as 4096 byte values. Rows that do
+    not hold a valid fingerprint are returned as None.
+    :param values: an iterable of comma separated strings or None
+    """
+    matrix, valid = parse_fingerprints(values)
+    packed = matrix.tobytes()
+    return [packed[i * FP_BYTES:(i + 1) * FP_BYTES] if ok else None
+            for i, ok in enumerate(valid)]
+
+
+def decode_fingerprints(blobs) -> np.ndarray:
+    """
+    Decodes binary fingerprints into a (n, 2048) uint16 matrix. Null values
+    are decoded as all zero rows.
+    :param blobs: an iterable of 4096 byte values or None
+    """
+    empty = bytes(FP_BYTES)
+    joined = b"".join(empty if blob is None else bytes(blob) for blob in blobs)
+    return np.frombuffer(joined, dtype=FP_DTYPE).reshape(-1, FP_LENGTH)
+
+
+def fingerprints_to_strings(matrix: np.ndarray) -> list:
+    """
+    Formats a (n, 2048) matrix back into comma separated strings
+    :param matrix: the fingerprint matrix
+    """
+    return [",".join(map(str, row)) for row in np.asarray(matrix).tolist()]
+
+
+def convert_parquet_file(source_path: str, destination_path: str) -> None:
+    """
+    Rewrites a text encoded Parquet output with binary fingerprints stored
+    as FIXED_LEN_BYTE_ARRAY(4096) columns
+    :param source_path: the text encoded Parquet file
+    :param destination_path: where the binary encoded file is written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(source_path)
+    for column in FP_COLUMNS:
+        if column not in table.column_names:
+            continue
+        encoded = pa.array(encode_fingerprints(table[column].to_pylist()),
+                           type=pa.binary(FP_BYTES))
+        table = table.set_column(
+            table.schema.get_field_index(column), column, encoded)
+    pq.write_table(table, destination_path)
+
+
+def convert_table_sql(source_table_id: str, destination_table_id: str) -> str:
+    """
+    Builds a CREATE TABLE AS SELECT statement that converts an existing text
+    encoded BigQuery table into one with BYTES fingerprints. Each value is
+    written as two little-endian bytes, matching encode_fingerprints.
+    :param source_table_id: the fully qualified text encoded table
+    :param destination_table_id: the fully qualified table to create
+    """
+    packed = []
+    for column in FP_COLUMNS:
+        packed.append(f"""
+    IF({column} IS NULL, NULL, CODE_POINTS_TO_BYTES(ARRAY(
+        SELECT byte
+        FROM UNNEST(SPLIT({column}, ',')) AS value WITH OFFSET position,
+            UNNEST([MOD(CAST(value AS INT64), 256), DIV(CAST(value AS INT64), 256)])
+            AS byte WITH OFFSET half
+        ORDER BY position, half))) AS {column}""")
+
+    return f"""
+CREATE TABLE `{destination_table_id}`
+CLUSTER BY ID
+AS SELECT
+    * EXCEPT ({", ".join(FP_COLUMNS)}),{",".join(packed)}
+FROM `{source_table_id}`
+"""
+
+
+def convert_table(client, source_table_id: str, destination_table_id: str):
+    """
+    Converts an existing text encoded BigQuery table into a binary one
+    :param client: a bigquery.Client
+    :param source_table_id: the fully qualified text encoded table
+    :param destination_table_id: the fully qualified table to create
+    """
+    query_job = client.query(
+        convert_table_sql(source_table_id, destination_table_id))
+    return query_job.result()
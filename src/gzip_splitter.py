@@ -0,0 +1,126 @@
+"""
+Turns a large gzip TSV into line aligned chunks that Spark can read in
+parallel. A single gzip stream is not splittable, so Spark reads it with one
+task on one core no matter how many executors there are.
+"""
+import gzip
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from source_connector import SourceConnector, parse_size
+
+READ_BLOCK_BYTES = 16 * 1024 ** 2
+
+
+def write_chunk(path: str, header: bytes, body: bytes, compress: bool) -> int:
+    """
+    Writes one chunk with its own copy of the header line. Compression runs
+    in zlib, which releases the GIL, so chunks compress in parallel threads.
+    """
+    data = header + body
+    if compress:
+        data = gzip.compress(data, compresslevel=1)
+    with open(path, "wb") as file:
+        file.write(data)
+    return len(data)
+
+
+class GzipSplitter(SourceConnector):
+    """
+    Decompresses a gzip TSV as a stream and cuts it into chunks of about
+    split_chunk_bytes uncompressed bytes, each starting with the header.
+    Chunks are written by split_workers threads, plain (split_codec: none)
+    or as small gzip files (split_codec: gzip).
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        self.min_bytes = parse_size(self.prop(
+            "split_min_bytes", optional=True, default_value=0))
+        self.chunk_bytes = parse_size(self.prop(
+            "split_chunk_bytes", optional=True, default_value="128MB"))
+        self.workers = self.prop(
+            "split_workers", optional=True, default_value=os.cpu_count() or 1)
+        self.codec = self.prop("split_codec", optional=True, default_value="none")
+        self.split_dir = self.prop(
+            "split_dir", optional=True, default_value="./split")
+
+    def should_split(self, filename: str) -> bool:
+        """
+        Only local gzip files of at least split_min_bytes are split;
+        split_min_bytes of 0 disables splitting
+        :param filename: the local or gs:// path of the input file
+        """
+        return bool(self.min_bytes) and filename.endswith(".gz") \
+            and not filename.startswith("gs://") \
+            and os.path.getsize(filename) >= self.min_bytes
+
+    def prepare(self, filename: str, name: str) -> str:
+        """
+        Returns the path Spark should read: a folder of chunks when the file
+        is split, the file itself otherwise
+        :param filename: the local or gs:// path of the input file
+        :param name: name of the chunk folder under split_dir
+        """
+        if not self.should_split(filename):
+            return filename
+        return self.split(filename, os.path.join(self.split_dir, name))
+
+    def split(self, filename: str, chunk_dir: str) -> str:
+        """
+        Splits the file into line aligned chunks in chunk_dir
+        :param filename: path to a .gz file
+        :param chunk_dir: the folder the chunks are written to
+        """
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+        os.makedirs(chunk_dir)
+        compress = self.codec == "gzip"
+        suffix = ".tsv.gz" if compress else ".tsv"
+
+        start = time.perf_counter()
+        bytes_in = 0
+        futures = []
+        with gzip.open(filename, "rb") as source, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            header = source.readline()
+            pending = []
+            pending_bytes = 0
+            remainder = b""
+            while True:
+                block = source.read(min(READ_BLOCK_BYTES, self.chunk_bytes))
+                if not block:
+                    break
+                bytes_in += len(block)
+                block = remainder + block
+                cut = block.rfind(b"\n") + 1
+                remainder = block[cut:]
+                pending.append(block[:cut])
+                pending_bytes += cut
+                if pending_bytes >= self.chunk_bytes:
+                    futures.append(self.submit_chunk(
+                        executor, chunk_dir, len(futures), suffix, header, pending, compress))
+                    pending, pending_bytes = [], 0
+                    # Bound the chunks held in memory while they are written
+                    if len(futures) > 2 * self.workers:
+                        futures[-2 * self.workers - 1].result()
+
+            if remainder:
+                pending.append(remainder if remainder.endswith(b"\n") else remainder + b"\n")
+            if pending or not futures:
+                futures.append(self.submit_chunk(
+                    executor, chunk_dir, len(futures), suffix, header, pending, compress))
+            bytes_out = sum(future.result() for future in futures)
+
+        logger.info("Split {file} ({mb_in:.1f} MB uncompressed) into {chunks} chunks "
+                    "({mb_out:.1f} MB) in {seconds:.2f}s",
+                    file=filename, mb_in=bytes_in / 1024 ** 2, chunks=len(futures),
+                    mb_out=bytes_out / 1024 ** 2, seconds=time.perf_counter() - start)
+        return chunk_dir
+
+    def submit_chunk(self, executor, chunk_dir, index, suffix, header, pending, compress):
+        path = os.path.join(chunk_dir, f"part-{index:05d}{suffix}")
+        return executor.submit(write_chunk, path, header, b"".join(pending), compress)
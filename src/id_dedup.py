@@ -0,0 +1,306 @@
+"""
+Row level deduplication of IDs across input files, so compounds that are
+shipped again under a new file name are not loaded twice
+"""
+import json
+import math
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from loguru import logger
+
+from source_connector import SourceConnector
+
+# pandas.util.hash_array takes 16 character keys; two keys give the two
+# independent hashes the bit positions are derived from
+HASH_KEYS = ("ingest-id-hash-1", "ingest-id-hash-2")
+# Keeps IN (...) lists below SQLite's parameter limit
+EXACT_CHUNK = 500
+# Seconds a process waits for another one holding the write lock of ids.sqlite
+LOCK_TIMEOUT = 300
+
+# The deduplicator of each Spark Python worker, by connector config
+_worker_deduplicators: dict = {}
+
+
+class IdDeduplicator(SourceConnector):
+    """
+    Remembers every ID that was converted and the file it came from, and
+    drops rows whose ID was already converted from another file. Repeats
+    within one file are left as they are.
+
+    New IDs are tested against a Bloom filter of dedup_expected_ids IDs at
+    dedup_false_positive_rate, kept in a memory mapped file under dedup_dir,
+    so only the pages that are touched stay in memory. A suspected hit is
+    confirmed against the exact set of IDs in dedup_dir/ids.sqlite, which
+    also records the file each ID came from. IDs that belong to the file
+    being converted are kept, so converting a file again after a crash
+    does not drop its own rows.
+
+    IDs are claimed by their file when it is converted and only count as
+    ingested once mark_loaded is called after its load succeeded. A claim
+    still blocks the ID for other files, so an ID new to two files at once
+    is only kept for the first; release gives up the claims of a file
+    whose load failed.
+
+    Several processes on one host, e.g. the Python workers of a local
+    Spark, can check IDs against the same dedup_dir: every check holds the
+    write lock of ids.sqlite while it reads and updates the exact set and
+    the shared memory mapped filter. Neither is safe on a filesystem
+    shared between hosts, see check_single_host.
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        state_path = self.prop("state_path", optional=True,
+                               default_value="./process_data/state.sqlite")
+        self.dedup_dir = self.prop("dedup_dir", optional=True, default_value=os.path.join(
+            os.path.dirname(state_path) or ".", "ids"))
+        os.makedirs(self.dedup_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(self.dedup_dir, "ids.sqlite"), timeout=LOCK_TIMEOUT,
+            isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY, source_file TEXT, "
+            "loaded INTEGER NOT NULL DEFAULT 1)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(ids)")]
+        if "loaded" not in columns:
+            # IDs recorded before claims existed were recorded once converted
+            self.connection.execute(
+                "ALTER TABLE ids ADD COLUMN loaded INTEGER NOT NULL DEFAULT 1")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS ids_claimed ON ids (source_file) WHERE loaded = 0")
+        self.bits, self.num_bits, self.num_hashes = self.open_filter()
+
+    def open_filter(self) -> tuple:
+        """
+        Opens the Bloom filter, creating it from the configured size on
+        first use. An existing filter keeps the size it was created with.
+        """
+        header_path = os.path.join(self.dedup_dir, "bloom.json")
+        bits_path = os.path.join(self.dedup_dir, "bloom.bits")
+        if os.path.exists(header_path) and os.path.exists(bits_path):
+            with open(header_path, "r", encoding="utf8") as file:
+                header = json.load(file)
+            bits = np.memmap(bits_path, dtype=np.uint8, mode="r+")
+            return bits, header["num_bits"], header["num_hashes"]
+
+        expected = int(self.prop("dedup_expected_ids", optional=True, default_value=100_000_000))
+        rate = float(self.prop("dedup_false_positive_rate", optional=True, default_value=0.001))
+        num_bits = math.ceil(-expected * math.log(rate) / math.log(2) ** 2)
+        num_bits += -num_bits % 8
+        num_hashes = max(round(num_bits / expected * math.log(2)), 1)
+        bits = np.memmap(bits_path, dtype=np.uint8, mode="w+", shape=(num_bits // 8,))
+        logger.info("Created a Bloom filter of {mb:.1f} MB with {hashes} hashes for "
+                    "{expected} IDs", mb=num_bits / 8 / 1024 ** 2, hashes=num_hashes,
+                    expected=expected)
+
+        known = self.connection.execute("SELECT COUNT(*) FROM ids").fetchone()[0]
+        if known:
+            # The exact set outlived the filter, e.g. after the filter was deleted
+            cursor = self.connection.execute("SELECT id FROM ids")
+            while True:
+                rows = cursor.fetchmany(100_000)
+                if not rows:
+                    break
+                self.add_to_filter(bits, num_bits, num_hashes,
+                                   np.array([row[0] for row in rows], dtype=object))
+            logger.info("Rebuilt the Bloom filter from {count} known IDs", count=known)
+        bits.flush()
+        with open(header_path, "w", encoding="utf8") as file:
+            json.dump({"num_bits": num_bits, "num_hashes": num_hashes,
+                       "expected_ids": expected, "false_positive_rate": rate}, file)
+        return bits, num_bits, num_hashes
+
+    @staticmethod
+    def positions(ids: np.ndarray, num_bits: int, num_hashes: int) -> np.ndarray:
+        """
+        Returns the (n, num_hashes) bit positions of the IDs, by double hashing
+        """
+        first, second = (pd.util.hash_array(ids, hash_key=key) for key in HASH_KEYS)
+        steps = np.arange(num_hashes, dtype=np.uint64)
+        return (first[:, None] + steps[None, :] * (second[:, None] | np.uint64(1))) \
+            % np.uint64(num_bits)
+
+    @classmethod
+    def add_to_filter(cls, bits, num_bits: int, num_hashes: int, ids: np.ndarray) -> None:
+        positions = cls.positions(ids, num_bits, num_hashes).ravel()
+        np.bitwise_or.at(bits, positions >> np.uint64(3),
+                         (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+
+    def maybe_seen(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Returns a mask of the IDs the Bloom filter may have seen
+        """
+        positions = self.positions(ids, self.num_bits, self.num_hashes)
+        set_bits = (self.bits[positions >> np.uint64(3)]
+                    >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return set_bits.all(axis=1)
+
+    def owners(self, ids: list) -> dict:
+        """
+        Returns the source file of every ID in the exact set
+        """
+        found = {}
+        for start in range(0, len(ids), EXACT_CHUNK):
+            chunk = ids[start:start + EXACT_CHUNK]
+            found.update(self.connection.execute(
+                f"SELECT id, source_file FROM ids WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk))
+        return found
+
+    def new_rows(self, ids, source_file: str) -> np.ndarray:
+        """
+        Records the new IDs and returns a mask of the rows to keep, i.e.
+        those whose ID was not ingested from another file
+        :param ids: the IDs of the rows, in order
+        :param source_file: the input file the rows come from
+        """
+        ids = np.asarray(ids, dtype=object)
+        # Rows without an ID are left to validation
+        keep = pd.isna(ids)
+        present = np.flatnonzero(~keep)
+        if not len(present):
+            return keep
+        codes, unique_ids = pd.factorize(ids[present])
+        unique_ids = np.asarray(unique_ids, dtype=object)
+
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                fresh, owners = self.check_and_record(unique_ids, source_file)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        keep[present] = fresh[codes]
+        return keep
+
+    def check_and_record(self, unique_ids: np.ndarray, source_file: str) -> tuple:
+        """
+        Returns a mask of the IDs to keep and the known owners of the IDs,
+        and records the new ones. Runs inside the write transaction.
+        """
+        suspected = self.maybe_seen(unique_ids)
+        owners = self.owners(unique_ids[suspected].tolist()) if suspected.any() else {}
+        fresh = np.array([owners.get(value, source_file) == source_file
+                          for value in unique_ids], dtype=bool) if owners \
+            else np.ones(len(unique_ids), dtype=bool)
+
+        new_ids = [value for value in unique_ids[fresh] if value not in owners]
+        if new_ids:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO ids (id, source_file, loaded) VALUES (?, ?, 0)",
+                ((value, source_file) for value in new_ids))
+            self.add_to_filter(self.bits, self.num_bits, self.num_hashes,
+                               np.array(new_ids, dtype=object))
+        return fresh, owners
+
+    def filter_batch(self, batch: pa.RecordBatch, source_file: str) -> pa.RecordBatch:
+        """
+        Returns the rows of the batch whose ID was not ingested from
+        another file
+        """
+        keep = self.new_rows(batch.column("ID").to_numpy(zero_copy_only=False), source_file)
+        return batch if keep.all() else batch.filter(pa.array(keep))
+
+    def filter_frame(self, frame: pd.DataFrame, source_file: str,
+                     source_column: str = None) -> pd.DataFrame:
+        """
+        Returns the rows of the pandas DataFrame whose ID was not ingested
+        from another file
+        :param source_file: the file the rows come from
+        :param source_column: a column with the file of every row, when the
+            rows come from several files
+        """
+        ids = frame["ID"].to_numpy(dtype=object)
+        if source_column is None:
+            keep = self.new_rows(ids, source_file)
+        else:
+            keep = np.ones(len(frame), dtype=bool)
+            for row_source, index in frame.groupby(source_column, sort=False).indices.items():
+                keep[index] = self.new_rows(ids[index], row_source)
+        return frame if keep.all() else frame[keep]
+
+    def mark_loaded(self, source_file: str) -> None:
+        """
+        Turns the IDs claimed by a file into ingested IDs, once its rows
+        were loaded
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE ids SET loaded = 1 WHERE source_file = ? AND loaded = 0", (source_file,))
+
+    def release(self, source_file: str) -> None:
+        """
+        Gives up the IDs claimed by a file whose load failed, so other files
+        keep them. Their Bloom filter bits stay set and only cost an exact
+        lookup.
+        """
+        with self.lock:
+            released = self.connection.execute(
+                "DELETE FROM ids WHERE source_file = ? AND loaded = 0", (source_file,)).rowcount
+        if released:
+            logger.info("Released {count} IDs claimed by {file}", count=released, file=source_file)
+
+    def report(self, source_file: str, rows: int) -> None:
+        """
+        Logs the number of duplicate rows skipped for a file and writes the
+        Bloom filter to disk
+        """
+        self.bits.flush()
+        if rows:
+            logger.info("Skipped {rows} rows of {file} whose ID was already ingested",
+                        rows=rows, file=source_file)
+
+    def close(self) -> None:
+        self.bits.flush()
+        self.connection.close()
+
+
+def check_single_host(master: str) -> None:
+    """
+    Raises ValueError unless Spark runs on one host. Every Python worker
+    opens the SQLite set and the memory mapped filter in dedup_dir itself,
+    and neither is safe to share between hosts over a network filesystem.
+    :param master: the Spark master URL, e.g. local[*]
+    """
+    if not (master or "").startswith("local"):
+        raise ValueError(f"dedup_enabled needs a local Spark master, got '{master}'; "
+                         f"dedup_dir cannot be shared between executor hosts")
+
+
+def worker_deduplicator(config_dict: dict) -> IdDeduplicator:
+    """
+    Returns the IdDeduplicator of the current process for the config,
+    opening it on first use, so a Spark Python worker opens dedup_dir once
+    and reuses it for every partition it checks
+    """
+    key = json.dumps(config_dict.get("connector_config", config_dict),
+                     sort_keys=True, default=str)
+    if key not in _worker_deduplicators:
+        _worker_deduplicators[key] = IdDeduplicator(config_dict)
+    return _worker_deduplicators[key]
+
+
+def drop_duplicate_frames(frames, config_dict: dict, source_file: str,
+                          source_column: str = None):
+    """
+    Filters pandas DataFrames of rows with the deduplicator of the current
+    process; the function mapInPandas runs on every partition
+    :param frames: an iterator of pandas DataFrames with an ID column
+    :param config_dict: the connector config, to open the deduplicator
+    :param source_file: the file the rows come from
+    :param source_column: a column with the file of every row, if any
+    """
+    deduplicator = worker_deduplicator(config_dict)
+    for frame in frames:
+        yield deduplicator.filter_frame(frame, source_file, source_column)
+    deduplicator.bits.flush()
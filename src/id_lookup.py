@@ -0,0 +1,141 @@
+"""
+Batched, cached lookup of rows by ID in the BigQuery table
+"""
+import threading
+
+from cachetools import TTLCache
+from loguru import logger
+from google.cloud import bigquery
+from google.oauth2 import service_account
+
+from source_connector import SourceConnector
+from bq_loader import TABLE_SCHEMA
+
+COLUMN_NAMES = [field.name for field in TABLE_SCHEMA]
+MISSING = object()
+
+
+class IdLookupService(SourceConnector):
+    """
+    Resolves many IDs at once with parameterized IN UNNEST(@ids) queries of
+    at most lookup_batch_size IDs, selecting only the requested columns.
+    Recent rows, including IDs that were not found, are kept in an LRU cache
+    of lookup_cache_size entries that expire after lookup_cache_ttl seconds.
+    """
+
+    def __init__(self, config_dict: dict, client: bigquery.Client = None):
+        super().__init__(config_dict)
+        self.project_id = self.prop("project_id")
+        self.dataset_id = self.prop("dataset_id")
+        self.table_id = "{}.{}.{}".format(
+            self.project_id, self.dataset_id, self.prop("bq_table_name"))
+        self.batch_size = self.prop(
+            "lookup_batch_size", optional=True, default_value=10000)
+
+        if client is None:
+            credentials = service_account.Credentials.from_service_account_file(
+                self.prop("key_path"), scopes=[
+                    "https://www.googleapis.com/auth/cloud-platform"],
+            )
+            client = bigquery.Client(credentials=credentials,
+                                     project=self.project_id)
+        self.client = client
+
+        self.cache = TTLCache(
+            maxsize=self.prop("lookup_cache_size", optional=True, default_value=100000),
+            ttl=self.prop("lookup_cache_ttl", optional=True, default_value=600))
+        self.lock = threading.Lock()
+
+        self.requested = 0
+        self.hits = 0
+        self.queries = 0
+        self.bytes_processed = 0
+        self.bytes_billed = 0
+
+    def select_columns(self, columns: list = None) -> tuple:
+        """
+        Checks the requested columns against the table schema; ID is always
+        selected because results are keyed on it
+        :param columns: column names, None for all columns
+        """
+        if not columns:
+            return tuple(COLUMN_NAMES)
+        unknown = set(columns) - set(COLUMN_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown columns requested: {sorted(unknown)}")
+        return tuple(["ID"] + [column for column in columns if column != "ID"])
+
+    def lookup(self, ids, columns: list = None) -> dict:
+        """
+        Returns a dict mapping every requested ID to its row (a dict of the
+        selected columns) or to None when the ID is not in the table
+        :param ids: the IDs to resolve
+        :param columns: the columns to return, None for all columns
+        """
+        columns = self.select_columns(columns)
+        unique_ids = list(dict.fromkeys(ids))
+
+        results = {}
+        misses = []
+        with self.lock:
+            self.requested += len(unique_ids)
+            for target_id in unique_ids:
+                row = self.cache.get((target_id, columns), MISSING)
+                if row is MISSING:
+                    misses.append(target_id)
+                else:
+                    results[target_id] = row
+            self.hits += len(unique_ids) - len(misses)
+
+        for start in range(0, len(misses), self.batch_size):
+            batch = misses[start:start + self.batch_size]
+            found = self.query_batch(batch, columns)
+            with self.lock:
+                for target_id in batch:
+                    row = found.get(target_id)
+                    self.cache[(target_id, columns)] = row
+                    results[target_id] = row
+        return results
+
+    def query_batch(self, ids: list, columns: tuple) -> dict:
+        """
+        Runs one parameterized query for a batch of IDs
+        :param ids: the IDs to resolve, at most lookup_batch_size of them
+        :param columns: the validated columns to select
+        """
+        query = f"""
+            SELECT {", ".join(f"`{column}`" for column in columns)}
+            FROM `{self.table_id}`
+            WHERE ID IN UNNEST(@ids)
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter("ids", "STRING", ids)])
+        query_job = self.client.query(query, job_config=job_config)
+        found = {row["ID"]: dict(row.items()) for row in query_job.result()}
+
+        with self.lock:
+            self.queries += 1
+            self.bytes_processed += query_job.total_bytes_processed or 0
+            self.bytes_billed += query_job.total_bytes_billed or 0
+        return found
+
+    def stats(self) -> dict:
+        """
+        Returns the cache hit rate and the bytes scanned per query and per
+        looked up ID
+        """
+        with self.lock:
+            misses = self.requested - self.hits
+            report = {
+                "ids_requested": self.requested,
+                "cache_hits": self.hits,
+                "cache_hit_rate": round(self.hits / self.requested, 4) if self.requested else 0.0,
+                "queries": self.queries,
+                "bytes_processed": self.bytes_processed,
+                "bytes_billed": self.bytes_billed,
+                "bytes_per_query": self.bytes_processed // self.queries if self.queries else 0,
+                "bytes_per_id": self.bytes_processed // self.requested if self.requested else 0,
+                "bytes_per_queried_id": self.bytes_processed // misses if misses else 0,
+            }
+        logger.info("ID lookup stats: {report}", report=report)
+        return report
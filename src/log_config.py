@@ -0,0 +1,27 @@
+"""
+Log file sinks. They are added by the entry points, once per process,
+instead of as a side effect of importing the pipeline modules.
+"""
+import os
+
+from loguru import logger
+
+LOG_FORMAT = "{time} | {name} | {level} | {message}"
+sink_ids: list = []
+
+
+def configure_logging() -> None:
+    """
+    Adds the error log (LOG_FILE_PATH) and the processing log
+    (PROCESSING_LOG_FILE_PATH) file sinks. Calling it again does nothing.
+    """
+    if sink_ids:
+        return
+    # Add a file handler for logging errors
+    sink_ids.append(logger.add(
+        os.getenv("LOG_FILE_PATH", "./logs/pipeline_error.log"),
+        level="ERROR", format=LOG_FORMAT))
+    # Add another file handler for logging processing information
+    sink_ids.append(logger.add(
+        os.getenv("PROCESSING_LOG_FILE_PATH", "./logs/processing.log"),
+        level="INFO", format=LOG_FORMAT))
@@ -0,0 +1,151 @@
+"""
+Per-file, per-stage timing and throughput metrics, written as JSON lines or
+as a Prometheus text file
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import pyarrow.parquet as pq
+from loguru import logger
+
+from source_connector import SourceConnector
+from bq_loader import find_parquet_files
+
+METRICS_FORMATS = ("none", "jsonl", "prometheus")
+COUNTERS = ("rows", "bytes_in", "bytes_out", "partitions")
+
+
+def input_size(filename: str):
+    """
+    Returns the size of a local input file or folder, None for gs:// paths
+    """
+    if filename.startswith("gs://") or not os.path.exists(filename):
+        return None
+    if os.path.isfile(filename):
+        return os.path.getsize(filename)
+    return sum(entry.stat().st_size for entry in Path(filename).rglob("*") if entry.is_file())
+
+
+def parquet_output_stats(parquet_paths) -> dict:
+    """
+    Returns the rows, bytes and number of Parquet files under the given
+    paths, read from the file footers only
+    :param parquet_paths: a path or a list of paths to Parquet files or folders
+    """
+    parquet_files = find_parquet_files(parquet_paths)
+    return {
+        "rows": sum(pq.ParquetFile(path).metadata.num_rows for path in parquet_files),
+        "bytes_out": sum(os.path.getsize(path) for path in parquet_files),
+        "partitions": len(parquet_files),
+    }
+
+
+class PipelineMetrics(SourceConnector):
+    """
+    Records one event per file and stage (seconds plus rows, bytes in and
+    out and partitions where known) and keeps per stage totals.
+
+    With metrics_format jsonl every event is appended to metrics_path as it
+    happens. With prometheus the totals are rewritten to metrics_path, in
+    the text format read by the node exporter's textfile collector, after
+    every file. Events are only recorded around whole stages, never per row.
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        self.format = self.prop("metrics_format", optional=True, default_value="none")
+        if self.format not in METRICS_FORMATS:
+            raise ValueError(
+                f"Unknown metrics_format '{self.format}', expected one of {METRICS_FORMATS}")
+        default_path = "./logs/metrics.prom" if self.format == "prometheus" \
+            else "./logs/metrics.jsonl"
+        self.path = self.prop("metrics_path", optional=True, default_value=default_path)
+
+        self.lock = threading.Lock()
+        self.totals: dict = {}
+        self.started = time.perf_counter()
+        self.file = None
+        if self.format == "jsonl":
+            os.makedirs(Path(self.path).parent, exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf8", buffering=1)
+
+    def record(self, source_file: str, stage: str, seconds: float, **fields) -> None:
+        """
+        Records one stage of one file
+        :param source_file: the input file
+        :param stage: the stage name, e.g. convert or load
+        :param seconds: the wall clock time spent in the stage
+        :param fields: rows, bytes_in, bytes_out, partitions or other values
+        """
+        with self.lock:
+            totals = self.totals.setdefault(
+                stage, dict({"runs": 0, "seconds": 0.0}, **dict.fromkeys(COUNTERS, 0)))
+            totals["runs"] += 1
+            totals["seconds"] += seconds
+            for counter in COUNTERS:
+                totals[counter] += fields.get(counter) or 0
+            if self.file is not None:
+                self.file.write(json.dumps(dict(
+                    {"time": time.time(), "file": source_file, "stage": stage,
+                     "seconds": round(seconds, 6)}, **fields), default=str) + "\n")
+        if stage == "file" and self.format == "prometheus":
+            self.write_prometheus()
+
+    @contextmanager
+    def timer(self, source_file: str, stage: str, **fields):
+        """
+        Times the enclosed block as one stage of source_file. The yielded
+        dict can be updated with rows, bytes and other values before the
+        block ends.
+        """
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(source_file, stage, time.perf_counter() - start, **fields)
+
+    def summary(self) -> dict:
+        """
+        Logs and returns the per stage totals with rows/s and MB/s
+        """
+        with self.lock:
+            report = {"wall_seconds": round(time.perf_counter() - self.started, 3), "stages": {}}
+            for stage, totals in self.totals.items():
+                seconds = totals["seconds"]
+                report["stages"][stage] = dict(
+                    totals, seconds=round(seconds, 3),
+                    rows_per_second=round(totals["rows"] / seconds, 1) if seconds else 0.0,
+                    mb_per_second=round(
+                        max(totals["bytes_in"], totals["bytes_out"]) / 1024 ** 2 / seconds, 2)
+                    if seconds else 0.0)
+            if self.file is not None:
+                self.file.write(json.dumps(
+                    dict({"time": time.time(), "stage": "summary"}, **report)) + "\n")
+        if self.format == "prometheus":
+            self.write_prometheus()
+        for stage, stage_report in report["stages"].items():
+            logger.info("Stage {stage}: {report}", stage=stage, report=stage_report)
+        return report
+
+    def write_prometheus(self) -> None:
+        lines = []
+        with self.lock:
+            for name in ("runs", "seconds") + COUNTERS:
+                metric = f"ingest_stage_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for stage, totals in sorted(self.totals.items()):
+                    lines.append(f'{metric}{{stage="{stage}"}} {totals[name]}')
+        os.makedirs(Path(self.path).parent, exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf8") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, self.path)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,205 @@
+"""
+Local index from ID to Parquet file and row group, for serving point
+lookups from the pipeline's own outputs without querying BigQuery
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from loguru import logger
+
+from source_connector import SourceConnector
+from bq_loader import find_parquet_files
+
+
+def keep_dir_name(source_file: str) -> str:
+    """
+    Returns the folder name the outputs of an input file are kept under:
+    its file name, readable, plus a hash of the full path, so files with
+    the same name in different folders or buckets do not collide
+    """
+    digest = hashlib.sha1(source_file.encode("utf8")).hexdigest()[:16]
+    return f"{Path(source_file).name}-{digest}"
+
+
+class LocalIdIndex(SourceConnector):
+    """
+    Keeps a copy of every Parquet output under local_index_dir (the outputs
+    in output_dir are deleted once loaded) and records, in the SQLite file
+    local_index_path, which file and row group holds each ID together with
+    the ID range of every row group. A lookup then reads only the row
+    groups that hold the requested IDs.
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        self.index_dir = self.prop(
+            "local_index_dir", optional=True, default_value="./index/parquet")
+        index_path = self.prop(
+            "local_index_path", optional=True, default_value="./index/ids.sqlite")
+        os.makedirs(self.index_dir, exist_ok=True)
+        os.makedirs(Path(index_path).parent, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, source_file TEXT);
+            CREATE TABLE IF NOT EXISTS row_groups (
+                file_id INTEGER, row_group INTEGER, num_rows INTEGER,
+                min_id TEXT, max_id TEXT, PRIMARY KEY (file_id, row_group));
+            CREATE TABLE IF NOT EXISTS ids (
+                id TEXT PRIMARY KEY, file_id INTEGER, row_group INTEGER);
+        """)
+        self.connection.commit()
+
+    def add_output(self, source_file: str, parquet_file_path) -> int:
+        """
+        Keeps the Parquet files written for an input file and indexes their
+        IDs. Indexing the same input file again replaces its entries.
+        Returns the number of IDs indexed.
+        :param source_file: the input file the outputs were converted from
+        :param parquet_file_path: a path or a list of paths to Parquet files or folders
+        """
+        keep_dir = os.path.join(self.index_dir, keep_dir_name(source_file))
+
+        indexed = 0
+        with self.lock, self.connection:
+            for (path,) in self.connection.execute(
+                    "SELECT path FROM files WHERE source_file = ?", (source_file,)).fetchall():
+                if os.path.exists(path):
+                    os.remove(path)
+            shutil.rmtree(keep_dir, ignore_errors=True)
+            os.makedirs(keep_dir)
+            self.connection.execute(
+                "DELETE FROM ids WHERE file_id IN (SELECT file_id FROM files WHERE source_file = ?)",
+                (source_file,))
+            self.connection.execute(
+                "DELETE FROM row_groups WHERE file_id IN (SELECT file_id FROM files WHERE source_file = ?)",
+                (source_file,))
+            self.connection.execute(
+                "DELETE FROM files WHERE source_file = ?", (source_file,))
+
+            for index, parquet_file in enumerate(find_parquet_files(parquet_file_path)):
+                kept = os.path.join(
+                    keep_dir, f"{index:05d}-{os.path.basename(parquet_file)}")
+                try:
+                    os.link(parquet_file, kept)
+                except OSError:
+                    shutil.copy2(parquet_file, kept)
+                indexed += self.index_file(kept, source_file)
+
+        logger.info("Indexed {count} IDs from {file}", count=indexed, file=source_file)
+        return indexed
+
+    def index_file(self, path: str, source_file: str) -> int:
+        file_id = self.connection.execute(
+            "INSERT INTO files (path, source_file) VALUES (?, ?)",
+            (path, source_file)).lastrowid
+
+        parquet_file = pq.ParquetFile(path)
+        indexed = 0
+        for row_group in range(parquet_file.num_row_groups):
+            ids = parquet_file.read_row_group(row_group, columns=["ID"])["ID"]
+            ids = ids.drop_null()
+            if len(ids) == 0:
+                continue
+            min_max = pc.min_max(ids)
+            self.connection.execute(
+                "INSERT INTO row_groups VALUES (?, ?, ?, ?, ?)",
+                (file_id, row_group, len(ids),
+                 min_max["min"].as_py(), min_max["max"].as_py()))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO ids VALUES (?, ?, ?)",
+                ((target_id, file_id, row_group) for target_id in ids.to_pylist()))
+            indexed += len(ids)
+        return indexed
+
+    def locate(self, ids: list) -> dict:
+        """
+        Returns {(path, row_group): [ids]} for the IDs that are indexed
+        :param ids: the IDs to find
+        """
+        located = {}
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = self.connection.execute(
+                    "SELECT ids.id, files.path, ids.row_group FROM ids "
+                    "JOIN files ON files.file_id = ids.file_id "
+                    f"WHERE ids.id IN ({', '.join('?' * len(batch))})", batch)
+                for target_id, path, row_group in rows:
+                    located.setdefault((path, row_group), []).append(target_id)
+        return located
+
+    def lookup(self, ids, columns: list = None) -> dict:
+        """
+        Returns a dict mapping every requested ID to its row, or to None
+        when it is not in the index. Each row group is read at most once.
+        :param ids: the IDs to resolve
+        :param columns: the columns to return, None for all columns
+        """
+        ids = list(dict.fromkeys(ids))
+        if columns:
+            columns = ["ID"] + [column for column in columns if column != "ID"]
+
+        results = dict.fromkeys(ids)
+        for (path, row_group), group_ids in self.locate(ids).items():
+            table = pq.ParquetFile(path).read_row_group(row_group, columns=columns)
+            table = table.filter(pc.is_in(table["ID"], value_set=pa.array(group_ids)))
+            for row in table.to_pylist():
+                results[row["ID"]] = row
+        return results
+
+    def cross_check(self, lookup_service, ids: list = None, sample_size: int = 1000) -> dict:
+        """
+        Compares rows served by the local index with the rows in BigQuery
+        :param lookup_service: an IdLookupService for the BigQuery table
+        :param ids: the IDs to compare, defaults to a random sample of indexed IDs
+        :param sample_size: the size of the random sample
+        """
+        if ids is None:
+            with self.lock:
+                ids = [row[0] for row in self.connection.execute(
+                    "SELECT id FROM ids ORDER BY RANDOM() LIMIT ?", (sample_size,))]
+
+        local = self.lookup(ids)
+        remote = lookup_service.lookup(ids)
+        missing_remote = [target_id for target_id in ids
+                          if local[target_id] is not None and remote.get(target_id) is None]
+        missing_local = [target_id for target_id in ids
+                         if local[target_id] is None and remote.get(target_id) is not None]
+        different = [target_id for target_id in ids
+                     if local[target_id] is not None and remote.get(target_id) is not None
+                     and not self.same_row(local[target_id], remote[target_id])]
+        report = {
+            "checked": len(ids),
+            "missing_in_bigquery": len(missing_remote),
+            "missing_locally": len(missing_local),
+            "different": len(different),
+            "examples": (missing_remote + missing_local + different)[:10],
+        }
+        logger.info("Local index cross check: {report}", report=report)
+        return report
+
+    @staticmethod
+    def same_row(local: dict, remote: dict) -> bool:
+        for column, value in remote.items():
+            local_value = local.get(column)
+            if isinstance(value, float) and local_value is not None:
+                # MW and LogP are FLOAT in Parquet and FLOAT64 in BigQuery
+                if abs(value - local_value) > 1e-4 * max(1.0, abs(value)):
+                    return False
+            elif value != local_value:
+                return False
+        return True
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,124 @@
+"""
+Parquet writer settings shared by the Spark and pyarrow writers: sort order,
+dictionary encoded columns, compression codec and row group size
+"""
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from source_connector import SourceConnector, parse_size
+
+CODECS = ("snappy", "zstd", "gzip", "none")
+DICTIONARY_COLUMNS = ["Library_ID", "Sub_ID_1", "Sub_ID_2", "Sub_ID_3"]
+
+
+def name_parts(output_path: str, prefix: str = "part") -> list:
+    """
+    Renames the part files Spark wrote under output_path, which carry a
+    random id, to prefix-00000.parquet, prefix-00001.parquet, ... in the
+    order Spark numbered them. An output written again then has the same
+    file names, so its load jobs keep their ids. Returns the new paths.
+    :param output_path: the folder of one Spark write
+    :param prefix: the start of the new file names
+    """
+    renamed = []
+    for root, dirs, files in os.walk(output_path):
+        dirs.sort()
+        parts = sorted(file for file in files
+                       if file.startswith("part-") and file.endswith(".parquet"))
+        for index, file in enumerate(parts):
+            new_path = os.path.join(root, f"{prefix}-{index:05d}.parquet")
+            os.replace(os.path.join(root, file), new_path)
+            renamed.append(new_path)
+    return renamed
+
+
+class ParquetLayout(SourceConnector):
+    """
+    The BigQuery table is clustered on ID, so with parquet_sort_by_id (or
+    local_index_enabled) rows are sorted by ID within every output file.
+
+    Only the columns in parquet_dictionary_columns are dictionary encoded.
+    Those are the low cardinality Library_ID and Sub_ID_* columns by
+    default; the fingerprints are nearly unique, so their dictionaries
+    would only be built and thrown away.
+
+    parquet_codec (snappy, zstd, gzip or none) compresses every column and
+    parquet_row_group_size sets the uncompressed bytes per row group.
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        codec = str(self.prop("parquet_codec", optional=True, default_value="snappy")).lower()
+        if codec not in CODECS:
+            raise ValueError(f"Unknown parquet_codec '{codec}', expected one of {list(CODECS)}")
+        self.codec = codec
+        self.row_group_bytes = parse_size(self.prop(
+            "parquet_row_group_size", optional=True, default_value="128MB"))
+        self.dictionary_columns = list(self.prop(
+            "parquet_dictionary_columns", optional=True, default_value=DICTIONARY_COLUMNS))
+        self.sort_by_id = bool(
+            self.prop("parquet_sort_by_id", optional=True, default_value=False)
+            or self.prop("local_index_enabled", optional=True, default_value=False))
+
+    def describe(self) -> str:
+        return (f"codec={self.codec} row_group={self.row_group_bytes} "
+                f"dictionary={','.join(self.dictionary_columns) or 'none'} "
+                f"sort_by_id={self.sort_by_id}")
+
+    def spark_options(self) -> dict:
+        """
+        Returns the DataFrameWriter options. Per column dictionary switches
+        (parquet.enable.dictionary#<column>) need parquet-mr 1.12, which
+        ships with Spark 3.2 and later.
+        """
+        options = {
+            "compression": self.codec,
+            "parquet.block.size": str(self.row_group_bytes),
+            "parquet.enable.dictionary": "false",
+        }
+        for column in self.dictionary_columns:
+            options[f"parquet.enable.dictionary#{column}"] = "true"
+        return options
+
+    def spark_writer(self, df):
+        """
+        Returns df.write with the layout applied, sorting each partition by
+        ID if configured
+        """
+        if self.sort_by_id:
+            df = df.sortWithinPartitions("ID")
+        return df.write.options(**self.spark_options())
+
+    def arrow_options(self) -> dict:
+        """
+        Returns the keyword arguments for pyarrow.parquet.ParquetWriter
+        """
+        return {
+            "compression": self.codec,
+            "use_dictionary": self.dictionary_columns,
+        }
+
+    def row_groups(self, batches):
+        """
+        Groups record batches into tables of about parquet_row_group_size
+        uncompressed bytes, sorted by ID if configured, so that each table
+        can be written as one row group
+        :param batches: record batches with the same schema
+        """
+        buffered, buffered_bytes = [], 0
+        for batch in batches:
+            buffered.append(batch)
+            buffered_bytes += batch.nbytes
+            if buffered_bytes >= self.row_group_bytes:
+                yield self.row_group(buffered)
+                buffered, buffered_bytes = [], 0
+        if buffered:
+            yield self.row_group(buffered)
+
+    def row_group(self, batches: list) -> pa.Table:
+        table = pa.Table.from_batches(batches)
+        if self.sort_by_id:
+            table = table.take(pc.sort_indices(table, sort_keys=[("ID", "ascending")]))
+        return table
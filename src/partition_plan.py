@@ -0,0 +1,180 @@
+"""
+Chooses the number of output partitions for a file from its measured size
+and row width, so every Parquet file comes out near a target size
+"""
+import math
+import os
+import zlib
+from pathlib import Path
+
+from loguru import logger
+
+from source_connector import SourceConnector, parse_size
+from fingerprint import BINARY_ENCODING, TEXT_ENCODING
+
+SAMPLE_READ_BYTES = 1024 ** 2
+
+
+def sample_text(path: str, sample_bytes: int) -> tuple:
+    """
+    Decompresses (if needed) the start of a local file and returns
+    (compressed bytes read, text bytes produced, lines seen). Concatenated
+    gzip members, as written by CreateSampleData, are followed across.
+    """
+    compressed = text = lines = 0
+    is_gzip = path.endswith(".gz")
+    decompressor = zlib.decompressobj(wbits=31)
+    with open(path, "rb") as file:
+        while text < sample_bytes:
+            block = file.read(SAMPLE_READ_BYTES)
+            if not block:
+                break
+            compressed += len(block)
+            if not is_gzip:
+                data = block
+            else:
+                data = b""
+                while block:
+                    data += decompressor.decompress(block)
+                    block = decompressor.unused_data
+                    if decompressor.eof:
+                        decompressor = zlib.decompressobj(wbits=31)
+                    else:
+                        break
+            text += len(data)
+            lines += data.count(b"\n")
+    return compressed, text, lines
+
+
+class PartitionPlanner(SourceConnector):
+    """
+    With repartition: auto (the default), the number of partitions is the
+    estimated Parquet size of the file divided by target_file_size. The
+    estimate comes from the input size, the uncompressed row width and
+    compression ratio measured on the first partition_sample_bytes of text,
+    and parquet_size_ratio (Parquet bytes per text byte, which depends on
+    the fingerprint encoding). gs:// inputs cannot be sampled locally, so
+    their size is read through Spark and input_compression_ratio and
+    input_row_bytes are assumed instead.
+
+    A number for repartition (or the older write_partitions key) fixes the
+    count. Reducing the number of partitions Spark read the file with uses
+    coalesce, which avoids a shuffle; more partitions, or grouping by
+    write_partition_columns, repartition. coalesce also merges the read
+    into the reduced number of tasks, so a folder of GzipSplitter chunks
+    is repartitioned instead: every chunk is still parsed by its own task,
+    at the cost of shuffling the converted rows once.
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        self.repartition = self.prop(
+            "repartition", optional=True,
+            default_value=self.prop("write_partitions", optional=True, default_value="auto"))
+        self.target_bytes = parse_size(self.prop(
+            "target_file_size", optional=True, default_value="256MB"))
+        self.sample_bytes = parse_size(self.prop(
+            "partition_sample_bytes", optional=True, default_value="8MB"))
+        fingerprint_encoding = self.prop(
+            "fingerprint_encoding", optional=True, default_value=TEXT_ENCODING)
+        # Binary fingerprints take 4096 bytes instead of about 8 KB of text,
+        # and compress less well than the digits do
+        self.parquet_ratio = float(self.prop(
+            "parquet_size_ratio", optional=True,
+            default_value=0.35 if fingerprint_encoding == BINARY_ENCODING else 0.45))
+        self.compression_ratio = float(self.prop(
+            "input_compression_ratio", optional=True, default_value=2.4))
+        self.assumed_row_bytes = parse_size(self.prop(
+            "input_row_bytes", optional=True, default_value="32KB"))
+        self.max_partitions = self.prop("max_partitions", optional=True, default_value=2000)
+
+    def measure(self, input_path, spark=None) -> dict:
+        """
+        Returns the input size, the estimated text size and row width of a
+        file, of a folder of split chunks or of a list of files read together
+        :param input_path: the local or gs:// path(s) Spark reads
+        :param spark: used to find the size of gs:// inputs
+        """
+        if isinstance(input_path, (list, tuple)):
+            measures = [self.measure(path, spark) for path in input_path]
+            text_bytes = sum(measure["text_bytes"] for measure in measures)
+            rows = sum(measure["text_bytes"] / max(measure["row_bytes"], 1)
+                       for measure in measures)
+            return {"input_bytes": sum(measure["input_bytes"] for measure in measures),
+                    "text_bytes": text_bytes,
+                    "row_bytes": int(text_bytes / rows) if rows else self.assumed_row_bytes,
+                    "measured": all(measure["measured"] for measure in measures)}
+
+        if input_path.startswith("gs://"):
+            input_bytes = self.remote_size(spark, input_path)
+            return {"input_bytes": input_bytes,
+                    "text_bytes": int(input_bytes * self.compression_ratio),
+                    "row_bytes": self.assumed_row_bytes, "measured": False}
+
+        files = [input_path] if os.path.isfile(input_path) else sorted(
+            str(path) for path in Path(input_path).rglob("*")
+            if path.is_file() and not path.name.startswith(("_", ".")))
+        input_bytes = sum(os.path.getsize(path) for path in files)
+        compressed = text = lines = 0
+        for path in files:
+            sampled = sample_text(path, self.sample_bytes - text)
+            compressed, text, lines = (compressed + sampled[0], text + sampled[1],
+                                       lines + sampled[2])
+            if text >= self.sample_bytes:
+                break
+        ratio = text / compressed if compressed else 1.0
+        return {"input_bytes": input_bytes, "text_bytes": int(input_bytes * ratio),
+                "row_bytes": int(text / lines) if lines else self.assumed_row_bytes,
+                "measured": True}
+
+    @staticmethod
+    def remote_size(spark, input_path: str) -> int:
+        jvm = spark._jvm
+        path = jvm.org.apache.hadoop.fs.Path(input_path)
+        file_system = path.getFileSystem(spark._jsc.hadoopConfiguration())
+        return file_system.getContentSummary(path).getLength()
+
+    def plan(self, input_path, current_partitions: int, spark=None,
+             partition_columns: list = None) -> dict:
+        """
+        Returns the plan for one file or batch of files: the partition
+        count, whether to coalesce or repartition, and the estimates it is
+        based on
+        :param input_path: the local or gs:// path(s) Spark reads
+        :param current_partitions: the partitions Spark read the input with
+        :param spark: used to find the size of gs:// inputs
+        :param partition_columns: columns rows are grouped by across files
+        """
+        plan = {"input_path": input_path, "current_partitions": current_partitions}
+        if str(self.repartition).lower() == "auto":
+            plan.update(self.measure(input_path, spark))
+            plan["estimated_rows"] = plan["text_bytes"] // max(plan["row_bytes"], 1)
+            plan["estimated_parquet_bytes"] = int(plan["text_bytes"] * self.parquet_ratio)
+            partitions = math.ceil(plan["estimated_parquet_bytes"] / self.target_bytes)
+            plan["partitions"] = min(max(partitions, 1), self.max_partitions)
+        else:
+            plan["partitions"] = int(self.repartition)
+
+        # The chunks of a split file, read with one task each
+        plan["split"] = isinstance(input_path, str) and not input_path.startswith("gs://") \
+            and os.path.isdir(input_path)
+        if partition_columns:
+            plan["method"] = "repartition"
+        elif plan["partitions"] == current_partitions or \
+                plan["partitions"] < current_partitions and not plan["split"]:
+            plan["method"] = "coalesce"
+        else:
+            plan["method"] = "repartition"
+        logger.info("Partition plan for {path}: {plan}", path=input_path, plan=plan)
+        return plan
+
+    @staticmethod
+    def apply(df, plan: dict, partition_columns: list = None):
+        """
+        Applies a plan to a DataFrame
+        """
+        if plan["method"] == "coalesce":
+            if plan["partitions"] == plan["current_partitions"]:
+                return df
+            return df.coalesce(plan["partitions"])
+        return df.repartition(plan["partitions"], *(partition_columns or []))
@@ -0,0 +1,262 @@
+"""
+Staged, concurrent ingestion: list -> fetch -> convert -> load.
+
+Each stage has its own pool of worker threads and hands its results to the
+next stage through a bounded queue, so file N+1 can be converting while
+file N is loading and a slow stage holds back the ones before it.
+"""
+import os
+import queue
+import threading
+import time
+
+from loguru import logger
+
+from source_connector import SourceConnector
+from data_process_ingest import GetLoadData
+
+STOP = object()
+
+
+class Stage:
+    """
+    A pool of worker threads that run a function on the items of an input
+    queue and put the results on an output queue. A function that returns
+    None drops the item. With fan_out the function returns an iterable and
+    every element of it is passed on.
+    """
+
+    def __init__(self, name: str, function, workers: int, input_queue: queue.Queue,
+                 output_queue: queue.Queue = None, fan_out: bool = False):
+        self.name = name
+        self.function = function
+        self.workers = max(int(workers), 1)
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.fan_out = fan_out
+
+        self.lock = threading.Lock()
+        self.threads: list = []
+        self.running = 0
+        self.items = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.started = None
+        self.finished = None
+
+    def start(self) -> None:
+        self.started = time.perf_counter()
+        self.running = self.workers
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self.work, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def join(self) -> None:
+        for thread in self.threads:
+            thread.join()
+
+    def work(self) -> None:
+        while True:
+            item = self.input_queue.get()
+            if item is STOP:
+                # Leave the marker for the other workers of this stage
+                self.input_queue.put(STOP)
+                self.worker_done()
+                return
+
+            start = time.perf_counter()
+            try:
+                result = self.function(item)
+                # Fanned out elements are passed on as they are produced, so
+                # a lazy listing fills the next queue page by page
+                for element in (result if self.fan_out else [result]):
+                    self.emit(element)
+                failed = False
+            except Exception as e:
+                logger.error(f"{self.name} failed for {item}: {e}")
+                failed = True
+            elapsed = time.perf_counter() - start
+
+            with self.lock:
+                self.items += 1
+                self.failures += failed
+                self.busy_seconds += elapsed
+
+    def emit(self, result) -> None:
+        if self.output_queue is not None and result is not None:
+            self.output_queue.put(result)
+
+    def worker_done(self) -> None:
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            self.finished = time.perf_counter()
+            if self.output_queue is not None:
+                self.output_queue.put(STOP)
+
+    def report(self) -> dict:
+        wall_seconds = (self.finished or time.perf_counter()) - self.started
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items": self.items,
+            "failures": self.failures,
+            "wall_seconds": round(wall_seconds, 3),
+            "busy_seconds": round(self.busy_seconds, 3),
+            "items_per_second": round(self.items / wall_seconds, 3) if wall_seconds else 0.0,
+            "seconds_per_item": round(self.busy_seconds / self.items, 3) if self.items else 0.0,
+            "utilization": round(self.busy_seconds / (wall_seconds * self.workers), 3)
+            if wall_seconds else 0.0,
+        }
+
+
+class IngestPipeline(SourceConnector):
+    """
+    Runs the files found by a GCPConnector through the list, fetch, convert
+    and load stages concurrently. Pool sizes come from fetch_workers,
+    convert_workers and load_workers, queue bounds from queue_size.
+    """
+
+    def __init__(self, connector):
+        super().__init__(connector.config_dict)
+        self.connector = connector
+        self.config_dict = connector.config_dict
+
+        if self.prop("write_mode", optional=True, default_value="driver") != "distributed":
+            raise ValueError(
+                "ingest_mode: pipelined requires write_mode: distributed")
+
+        self.queue_size = self.prop("queue_size", optional=True, default_value=4)
+        self.fetch_to_local = self.prop(
+            "fetch_to_local", optional=True, default_value=False)
+        self.fetch_dir = self.prop(
+            "fetch_dir", optional=True, default_value="./incoming")
+
+        self.session_manager = None
+        self.loader = None
+        self.local_index = None
+        self.similarity_index = None
+        self.stages: list = []
+        self.file_started: dict = {}
+
+    def list_files(self, download_file_paths: list):
+        """
+        Yields the files that still need to be ingested
+        :param download_file_paths: every file found by the connector
+        """
+        ignore_duplicates = self.prop("ignore_duplicates")
+        for gcp_path in download_file_paths:
+            if ignore_duplicates and self.connector.is_file_duplicate(gcp_path):
+                continue
+            yield gcp_path
+
+    def fetch(self, gcp_path: str) -> tuple:
+        """
+        Downloads a gs:// file to fetch_dir when fetch_to_local is set.
+        Otherwise the path is passed on and read by Spark where it is.
+        :param gcp_path: the local or gs:// path of the file
+        """
+        self.file_started[gcp_path] = time.perf_counter()
+        # Taken before the file is read, see GCPConnector.source_version
+        version = self.connector.source_version(gcp_path)
+        if not (self.fetch_to_local and gcp_path.startswith("gs://")):
+            return gcp_path, gcp_path, None
+
+        bucket_name, blob_name = gcp_path[len("gs://"):].split("/", 1)
+        os.makedirs(self.fetch_dir, exist_ok=True)
+        local_file_name = os.path.join(
+            self.fetch_dir, blob_name.replace("/", "_"))
+        # Pinned to the listed generation, so the generation that is marked
+        # ingested is the one that was downloaded
+        blob = self.connector.storage_client.bucket(bucket_name).blob(
+            blob_name, generation=int(version) if version else None)
+        with self.connector.metrics.timer(gcp_path, "fetch") as stage:
+            blob.download_to_filename(local_file_name)
+            stage["bytes_out"] = os.path.getsize(local_file_name)
+        return gcp_path, local_file_name, local_file_name
+
+    def convert(self, item: tuple) -> tuple:
+        gcp_path, local_file_name, fetched_file = item
+        load_data = self.get_load_data()
+        if load_data.streams_batches(local_file_name):
+            # Streamed into BigQuery while converting; nothing left to load
+            load_data.stream_file(local_file_name, source_file=gcp_path)
+            return gcp_path, fetched_file, None
+        parquet_file_path = load_data.convert_file(
+            local_file_name, source_file=gcp_path)
+        return gcp_path, fetched_file, parquet_file_path
+
+    def load(self, item: tuple) -> str:
+        gcp_path, fetched_file, parquet_file_path = item
+        consumed = []
+        if parquet_file_path is not None:
+            self.get_load_data().load_output(
+                parquet_file_path, gcp_path, [gcp_path],
+                source_version=self.connector.source_version(gcp_path))
+            consumed.append(parquet_file_path)
+        if fetched_file is not None:
+            consumed.append(fetched_file)
+        self.connector.update_and_clean(gcp_path, consumed)
+        started = self.file_started.pop(gcp_path, None)
+        if started is not None:
+            self.connector.metrics.record(gcp_path, "file", time.perf_counter() - started)
+        return gcp_path
+
+    def get_load_data(self) -> GetLoadData:
+        return GetLoadData(self.config_dict, session_manager=self.session_manager,
+                           loader=self.loader, state=self.connector.state,
+                           local_index=self.local_index,
+                           similarity_index=self.similarity_index,
+                           metrics=self.connector.metrics,
+                           deduplicator=self.connector.get_deduplicator(),
+                           source_version=self.connector.source_version)
+
+    def run(self, download_file_paths: list = None) -> list:
+        """
+        Ingests the files and returns the per stage throughput report
+        :param download_file_paths: the files to ingest, defaults to the
+            files found by the connector
+        """
+        if download_file_paths is None:
+            download_file_paths = self.connector.download_file_paths
+
+        list_queue = queue.Queue()
+        fetch_queue = queue.Queue(maxsize=self.queue_size)
+        convert_queue = queue.Queue(maxsize=self.queue_size)
+        load_queue = queue.Queue(maxsize=self.queue_size)
+
+        self.loader = self.loader or self.connector.get_loader()
+        self.local_index, self.similarity_index = self.connector.get_indexes()
+        with self.connector.spark_sessions() as session_manager:
+            self.session_manager = session_manager
+            self.stages = [
+                Stage("list", self.list_files, 1, list_queue, fetch_queue, fan_out=True),
+                Stage("fetch", self.fetch, self.prop(
+                    "fetch_workers", optional=True, default_value=2), fetch_queue, convert_queue),
+                Stage("convert", self.convert, self.prop(
+                    "convert_workers", optional=True, default_value=2), convert_queue, load_queue),
+                Stage("load", self.load, self.prop(
+                    "load_workers", optional=True, default_value=4), load_queue),
+            ]
+            for stage in self.stages:
+                stage.start()
+
+            list_queue.put(download_file_paths)
+            list_queue.put(STOP)
+            for stage in self.stages:
+                stage.join()
+
+        return self.report()
+
+    def report(self) -> list:
+        """
+        Logs and returns the throughput of every stage
+        """
+        reports = [stage.report() for stage in self.stages]
+        for stage_report in reports:
+            logger.info("Pipeline stage {stage}: {report}",
+                        stage=stage_report["stage"], report=stage_report)
+        return reports
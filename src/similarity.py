@@ -0,0 +1,247 @@
+"""
+Nearest neighbour search over the FP1-FP5 fingerprints.
+
+Fingerprints from the pipeline's Parquet outputs are stored as shards of
+(n, 2048) uint16 matrices in .npy files, memory-mapped when searched. Every
+input file adds one shard, so the index grows as files are ingested.
+Fingerprints hold counts, so Tanimoto is the continuous form
+a.b / (|a|^2 + |b|^2 - a.b), which equals the usual Tanimoto on 0/1 vectors.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+
+from source_connector import SourceConnector
+from bq_loader import find_parquet_files
+from fingerprint import FP_COLUMNS, FP_DTYPE, FP_LENGTH, decode_fingerprints, parse_fingerprints
+
+METRICS = ("tanimoto", "cosine")
+
+
+def scores_for(block: np.ndarray, block_norms: np.ndarray, queries: np.ndarray,
+               query_norms: np.ndarray, metric: str) -> np.ndarray:
+    """
+    Scores a block of fingerprints against all queries at once; returns a
+    (queries, block rows) matrix where higher is more similar
+    """
+    dot = queries @ block.astype(np.float32).T
+    if metric == "cosine":
+        denominator = np.sqrt(np.outer(query_norms, block_norms))
+    else:
+        denominator = query_norms[:, None] + block_norms[None, :] - dot
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.where(denominator > 0, dot / denominator, 0.0)
+    return scores.astype(np.float32)
+
+
+def top_k(scores: np.ndarray, k: int) -> tuple:
+    """
+    Returns the (indexes, scores) of the k best columns of every row, best first
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(np.float32)
+    indexes = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best = np.take_along_axis(scores, indexes, axis=1)
+    order = np.argsort(-best, axis=1)
+    return np.take_along_axis(indexes, order, axis=1), np.take_along_axis(best, order, axis=1)
+
+
+def shard_name_for(source_file: str) -> str:
+    """
+    Returns the shard name of an input file: its file name, readable, plus
+    a hash of the full path, so files with the same name in different
+    folders or buckets get their own shards
+    """
+    digest = hashlib.sha1(source_file.encode("utf8")).hexdigest()[:16]
+    return f"shard-{os.path.basename(source_file).replace('.', '_')}-{digest}"
+
+
+class FingerprintIndex(SourceConnector):
+    """
+    Sharded, memory-mapped fingerprint index under similarity_index_dir for
+    the columns in similarity_columns. Searches split every shard into
+    blocks of similarity_block_rows and score the blocks on a pool of
+    similarity_workers threads; NumPy releases the GIL in the matrix
+    products, so the blocks are scored in parallel.
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        self.index_dir = self.prop(
+            "similarity_index_dir", optional=True, default_value="./index/fingerprints")
+        self.columns = self.prop(
+            "similarity_columns", optional=True, default_value=["FP1"])
+        self.block_rows = self.prop(
+            "similarity_block_rows", optional=True, default_value=4096)
+        self.workers = self.prop(
+            "similarity_workers", optional=True, default_value=os.cpu_count() or 1)
+        unknown = set(self.columns) - set(FP_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown fingerprint columns: {sorted(unknown)}")
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.manifest_path = os.path.join(self.index_dir, "manifest.json")
+        self.lock = threading.Lock()
+        self.manifest = {"shards": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf8") as file:
+                self.manifest = json.load(file)
+        self.shards: dict = {}
+
+    def save_manifest(self) -> None:
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf8") as file:
+            json.dump(self.manifest, file)
+        os.replace(temporary_path, self.manifest_path)
+
+    def read_fingerprints(self, parquet_file_path) -> tuple:
+        """
+        Reads the IDs and fingerprint matrices from Parquet outputs in
+        either encoding; rows without a valid fingerprint are dropped
+        :param parquet_file_path: a path or a list of paths to Parquet files or folders
+        """
+        ids = []
+        matrices = {column: [] for column in self.columns}
+        for parquet_file in find_parquet_files(parquet_file_path):
+            for batch in pq.ParquetFile(parquet_file).iter_batches(
+                    columns=["ID"] + self.columns):
+                valid = np.ones(batch.num_rows, dtype=bool)
+                batch_matrices = {}
+                for column in self.columns:
+                    values = batch.column(column)
+                    if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+                        matrix, column_valid = parse_fingerprints(values.to_pylist())
+                    else:
+                        blobs = values.to_pylist()
+                        matrix = decode_fingerprints(blobs)
+                        column_valid = np.array([blob is not None for blob in blobs], dtype=bool)
+                    batch_matrices[column] = matrix
+                    valid &= column_valid
+                batch_ids = np.array(batch.column("ID").to_pylist(), dtype=object)
+                valid &= batch_ids != None  # noqa: E711
+                ids.append(batch_ids[valid])
+                for column in self.columns:
+                    matrices[column].append(batch_matrices[column][valid])
+
+        ids = np.concatenate(ids) if ids else np.empty(0, dtype=object)
+        return ids, {column: np.concatenate(parts) if parts else
+                     np.empty((0, FP_LENGTH), dtype=FP_DTYPE)
+                     for column, parts in matrices.items()}
+
+    def add_output(self, source_file: str, parquet_file_path) -> int:
+        """
+        Adds (or replaces) the shard for an input file. Returns the number
+        of fingerprints added.
+        :param source_file: the input file the outputs were converted from
+        :param parquet_file_path: a path or a list of paths to Parquet files or folders
+        """
+        ids, matrices = self.read_fingerprints(parquet_file_path)
+        shard_name = shard_name_for(source_file)
+        shard_dir = os.path.join(self.index_dir, shard_name)
+        temporary_dir = shard_dir + ".tmp"
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        os.makedirs(temporary_dir)
+
+        np.save(os.path.join(temporary_dir, "ids.npy"), ids.astype(str))
+        for column, matrix in matrices.items():
+            np.save(os.path.join(temporary_dir, f"{column}.npy"), matrix)
+            norms = np.square(matrix, dtype=np.float64).sum(axis=1).astype(np.float32)
+            np.save(os.path.join(temporary_dir, f"{column}.norms.npy"), norms)
+
+        with self.lock:
+            # Shards of the same file kept under another name, e.g. before
+            # shard names included the path hash
+            for old_name, shard in list(self.manifest["shards"].items()):
+                if shard["source_file"] == source_file and old_name != shard_name:
+                    shutil.rmtree(os.path.join(self.index_dir, old_name), ignore_errors=True)
+                    del self.manifest["shards"][old_name]
+                    for column in self.columns:
+                        self.shards.pop((old_name, column), None)
+            shutil.rmtree(shard_dir, ignore_errors=True)
+            os.rename(temporary_dir, shard_dir)
+            self.manifest["shards"][shard_name] = {
+                "source_file": source_file, "rows": int(len(ids))}
+            self.save_manifest()
+            for column in self.columns:
+                self.shards.pop((shard_name, column), None)
+
+        logger.info("Added {rows} fingerprints from {file} to the similarity index",
+                    rows=len(ids), file=source_file)
+        return len(ids)
+
+    def load_shard(self, shard_name: str, column: str) -> tuple:
+        """
+        Memory-maps the ids, fingerprints and norms of a shard
+        """
+        key = (shard_name, column)
+        if key not in self.shards:
+            shard_dir = os.path.join(self.index_dir, shard_name)
+            self.shards[key] = (
+                np.load(os.path.join(shard_dir, "ids.npy"), mmap_mode="r"),
+                np.load(os.path.join(shard_dir, f"{column}.npy"), mmap_mode="r"),
+                np.load(os.path.join(shard_dir, f"{column}.norms.npy"), mmap_mode="r"),
+            )
+        return self.shards[key]
+
+    def search(self, queries, k: int = 10, metric: str = "tanimoto", column: str = None) -> list:
+        """
+        Returns, for every query fingerprint, the k most similar IDs as a
+        list of (id, score) pairs, best first
+        :param queries: comma separated strings, or an array of shape (2048,) or (q, 2048)
+        :param k: the number of neighbours per query
+        :param metric: tanimoto or cosine
+        :param column: the fingerprint column to search, defaults to the first indexed one
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric '{metric}', expected one of {METRICS}")
+        column = column or self.columns[0]
+        if column not in self.columns:
+            raise ValueError(f"Column {column} is not indexed")
+
+        if isinstance(queries, str) or (isinstance(queries, list) and queries
+                                        and isinstance(queries[0], str)):
+            matrix, valid = parse_fingerprints([queries] if isinstance(queries, str) else queries)
+            if not valid.all():
+                raise ValueError("Query fingerprints must hold 2048 values in 0..1000")
+            queries = matrix
+        queries = np.atleast_2d(np.asarray(queries)).astype(np.float32)
+        query_norms = np.square(queries).sum(axis=1)
+
+        with self.lock:
+            shard_names = list(self.manifest["shards"])
+        blocks = []
+        for shard_name in shard_names:
+            ids, matrix, norms = self.load_shard(shard_name, column)
+            for start in range(0, len(ids), self.block_rows):
+                blocks.append((ids, matrix, norms, start, min(start + self.block_rows, len(ids))))
+
+        def score_block(block):
+            ids, matrix, norms, start, stop = block
+            scores = scores_for(matrix[start:stop], norms[start:stop],
+                                queries, query_norms, metric)
+            indexes, best = top_k(scores, k)
+            return ids[start:stop][indexes], best
+
+        candidate_ids = [np.empty((len(queries), 0), dtype=str)]
+        candidate_scores = [np.empty((len(queries), 0), dtype=np.float32)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for block_ids, block_scores in executor.map(score_block, blocks):
+                candidate_ids.append(block_ids)
+                candidate_scores.append(block_scores)
+
+        all_ids = np.concatenate(candidate_ids, axis=1)
+        all_scores = np.concatenate(candidate_scores, axis=1)
+        indexes, best = top_k(all_scores, k)
+        best_ids = np.take_along_axis(all_ids, indexes, axis=1)
+        return [[(str(target_id), float(score)) for target_id, score in zip(row_ids, row_scores)]
+                for row_ids, row_scores in zip(best_ids, best)]
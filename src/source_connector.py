@@ -58,3 +58,20 @@ class SourceConnector(ABC):
         if prop is None:
             prop = default_value
         return prop
+
+
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+
+
+def parse_size(size) -> int:
+    """
+    Converts a size from the config, e.g. 100MB or 1.5GB, to a number of bytes
+    :param size: a number of bytes or a string with a B, KB, MB, GB or TB suffix
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    text = str(size).strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)].strip()) * SIZE_UNITS[unit])
+    return int(float(text))
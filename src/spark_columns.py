@@ -0,0 +1,77 @@
+"""
+Spark schema and column expressions of the Spark conversion path. Kept
+apart from data_process_ingest so pyspark is only imported when a file is
+actually converted with Spark.
+"""
+import os
+from urllib.parse import quote
+
+import pandas as pd
+from pyspark.sql.functions import (col, concat_ws, exists, input_file_name, lit, pandas_udf,
+                                   size, split, when)
+from pyspark.sql.types import BinaryType, FloatType, StringType, StructField, StructType
+
+from fingerprint import FP_COLUMNS, FP_LENGTH, FP_MAX_VALUE, encode_fingerprints
+from validation import FINGERPRINT_PATTERN, NUMERIC_COLUMNS
+
+SCHEMA = StructType([
+    StructField("ID", StringType(), False),
+    StructField("Library_ID", StringType()),
+    StructField("Sub_ID_1", StringType()),
+    StructField("Sub_ID_2", StringType()),
+    StructField("Sub_ID_3", StringType()),
+    StructField("MW", FloatType()),
+    StructField("LogP", FloatType()),
+    StructField("FP1", StringType()),
+    StructField("FP2", StringType()),
+    StructField("FP3", StringType()),
+    StructField("FP4", StringType()),
+    StructField("FP5", StringType()),
+])
+
+
+@pandas_udf(BinaryType())
+def encode_fingerprint_column(values: pd.Series) -> pd.Series:
+    """
+    Packs a column of comma separated fingerprints into 4096 byte values
+    """
+    return pd.Series(encode_fingerprints(values.where(values.notna(), None)))
+
+
+def validation_reasons(required_columns: list):
+    """
+    Returns a column with the "; " separated reasons a row of string
+    columns is invalid, empty for valid rows. The checks are those of
+    validation.RowValidator.
+    :param required_columns: the columns that must not be null
+    """
+    checks = [when(col(column).isNull(), lit(f"{column} is missing"))
+              for column in required_columns]
+    checks += [when(col(column).isNotNull() & col(column).cast(FloatType()).isNull(),
+                    lit(f"{column} is not a number"))
+               for column in NUMERIC_COLUMNS]
+    for column in FP_COLUMNS:
+        values = split(col(column), ",")
+        checks.append(when(col(column).isNotNull() & (size(values) != FP_LENGTH),
+                           lit(f"{column} does not have {FP_LENGTH} values")))
+        checks.append(when(col(column).isNotNull() & (
+            ~col(column).rlike(FINGERPRINT_PATTERN)
+            | exists(values, lambda value: value.cast("int") > FP_MAX_VALUE)),
+            lit(f"{column} has values outside 0..{FP_MAX_VALUE}")))
+    # concat_ws skips the nulls of the checks that passed
+    return concat_ws("; ", *checks)
+
+
+def source_file_column(filenames: list):
+    """
+    Returns a column with the input file of every row, as it is named in
+    filenames. Spark reports the file as a URI, which may be URL encoded.
+    """
+    path = input_file_name()
+    source = lit(None).cast(StringType())
+    for filename in filenames:
+        suffix = filename[len("gs://"):] if filename.startswith("gs://") \
+            else os.path.abspath(filename)
+        source = when(path.endswith(suffix) | path.endswith(quote(suffix)),
+                      lit(filename)).otherwise(source)
+    return source
@@ -0,0 +1,91 @@
+"""
+Long-lived SparkSession shared by every file processed in a run
+"""
+import threading
+import time
+
+from loguru import logger
+from pyspark.sql import SparkSession
+
+from source_connector import SourceConnector
+
+GCS_CONNECTOR_JAR = "https://storage.googleapis.com/hadoop-lib/gcs/gcs-connector-hadoop3-latest.jar"
+
+
+class SparkSessionManager(SourceConnector):
+    """
+    Owns a single SparkSession for the whole run and hands it to every
+    file's conversion. The session is only stopped once, at the end.
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        self.spark = None
+        self.startup_seconds = 0.0
+        self.sessions_served = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def build_session(self) -> SparkSession:
+        """
+        Build the SparkSession from the connector config
+        """
+        spark = SparkSession.builder \
+            .appName("example") \
+            .config("spark.executor.memory", self.prop("executor_memory", 4)) \
+            .config("spark.executor.memoryOverhead", self.prop("executor_memoryOverhea", 2)) \
+            .config("spark.driver.memory", self.prop("driver_memory", 4)) \
+            .config("spark.jars", GCS_CONNECTOR_JAR)\
+            .getOrCreate()
+        logger.info(
+            "Spark Session created: {info}", info="Spark Session created")
+
+        conf = spark.sparkContext.getConf()
+        logger.info("Executor Memory: {memory}",
+                    memory=conf.get("spark.executor.memory", "Not specified"))
+        logger.info("Driver Memory: {memory}",
+                    memory=conf.get("spark.driver.memory", "Not specified"))
+        return spark
+
+    def get_session(self) -> SparkSession:
+        """
+        Returns the shared session, starting it on first use
+        """
+        with self.lock:
+            if self.spark is None:
+                start = time.perf_counter()
+                self.spark = self.build_session()
+                self.startup_seconds = time.perf_counter() - start
+                logger.info("Spark startup took {seconds:.2f}s",
+                            seconds=self.startup_seconds)
+            self.sessions_served += 1
+            return self.spark
+
+    def stop(self) -> None:
+        """
+        Stops the shared session and reports the startup time saved by reuse
+        """
+        if self.spark is None:
+            return
+        self.spark.stop()
+        self.spark = None
+        self.report_savings()
+
+    def report_savings(self) -> dict:
+        """
+        Estimates the startup time saved compared to one session per file
+        """
+        reused = max(self.sessions_served - 1, 0)
+        report = {
+            "startup_seconds": round(self.startup_seconds, 3),
+            "files_served": self.sessions_served,
+            "sessions_avoided": reused,
+            "seconds_saved": round(reused * self.startup_seconds, 3),
+        }
+        logger.info("Spark session reuse: {report}", report=report)
+        return report
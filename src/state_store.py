@@ -0,0 +1,412 @@
+"""
+Pluggable backends for the record of files that have already been processed,
+and for the checkpoints of files that are part way through
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import yaml
+from loguru import logger
+
+
+class StateStore(ABC):
+    """
+    Base class for the persistence backends. Duplicate checks are O(1) and
+    marking a file as processed only writes that one file. Backends are
+    safe to share between the worker threads of the ingest pipeline.
+    """
+
+    @abstractmethod
+    def is_processed(self, file_name: str) -> bool:
+        """
+        Detect whether a file has been downloaded and ingested before
+        :param file_name: the name of the file to be checked
+        """
+
+    @abstractmethod
+    def mark_processed(self, file_name: str) -> None:
+        """
+        Durably records a file as processed
+        :param file_name: the name of the file that was consumed
+        """
+
+    @abstractmethod
+    def processed_files(self) -> list:
+        """
+        Returns every file recorded as processed
+        """
+
+    @abstractmethod
+    def record_checkpoint(self, file_name: str, kind: str, key: str, value: str = "") -> None:
+        """
+        Durably records a finished unit of work for a file that is not done
+        yet, such as a written Parquet output or a successful load job
+        :param file_name: the input file the work belongs to
+        :param kind: the kind of work, e.g. output or load
+        :param key: identifies the unit of work within the file
+        :param value: extra information about the unit, e.g. its path
+        """
+
+    @abstractmethod
+    def checkpoints(self, file_name: str, kind: str) -> dict:
+        """
+        Returns the recorded units of a kind for a file, as a key -> value dict
+        :param file_name: the input file the work belongs to
+        :param kind: the kind of work, e.g. output or load
+        """
+
+    @abstractmethod
+    def clear_checkpoints(self, file_name: str) -> None:
+        """
+        Forgets the checkpoints of a file once it is fully processed
+        :param file_name: the input file the work belongs to
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class YamlStateStore(StateStore):
+    """
+    The original backend: a YAML file with a download_file_list, rewritten
+    in full on every update. Kept for small runs and as a migration source.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.path = path
+        file_path = Path(path)
+        os.makedirs(file_path.parent, exist_ok=True)
+        file_path.touch(exist_ok=True)
+
+        with open(path, "r", encoding="utf8") as file:
+            self.persistent_data = yaml.safe_load(file) or {}
+        if not self.persistent_data.get("download_file_list"):
+            self.persistent_data["download_file_list"] = []
+        if not self.persistent_data.get("checkpoints"):
+            self.persistent_data["checkpoints"] = {}
+        self.seen = set(self.persistent_data["download_file_list"])
+
+    def save(self) -> None:
+        with open(self.path, "w", encoding="utf8") as file:
+            yaml.safe_dump(self.persistent_data, file)
+
+    def is_processed(self, file_name: str) -> bool:
+        return file_name in self.seen
+
+    def mark_processed(self, file_name: str) -> None:
+        with self.lock:
+            if file_name in self.seen:
+                return
+            self.seen.add(file_name)
+            self.persistent_data["download_file_list"].append(file_name)
+            self.save()
+
+    def processed_files(self) -> list:
+        with self.lock:
+            return list(self.persistent_data["download_file_list"])
+
+    def record_checkpoint(self, file_name: str, kind: str, key: str, value: str = "") -> None:
+        with self.lock:
+            file_checkpoints = self.persistent_data["checkpoints"].setdefault(file_name, {})
+            file_checkpoints.setdefault(kind, {})[key] = value
+            self.save()
+
+    def checkpoints(self, file_name: str, kind: str) -> dict:
+        with self.lock:
+            return dict(self.persistent_data["checkpoints"].get(file_name, {}).get(kind, {}))
+
+    def clear_checkpoints(self, file_name: str) -> None:
+        with self.lock:
+            if self.persistent_data["checkpoints"].pop(file_name, None) is not None:
+                self.save()
+
+
+def read_log_lines(path: str, truncate: bool = False) -> list:
+    """
+    Returns the complete lines of an append-only log. A last line without a
+    newline was cut off by a crash while it was appended and is dropped.
+    :param path: the log file, which may not exist
+    :param truncate: also cut the torn line off the file, so the next
+        append starts on a line of its own
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as file:
+        data = file.read()
+    complete = data.rfind(b"\n") + 1
+    if complete < len(data):
+        logger.warning("Dropping the torn last line of {path}", path=path)
+        if truncate:
+            with open(path, "r+b") as file:
+                file.truncate(complete)
+    return data[:complete].decode("utf8").splitlines()
+
+
+class AppendLogStateStore(StateStore):
+    """
+    Append-only log with one file name per line, mirrored in a hash set.
+    Checkpoints go to a second append-only log of JSON lines next to it,
+    which is compacted to the checkpoints that are still set on open.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.path = path
+        os.makedirs(Path(path).parent, exist_ok=True)
+        self.seen = set()
+        self.order = []
+        for file_name in read_log_lines(path, truncate=True):
+            if file_name and file_name not in self.seen:
+                self.seen.add(file_name)
+                self.order.append(file_name)
+        self.log = open(path, "a", encoding="utf8")
+
+        self.checkpoint_path = path + ".checkpoints"
+        self.file_checkpoints: dict = {}
+        lines = [line for line in read_log_lines(self.checkpoint_path, truncate=True)
+                 if line.strip()]
+        for line in lines:
+            try:
+                self.apply_checkpoint(json.loads(line))
+            except (ValueError, KeyError):
+                logger.warning("Skipping an unreadable line of {path}: {line}",
+                               path=self.checkpoint_path, line=line[:200])
+        entries = self.checkpoint_entries()
+        if len(entries) < len(lines):
+            self.compact(entries)
+        self.checkpoint_log = open(self.checkpoint_path, "a", encoding="utf8")
+
+    def checkpoint_entries(self) -> list:
+        return [{"file": file_name, "kind": kind, "key": key, "value": value}
+                for file_name, kinds in self.file_checkpoints.items()
+                for kind, values in kinds.items()
+                for key, value in values.items()]
+
+    def compact(self, entries: list) -> None:
+        """
+        Replaces the checkpoint log with one line per checkpoint that is
+        still set, dropping cleared files, overwritten values and torn lines
+        """
+        temporary_path = self.checkpoint_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf8") as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def apply_checkpoint(self, entry: dict) -> None:
+        if entry.get("clear"):
+            self.file_checkpoints.pop(entry["file"], None)
+            return
+        file_checkpoints = self.file_checkpoints.setdefault(entry["file"], {})
+        file_checkpoints.setdefault(entry["kind"], {})[entry["key"]] = entry["value"]
+
+    def append(self, log, line: str) -> None:
+        log.write(line + "\n")
+        log.flush()
+        os.fsync(log.fileno())
+
+    def is_processed(self, file_name: str) -> bool:
+        return file_name in self.seen
+
+    def mark_processed(self, file_name: str) -> None:
+        with self.lock:
+            if file_name in self.seen:
+                return
+            self.seen.add(file_name)
+            self.order.append(file_name)
+            self.append(self.log, file_name)
+
+    def processed_files(self) -> list:
+        with self.lock:
+            return list(self.order)
+
+    def record_checkpoint(self, file_name: str, kind: str, key: str, value: str = "") -> None:
+        with self.lock:
+            entry = {"file": file_name, "kind": kind, "key": key, "value": value}
+            self.apply_checkpoint(entry)
+            self.append(self.checkpoint_log, json.dumps(entry))
+
+    def checkpoints(self, file_name: str, kind: str) -> dict:
+        with self.lock:
+            return dict(self.file_checkpoints.get(file_name, {}).get(kind, {}))
+
+    def clear_checkpoints(self, file_name: str) -> None:
+        with self.lock:
+            if file_name in self.file_checkpoints:
+                entry = {"file": file_name, "clear": True}
+                self.apply_checkpoint(entry)
+                self.append(self.checkpoint_log, json.dumps(entry))
+
+    def close(self) -> None:
+        with self.lock:
+            self.log.close()
+            self.checkpoint_log.close()
+
+
+class SQLiteStateStore(StateStore):
+    """
+    SQLite table of processed files, mirrored in a hash set
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.path = path
+        os.makedirs(Path(path).parent, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed_files ("
+            "file_name TEXT PRIMARY KEY, processed_at REAL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "file_name TEXT, kind TEXT, key TEXT, value TEXT, "
+            "PRIMARY KEY (file_name, kind, key))")
+        self.connection.commit()
+        self.seen = {row[0] for row in self.connection.execute(
+            "SELECT file_name FROM processed_files")}
+
+    def is_processed(self, file_name: str) -> bool:
+        return file_name in self.seen
+
+    def mark_processed(self, file_name: str) -> None:
+        with self.lock:
+            self.mark_many([file_name])
+
+    def mark_many(self, file_names: list) -> None:
+        """
+        Records several files in a single transaction
+        :param file_names: the names of the files that were consumed
+        """
+        with self.lock:
+            new_files = [name for name in file_names if name not in self.seen]
+            if not new_files:
+                return
+            now = time.time()
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO processed_files VALUES (?, ?)",
+                    [(name, now) for name in new_files])
+            self.seen.update(new_files)
+
+    def processed_files(self) -> list:
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT file_name FROM processed_files ORDER BY processed_at, rowid")]
+
+    def record_checkpoint(self, file_name: str, kind: str, key: str, value: str = "") -> None:
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+                    (file_name, kind, key, value))
+
+    def checkpoints(self, file_name: str, kind: str) -> dict:
+        with self.lock:
+            return dict(self.connection.execute(
+                "SELECT key, value FROM checkpoints WHERE file_name = ? AND kind = ?",
+                (file_name, kind)))
+
+    def clear_checkpoints(self, file_name: str) -> None:
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "DELETE FROM checkpoints WHERE file_name = ?", (file_name,))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+STATE_BACKENDS = {
+    "yaml": YamlStateStore,
+    "log": AppendLogStateStore,
+    "sqlite": SQLiteStateStore,
+}
+
+
+def migrate_yaml_state(yaml_path: str, store: StateStore) -> int:
+    """
+    Copies the download_file_list of an existing YAML persistence file into
+    another backend. Files already in the store are skipped, so running it
+    twice is harmless. Returns the number of files copied.
+    :param yaml_path: path to the existing download_data.yaml
+    :param store: the backend to copy into
+    """
+    if not os.path.exists(yaml_path):
+        return 0
+    with open(yaml_path, "r", encoding="utf8") as file:
+        persistent_data = yaml.safe_load(file) or {}
+
+    file_names = [name for name in persistent_data.get("download_file_list") or []
+                  if not store.is_processed(name)]
+    if isinstance(store, SQLiteStateStore):
+        store.mark_many(file_names)
+    else:
+        for file_name in file_names:
+            store.mark_processed(file_name)
+    logger.info("Migrated {count} processed files from {path}",
+                count=len(file_names), path=yaml_path)
+    return len(file_names)
+
+
+def open_state_store(backend: str, state_path: str, yaml_path: str = None) -> StateStore:
+    """
+    Opens the configured backend. A backend that is opened for the first
+    time is seeded from the YAML persistence file, if there is one.
+    :param backend: one of yaml, log or sqlite
+    :param state_path: where the log or sqlite backend keeps its data
+    :param yaml_path: the YAML persistence file, used by the yaml backend and
+        as the migration source for the others
+    """
+    try:
+        store_class = STATE_BACKENDS[backend]
+    except KeyError as exc:
+        raise ValueError(
+            f"Unknown state_backend '{backend}', expected one of {sorted(STATE_BACKENDS)}"
+        ) from exc
+
+    if store_class is YamlStateStore:
+        return YamlStateStore(yaml_path)
+
+    first_open = not os.path.exists(state_path)
+    store = store_class(state_path)
+    if first_open and yaml_path:
+        migrate_yaml_state(yaml_path, store)
+    return store
+
+
+def read_processed_files(backend: str, state_path: str, yaml_path: str = None) -> list:
+    """
+    Returns the processed files recorded by a backend without opening it
+    for writing, so no file is created and nothing is migrated, e.g. for
+    reporting on a running pipeline
+    :param backend: one of yaml, log or sqlite
+    :param state_path: where the log or sqlite backend keeps its data
+    :param yaml_path: the YAML persistence file of the yaml backend
+    """
+    if backend not in STATE_BACKENDS:
+        raise ValueError(
+            f"Unknown state_backend '{backend}', expected one of {sorted(STATE_BACKENDS)}")
+    path = yaml_path if backend == "yaml" else state_path
+    if not path or not os.path.exists(path):
+        return []
+
+    if backend == "yaml":
+        with open(path, "r", encoding="utf8") as file:
+            return list((yaml.safe_load(file) or {}).get("download_file_list") or [])
+    if backend == "log":
+        return list(dict.fromkeys(line for line in read_log_lines(path) if line.strip()))
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return [row[0] for row in connection.execute(
+            "SELECT file_name FROM processed_files ORDER BY processed_at, rowid")]
+    finally:
+        connection.close()
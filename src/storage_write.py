@@ -0,0 +1,338 @@
+"""
+Loader that streams Arrow record batches into BigQuery through the Storage
+Write API instead of running load jobs
+"""
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types, writer
+from google.oauth2 import service_account
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+from bq_loader import BigQueryBulkLoader, find_parquet_files
+from fingerprint import FP_COLUMNS, BINARY_ENCODING
+
+STREAM_TYPES = {
+    "pending": types.WriteStream.Type.PENDING,
+    "committed": types.WriteStream.Type.COMMITTED,
+}
+# AppendRows requests are limited to 10 MB
+MAX_REQUEST_BYTES = 9 * 1024 * 1024
+# Newer clients accept serialized Arrow record batches; 2.23 only has proto_rows
+ARROW_ROWS = "arrow_rows" in types.AppendRowsRequest.meta.fields
+ARROW_TYPES = {
+    descriptor_pb2.FieldDescriptorProto.TYPE_STRING: pa.string(),
+    descriptor_pb2.FieldDescriptorProto.TYPE_BYTES: pa.binary(),
+    descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE: pa.float64(),
+}
+
+
+def row_descriptor(fingerprint_encoding: str) -> descriptor_pb2.DescriptorProto:
+    """
+    Returns the proto2 message matching the table schema. Clients without
+    arrow_rows (such as 2.23) only accept protocol buffer rows, so Arrow rows
+    are converted to it.
+    :param fingerprint_encoding: text or binary
+    """
+    fingerprint_type = descriptor_pb2.FieldDescriptorProto.TYPE_BYTES \
+        if fingerprint_encoding == BINARY_ENCODING \
+        else descriptor_pb2.FieldDescriptorProto.TYPE_STRING
+    types_by_column = {
+        "ID": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+        "Library_ID": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+        "Sub_ID_1": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+        "Sub_ID_2": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+        "Sub_ID_3": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+        "MW": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+        "LogP": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+    }
+    types_by_column.update({column: fingerprint_type for column in FP_COLUMNS})
+
+    descriptor = descriptor_pb2.DescriptorProto(name="IngestRow")
+    for number, (column, field_type) in enumerate(types_by_column.items(), 1):
+        descriptor.field.add(name=column, number=number, type=field_type,
+                             label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL)
+    return descriptor
+
+
+def row_message_class(descriptor: descriptor_pb2.DescriptorProto):
+    file_descriptor = descriptor_pb2.FileDescriptorProto(
+        name="ingest_row.proto", package="ingest", syntax="proto2")
+    file_descriptor.message_type.add().CopyFrom(descriptor)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_descriptor)
+    return message_factory.GetMessageClass(pool.FindMessageTypeByName("ingest.IngestRow"))
+
+
+def arrow_schema(descriptor: descriptor_pb2.DescriptorProto) -> pa.Schema:
+    """
+    Returns the Arrow schema with the same columns and types as the row message
+    """
+    return pa.schema([pa.field(field.name, ARROW_TYPES[field.type])
+                      for field in descriptor.field])
+
+
+class StorageWriteLoader(BigQueryBulkLoader):
+    """
+    Appends rows to the table over the Storage Write API, so data does not
+    have to be staged as Parquet and no load job has to be scheduled.
+
+    With storage_write_stream_type pending (the default) all rows of an input
+    file are appended to one pending stream that is committed atomically at
+    the end. The stream name and its state are checkpointed, so a restarted
+    file commits a finalized stream instead of appending it again, and a
+    stream that was already committed is skipped. With committed, rows are
+    visible as soon as they are appended; every append carries its offset
+    and the acknowledged offset is checkpointed, so a restart resumes the
+    same stream after the rows it already holds.
+
+    At most storage_write_inflight requests are in flight at once. Where the
+    client supports it, record batches are appended as serialized Arrow
+    (arrow_rows); otherwise every row is converted to a protocol buffer.
+    """
+
+    def __init__(self, config_dict: dict, metrics=None, client=None, storage_client=None,
+                 write_client: bigquery_storage_v1.BigQueryWriteClient = None):
+        super().__init__(config_dict, metrics=metrics, client=client,
+                         storage_client=storage_client)
+        stream_type = self.prop(
+            "storage_write_stream_type", optional=True, default_value="pending")
+        if stream_type not in STREAM_TYPES:
+            raise ValueError(f"Unknown storage_write_stream_type '{stream_type}', "
+                             f"expected one of {sorted(STREAM_TYPES)}")
+        self.stream_type = stream_type
+        self.inflight = self.prop("storage_write_inflight", optional=True, default_value=8)
+        self.batch_rows = self.prop("storage_write_batch_rows", optional=True, default_value=2000)
+
+        if write_client is None:
+            credentials = service_account.Credentials.from_service_account_file(
+                self.prop("key_path"), scopes=[
+                    "https://www.googleapis.com/auth/cloud-platform"],
+            )
+            write_client = bigquery_storage_v1.BigQueryWriteClient(credentials=credentials)
+        self.write_client = write_client
+
+        self.descriptor = row_descriptor(self.fingerprint_encoding)
+        self.row_class = row_message_class(self.descriptor)
+        self.row_fields = set(self.row_class.DESCRIPTOR.fields_by_name)
+        self.arrow_rows = ARROW_ROWS
+        self.schema = arrow_schema(self.descriptor)
+
+    def serialize(self, batch: pa.RecordBatch) -> list:
+        """
+        Converts a record batch to serialized protocol buffer rows. This
+        runs in Python, one to_pylist row and one setattr per value at a
+        time, so it is CPU-bound and usually slower than the append calls.
+        """
+        message = self.row_class()
+        serialized_rows = []
+        for row in batch.to_pylist():
+            message.Clear()
+            for column, value in row.items():
+                if value is not None and column in self.row_fields:
+                    setattr(message, column, value)
+            serialized_rows.append(message.SerializeToString())
+        return serialized_rows
+
+    def conform(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        """
+        Returns the batch with the table's columns and types, missing
+        columns as nulls, for appending as Arrow
+        """
+        columns = [batch.column(field.name).cast(field.type)
+                   if field.name in batch.schema.names
+                   else pa.nulls(batch.num_rows, type=field.type)
+                   for field in self.schema]
+        return pa.RecordBatch.from_arrays(columns, schema=self.schema)
+
+    def arrow_chunks(self, batch: pa.RecordBatch):
+        """
+        Yields slices of a conformed batch that serialize to at most
+        MAX_REQUEST_BYTES
+        """
+        rows = max(int(batch.num_rows * MAX_REQUEST_BYTES / max(batch.nbytes, 1)), 1)
+        for start in range(0, batch.num_rows, rows):
+            yield batch.slice(start, rows)
+
+    def requests(self, batches, skip_rows: int = 0):
+        """
+        Yields (offset, rows, payload) chunks of at most MAX_REQUEST_BYTES.
+        The payload is a serialized Arrow record batch with arrow_rows,
+        otherwise a list of serialized protocol buffer rows.
+        :param batches: record batches in the table's column layout
+        :param skip_rows: rows at the start that the stream already holds
+        """
+        offset = 0
+        chunk, chunk_bytes, chunk_offset = [], 0, 0
+        for batch in batches:
+            if offset + batch.num_rows <= skip_rows:
+                offset += batch.num_rows
+                continue
+            if self.arrow_rows:
+                # Cast before slicing: pyarrow 14 crashes casting a sliced
+                # fixed size binary column
+                batch = self.conform(batch)
+            if offset < skip_rows:
+                batch = batch.slice(skip_rows - offset)
+                offset = skip_rows
+            if self.arrow_rows:
+                for chunk_batch in self.arrow_chunks(batch):
+                    yield offset, chunk_batch.num_rows, chunk_batch.serialize().to_pybytes()
+                    offset += chunk_batch.num_rows
+                continue
+            for serialized_row in self.serialize(batch):
+                if chunk and chunk_bytes + len(serialized_row) > MAX_REQUEST_BYTES:
+                    yield chunk_offset, len(chunk), chunk
+                    chunk, chunk_bytes = [], 0
+                if not chunk:
+                    chunk_offset = offset
+                chunk.append(serialized_row)
+                chunk_bytes += len(serialized_row)
+                offset += 1
+        if chunk:
+            yield chunk_offset, len(chunk), chunk
+
+    def append_request(self, offset: int, rows: int, payload) -> types.AppendRowsRequest:
+        request = types.AppendRowsRequest(offset=offset)
+        if self.arrow_rows:
+            request.arrow_rows = types.AppendRowsRequest.ArrowData(
+                rows=types.ArrowRecordBatch(serialized_record_batch=payload, row_count=rows))
+        else:
+            request.proto_rows = types.AppendRowsRequest.ProtoData(
+                rows=types.ProtoRows(serialized_rows=payload))
+        return request
+
+    def open_stream(self, parent: str, source_file: str = None, state=None) -> tuple:
+        """
+        Returns (stream name, rows already in the stream, already committed)
+        for the file, resuming a checkpointed stream where that is safe
+        """
+        checkpoint = {}
+        if state is not None and source_file is not None:
+            checkpoint = state.checkpoints(source_file, "stream")
+
+        name = checkpoint.get("name")
+        if name and self.stream_type == "pending":
+            if checkpoint.get("committed") or \
+                    self.write_client.get_write_stream(name=name).commit_time:
+                return name, 0, True
+            if checkpoint.get("finalized"):
+                # Every row was appended before the stream was finalized, so
+                # it only has to be committed
+                return name, int(checkpoint["finalized"]), False
+        elif name:
+            return name, int(checkpoint.get("finalized") or checkpoint.get("offset", 0)), False
+
+        stream = self.write_client.create_write_stream(
+            parent=parent, write_stream=types.WriteStream(type_=STREAM_TYPES[self.stream_type]))
+        if state is not None and source_file is not None:
+            state.record_checkpoint(source_file, "stream", "name", stream.name)
+        return stream.name, 0, False
+
+    def append(self, stream_name: str, batches, skip_rows: int = 0,
+               source_file: str = None, state=None) -> int:
+        """
+        Appends the rows to the stream and returns the number appended
+        """
+        template = types.AppendRowsRequest(write_stream=stream_name)
+        if self.arrow_rows:
+            template.arrow_rows = types.AppendRowsRequest.ArrowData(
+                writer_schema=types.ArrowSchema(
+                    serialized_schema=self.schema.serialize().to_pybytes()))
+        else:
+            template.proto_rows = types.AppendRowsRequest.ProtoData(
+                writer_schema=types.ProtoSchema(proto_descriptor=self.descriptor))
+        append_stream = writer.AppendRowsStream(self.write_client, template)
+
+        pending = []
+        appended = 0
+
+        def acknowledge(offset, rows, future):
+            try:
+                future.result()
+            except AlreadyExists:
+                # Rows at this offset were appended by an earlier attempt
+                pass
+            if self.stream_type == "committed" and state is not None and source_file is not None:
+                state.record_checkpoint(source_file, "stream", "offset", str(offset + rows))
+
+        try:
+            for offset, rows, payload in self.requests(batches, skip_rows):
+                request = self.append_request(offset, rows, payload)
+                pending.append((offset, rows, append_stream.send(request)))
+                appended += rows
+                if len(pending) >= self.inflight:
+                    acknowledge(*pending.pop(0))
+            for item in pending:
+                acknowledge(*item)
+        finally:
+            append_stream.close()
+        return appended
+
+    def load_batches(self, batches, table_name: str = None, source_file: str = None,
+                     state=None) -> int:
+        """
+        Streams record batches into the table and returns the number of rows
+        written by this call
+        :param batches: an iterable of record batches with the table's columns
+        :param table_name: overrides bq_table_name from the config
+        :param source_file: the input file the rows come from
+        :param state: the StateStore that holds the stream checkpoints
+        """
+        table_id = self.table_id(table_name)
+        self.get_table(table_id)
+        project, dataset, table = table_id.split(".")
+        parent = self.write_client.table_path(project, dataset, table)
+
+        start = time.perf_counter()
+        stream_name, skip_rows, committed = self.open_stream(parent, source_file, state)
+        if committed:
+            logger.info("Stream {stream} for {file} was already committed",
+                        stream=stream_name, file=source_file)
+            return 0
+
+        checkpointed = state is not None and source_file is not None
+        finalized = checkpointed and state.checkpoints(source_file, "stream").get("finalized")
+        rows = 0
+        if not finalized:
+            rows = self.append(stream_name, batches, skip_rows, source_file, state)
+            self.write_client.finalize_write_stream(name=stream_name)
+            if checkpointed:
+                state.record_checkpoint(source_file, "stream", "finalized", str(skip_rows + rows))
+
+        if self.stream_type == "pending":
+            response = self.write_client.batch_commit_write_streams(
+                types.BatchCommitWriteStreamsRequest(parent=parent, write_streams=[stream_name]))
+            if response.stream_errors:
+                raise RuntimeError(f"Committing {stream_name} failed: {response.stream_errors}")
+            if checkpointed:
+                state.record_checkpoint(source_file, "stream", "committed", stream_name)
+            rows = skip_rows + rows
+
+        seconds = time.perf_counter() - start
+        logger.info("Streamed {rows} rows into {table_id} in {seconds:.2f}s",
+                    rows=rows, table_id=table_id, seconds=seconds)
+        if self.metrics is not None:
+            self.metrics.record(source_file or table_id, "storage_write", seconds,
+                                rows=rows, stream_type=self.stream_type)
+        return rows
+
+    def load(self, parquet_paths, table_name: str = None, source_file: str = None,
+             state=None, source_version: str = None) -> int:
+        """
+        Streams every Parquet file under the given paths into the table, for
+        outputs that were staged as Parquet anyway. Stream checkpoints are
+        cleared once a file is processed, so source_version is not needed.
+        """
+        parquet_files = find_parquet_files(parquet_paths)
+        if not parquet_files:
+            return 0
+        batches = (batch for parquet_file in parquet_files
+                   for batch in pq.ParquetFile(parquet_file).iter_batches(
+                       batch_size=self.batch_rows))
+        return self.load_batches(batches, table_name, source_file, state)
+
@@ -0,0 +1,169 @@
+"""
+Columnar validation of input rows before they are loaded. Rows that would
+make a BigQuery load job fail are written to a quarantine Parquet output,
+with the reasons, instead of being loaded.
+"""
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from loguru import logger
+
+from source_connector import SourceConnector
+from fingerprint import FP_COLUMNS, FP_LENGTH, FP_MAX_VALUE, FINGERPRINT_PATTERN
+
+# The REQUIRED columns of bq_loader.TABLE_SCHEMA
+REQUIRED_COLUMNS = ["ID", "Library_ID", "Sub_ID_1", "Sub_ID_2", "MW", "LogP",
+                    "FP1", "FP2", "FP3"]
+NUMERIC_COLUMNS = ["MW", "LogP"]
+REASONS_COLUMN = "reasons"
+SOURCE_COLUMN = "source_file"
+
+
+def to_float(column: pa.Array) -> pa.Array:
+    """
+    Casts a string column to float32. Like Spark's cast, values that are not
+    numbers become null instead of failing the whole batch.
+    """
+    try:
+        return column.cast(pa.float32())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        numbers = pd.to_numeric(column.to_pandas(), errors="coerce")
+        return pa.array(numbers, type=pa.float32(), from_pandas=True)
+
+
+def fingerprint_failures(column: pa.Array) -> tuple:
+    """
+    Returns boolean masks of the non-null values that do not have 2048
+    values, and of those that are not integers in 0..1000
+    """
+    present = pc.is_valid(column).to_numpy(zero_copy_only=False)
+    wrong_length = present & (pc.fill_null(
+        pc.count_substring(column, ","), FP_LENGTH - 1).to_numpy(zero_copy_only=False)
+        != FP_LENGTH - 1)
+    well_formed = pc.fill_null(pc.match_substring_regex(
+        column, FINGERPRINT_PATTERN), False).to_numpy(zero_copy_only=False)
+    out_of_range = present & ~well_formed
+
+    rows = np.flatnonzero(well_formed)
+    if len(rows):
+        values = pc.split_pattern(column.take(pa.array(rows)), ",")
+        too_large = pc.greater(pc.list_flatten(values).cast(pa.int32()), FP_MAX_VALUE)
+        parents = pc.list_parent_indices(values).to_numpy()
+        out_of_range[rows[np.unique(parents[too_large.to_numpy(zero_copy_only=False)])]] = True
+    return wrong_length, out_of_range
+
+
+class RowValidator(SourceConnector):
+    """
+    Checks whole record batches at once: the columns in
+    validation_required_columns must not be null, MW and LogP must be
+    numbers and every fingerprint that is present must hold 2048 integers
+    in 0..1000. Disabled with validation_enabled: False.
+    """
+
+    def __init__(self, config_dict: dict):
+        super().__init__(config_dict)
+        self.enabled = self.prop("validation_enabled", optional=True, default_value=True)
+        self.required_columns = list(self.prop(
+            "validation_required_columns", optional=True, default_value=REQUIRED_COLUMNS))
+        self.quarantine_dir = self.prop(
+            "quarantine_dir", optional=True, default_value="./quarantine")
+
+    def quarantine_path(self, name: str) -> str:
+        return os.path.join(self.quarantine_dir, name)
+
+    def check(self, batch: pa.RecordBatch) -> tuple:
+        """
+        Returns a boolean mask of the valid rows and the reasons of the
+        invalid ones, in row order
+        :param batch: the rows as read, every column a string
+        """
+        failures = []
+        for column in self.required_columns:
+            if column not in batch.schema.names:
+                failures.append((f"{column} is missing", np.ones(batch.num_rows, dtype=bool)))
+                continue
+            failures.append((f"{column} is missing",
+                             pc.is_null(batch.column(column)).to_numpy(zero_copy_only=False)))
+        for column in NUMERIC_COLUMNS:
+            if column not in batch.schema.names:
+                continue
+            values = batch.column(column)
+            failures.append((f"{column} is not a number", pc.and_(
+                pc.is_valid(values), pc.is_null(to_float(values))).to_numpy(zero_copy_only=False)))
+        for column in FP_COLUMNS:
+            if column not in batch.schema.names:
+                continue
+            wrong_length, out_of_range = fingerprint_failures(batch.column(column))
+            failures.append((f"{column} does not have {FP_LENGTH} values", wrong_length))
+            failures.append((f"{column} has values outside 0..{FP_MAX_VALUE}", out_of_range))
+
+        invalid = np.zeros(batch.num_rows, dtype=bool)
+        for _, failed in failures:
+            invalid |= failed
+        reasons = ["; ".join(reason for reason, failed in failures if failed[row])
+                   for row in np.flatnonzero(invalid)]
+        return ~invalid, reasons
+
+
+class QuarantineWriter:
+    """
+    Writes rejected rows, as read plus the reasons and the source file, to
+    one Parquet file under path. The file is only created once a row is
+    rejected; without a path rejected rows are only counted.
+    """
+
+    def __init__(self, path: str, source_file: str):
+        self.path = path
+        self.source_file = source_file
+        self.writer = None
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def split(self, validator: RowValidator, batch: pa.RecordBatch) -> pa.RecordBatch:
+        """
+        Quarantines the invalid rows of the batch and returns the valid ones
+        """
+        valid, reasons = validator.check(batch)
+        if not reasons:
+            return batch
+        rejected = batch.filter(pa.array(~valid))
+        rejected = pa.RecordBatch.from_arrays(
+            [column.cast(pa.string()) for column in rejected.columns] + [
+                pa.array(reasons, type=pa.string()),
+                pa.array([self.source_file] * len(reasons), type=pa.string())],
+            names=rejected.schema.names + [REASONS_COLUMN, SOURCE_COLUMN])
+        self.write(rejected)
+        return batch.filter(pa.array(valid))
+
+    def write(self, rejected: pa.RecordBatch) -> None:
+        self.rows += rejected.num_rows
+        if self.path is None:
+            return
+        if self.writer is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            self.writer = pq.ParquetWriter(
+                os.path.join(self.path, "part-00000.parquet"), rejected.schema)
+        self.writer.write_batch(rejected)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        elif self.path is not None:
+            # Left over from an earlier run of the same file
+            shutil.rmtree(self.path, ignore_errors=True)
+        if self.rows:
+            logger.warning("Quarantined {rows} invalid rows of {file} to {path}",
+                           rows=self.rows, file=self.source_file, path=self.path)
@@ -0,0 +1,177 @@
+"""
+Watches the local search_folder or the input bucket for new files and hands
+them out in micro-batches, for a long running ingest process
+"""
+import os
+import threading
+import time
+
+from loguru import logger
+
+from source_connector import SourceConnector
+
+
+def file_signature(path: str):
+    """
+    Returns the size and modification time of a local file as a string,
+    or None if it does not exist; a file is the same version as long as
+    its signature is
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class FileWatcher(SourceConnector):
+    """
+    Polls every watch_poll_seconds for new files. A local file is handed out
+    once its size and modification time are the same on two polls in a row,
+    so files still being copied in are not read half written; a file that
+    changes after it was handed out is handed out again. Bucket objects only
+    become visible once complete and are listed with BucketListing, which
+    skips the generations already ingested. Between full listings, every
+    watch_full_list_seconds, a poll only lists the objects named after the
+    last one in the listing cache, so it costs one request when nothing
+    arrived. Objects added under an earlier name, and overwritten objects,
+    are picked up by the next full listing.
+
+    Files of a batch that failed are handed out again after
+    watch_retry_seconds.
+
+    Ready files are collected into batches of at most watch_batch_size
+    files. A batch is handed out when it is full or when its first file has
+    waited watch_batch_seconds, so a single arrival is not held back long.
+    """
+
+    def __init__(self, config_dict: dict, is_duplicate=None, listing=None):
+        """
+        :param config_dict: the connector config
+        :param is_duplicate: called with a local path, returns True for
+            files whose current version was already ingested
+        :param listing: the BucketListing used when search_folder is gcp
+        """
+        super().__init__(config_dict)
+        self.search_folder = self.prop("search_folder")
+        self.file_extension = self.prop("file_extension", optional=True, default_value=".gz")
+        self.poll_seconds = float(self.prop("watch_poll_seconds", optional=True, default_value=5))
+        self.batch_size = self.prop("watch_batch_size", optional=True, default_value=16)
+        self.batch_seconds = float(self.prop("watch_batch_seconds", optional=True, default_value=2))
+        self.full_list_seconds = float(self.prop(
+            "watch_full_list_seconds", optional=True, default_value=300))
+        self.retry_seconds = float(self.prop("watch_retry_seconds", optional=True, default_value=60))
+        self.is_duplicate = is_duplicate
+        self.listing = listing
+        self.from_bucket = self.search_folder.lower() == "gcp"
+
+        self.stopped = threading.Event()
+        self.observed: dict = {}
+        self.handed_out: dict = {}
+        self.retry_at: dict = {}
+        self.next_full_list = 0.0
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def poll(self) -> list:
+        """
+        Returns the files that became ready since the last poll
+        """
+        now = time.monotonic()
+        for path, retry_at in list(self.retry_at.items()):
+            if retry_at <= now:
+                del self.retry_at[path]
+                self.handed_out.pop(path, None)
+                # The object may be named before the last one listed
+                self.next_full_list = now
+
+        if self.from_bucket:
+            start_offset = self.listing.last_name() if now < self.next_full_list else None
+            if start_offset is None:
+                self.next_full_list = now + self.full_list_seconds
+            return [uri for uri in self.listing.list_files(
+                skip_ingested=True, start_offset=start_offset)
+                if uri not in self.handed_out]
+
+        ready = []
+        observed = {}
+        try:
+            entries = list(os.scandir(self.search_folder))
+        except FileNotFoundError:
+            entries = []
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if not entry.is_file() or not entry.name.endswith(self.file_extension):
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            observed[entry.path] = signature
+            if self.observed.get(entry.path) != signature:
+                # New or still being written
+                continue
+            if self.handed_out.get(entry.path) == signature:
+                continue
+            self.handed_out[entry.path] = signature
+            if self.is_duplicate is not None and self.is_duplicate(entry.path):
+                continue
+            ready.append(entry.path)
+        self.observed = observed
+        # Files removed from the folder can arrive again under the same name
+        self.handed_out = {path: signature for path, signature in self.handed_out.items()
+                           if path in observed}
+        return ready
+
+    def batches(self):
+        """
+        Yields lists of ready files until stop() is called
+        """
+        logger.info("Watching {source} for new {extension} files every {seconds}s",
+                    source=self.listing.uri(self.listing.prefix or "") if self.from_bucket
+                    else self.search_folder,
+                    extension=self.file_extension, seconds=self.poll_seconds)
+        pending: list = []
+        first_ready = None
+        while not self.stopped.is_set():
+            for path in self.poll():
+                if path not in pending:
+                    pending.append(path)
+            if pending and first_ready is None:
+                first_ready = time.monotonic()
+
+            while len(pending) >= self.batch_size:
+                yield self.hand_out(pending[:self.batch_size])
+                pending = pending[self.batch_size:]
+                first_ready = time.monotonic() if pending else None
+            if pending and time.monotonic() - first_ready >= self.batch_seconds:
+                yield self.hand_out(pending)
+                pending, first_ready = [], None
+                continue
+
+            wait = self.poll_seconds
+            if pending:
+                wait = min(wait, max(self.batch_seconds - (time.monotonic() - first_ready), 0))
+            self.stopped.wait(wait)
+
+    def hand_out(self, batch: list) -> list:
+        if self.from_bucket:
+            self.handed_out.update(dict.fromkeys(batch, True))
+        logger.info("Handing out a batch of {count} new file(s)", count=len(batch))
+        return batch
+
+    def ingested(self, batch: list) -> None:
+        """
+        Forgets handed out bucket objects once their batch is ingested; the
+        listing skips them from then on unless they are overwritten
+        """
+        if self.from_bucket:
+            for uri in batch:
+                self.handed_out.pop(uri, None)
+
+    def failed(self, batch: list) -> None:
+        """
+        Hands the files of a batch that failed out again after
+        watch_retry_seconds, unless they change before that
+        """
+        retry_at = time.monotonic() + self.retry_seconds
+        for path in batch:
+            self.retry_at[path] = retry_at
@@ -0,0 +1,7 @@
+"""
+The pipeline modules are imported the way they are run, from src
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,144 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from bq_loader import BigQueryBulkLoader, LoadJobError, find_parquet_files, open_loader
+from parquet_layout import name_parts
+
+TABLE_ID = "project.dataset.table"
+
+
+def config(**props):
+    return {"connector_config": dict({"key_path": "key.json", "project_id": "project",
+                                      "dataset_id": "dataset", "bq_table_name": "table"},
+                                     **props)}
+
+
+def loader(**props):
+    return BigQueryBulkLoader(config(**props), client=object(), storage_client=object())
+
+
+def write_parts(output_path, names):
+    os.makedirs(output_path, exist_ok=True)
+    for name in names:
+        with open(os.path.join(output_path, name), "wb") as file:
+            file.write(b"PAR1")
+
+
+def test_job_keys_are_deterministic(tmp_path):
+    write_parts(tmp_path / "out", ["part-00000.parquet", "part-00001.parquet"])
+    files = find_parquet_files(str(tmp_path / "out"))
+    units = loader(bq_files_per_job=1).plan_units(files, TABLE_ID, "input.tsv.gz")
+    assert [batch for _, batch in units] == [[path] for path in files]
+    assert units == loader(bq_files_per_job=1).plan_units(files, TABLE_ID, "input.tsv.gz")
+    assert len({key for key, _ in units}) == 2
+    assert all(key.startswith("ingest_") for key, _ in units)
+
+
+def test_job_keys_depend_on_table_and_input_file(tmp_path):
+    write_parts(tmp_path / "out", ["part-00000.parquet"])
+    files = find_parquet_files(str(tmp_path / "out"))
+    keys = {loader().plan_units(files, table_id, source_file)[0][0]
+            for table_id, source_file in [(TABLE_ID, "a.tsv.gz"), (TABLE_ID, "b.tsv.gz"),
+                                          ("project.dataset.other", "a.tsv.gz")]}
+    assert len(keys) == 3
+
+
+def test_job_keys_depend_on_the_input_version(tmp_path):
+    first, second = tmp_path / "first" / "out", tmp_path / "second" / "out"
+    write_parts(first, ["part-00000-1b2c-c000.snappy.parquet",
+                        "part-00001-1b2c-c000.snappy.parquet"])
+    write_parts(second, ["part-00000-9f8e-c000.snappy.parquet",
+                         "part-00001-9f8e-c000.snappy.parquet"])
+    for output_path in (first, second):
+        name_parts(str(output_path))
+
+    def keys(output_path, version):
+        return [key for key, _ in loader(bq_files_per_job=1).plan_units(
+            find_parquet_files(str(output_path)), TABLE_ID, "input.tsv.gz", version)]
+    # A retry of the same version reuses its jobs, a new version does not
+    assert keys(first, "1700000000000000") == keys(second, "1700000000000000")
+    assert not set(keys(first, "1700000000000000")) & set(keys(second, "1700000000000001"))
+
+
+class FakeJob:
+    def __init__(self, job_id, error=None, output_rows=10):
+        self.job_id = job_id
+        self.error = error
+        self.output_rows = output_rows
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+
+
+def test_failed_load_jobs_raise_after_every_job_was_waited_on():
+    class State:
+        def __init__(self):
+            self.checkpoints = []
+
+        def record_checkpoint(self, file_name, kind, key, value):
+            self.checkpoints.append(key)
+
+    state = State()
+    jobs = [(FakeJob("job-1"), "key-1", ["a.parquet"], []),
+            (FakeJob("job-2", RuntimeError("quota exceeded")), "key-2", ["b.parquet"], []),
+            (FakeJob("job-3"), "key-3", ["c.parquet"], [])]
+    with pytest.raises(LoadJobError, match="job-2"):
+        loader().wait(jobs, TABLE_ID, "input.tsv.gz", state)
+    assert state.checkpoints == ["key-1", "key-3"]
+
+
+def test_same_file_names_in_different_folders_get_different_keys(tmp_path):
+    for folder in ("Library_ID=L1", "Library_ID=L2"):
+        write_parts(tmp_path / "out" / folder, ["part-00000.parquet"])
+    files = find_parquet_files(str(tmp_path / "out"))
+    units = loader(bq_files_per_job=1).plan_units(files, TABLE_ID, "input.tsv.gz")
+    assert len({key for key, _ in units}) == 2
+
+
+def test_staged_files_are_grouped_per_job(tmp_path):
+    write_parts(tmp_path / "out", [f"part-{index:05d}.parquet" for index in range(5)])
+    files = find_parquet_files(str(tmp_path / "out"))
+    units = loader(bq_staging_bucket="bucket", bq_files_per_job=2).plan_units(
+        files, TABLE_ID, "input.tsv.gz")
+    assert [len(batch) for _, batch in units] == [2, 2, 1]
+
+
+def test_load_job_mode_does_not_import_storage_write():
+    import sys
+    sys.modules.pop("storage_write", None)
+    assert isinstance(open_loader(config(), "load_job", client=object()),
+                      BigQueryBulkLoader)
+    assert "storage_write" not in sys.modules
+
+
+def test_unknown_load_mode_is_rejected():
+    with pytest.raises(ValueError):
+        open_loader(config(), "streaming")
+
+
+def test_local_files_are_grouped_without_a_staging_bucket(tmp_path):
+    write_parts(tmp_path / "out", [f"part-{index:05d}.parquet" for index in range(3)])
+    files = find_parquet_files(str(tmp_path / "out"))
+    assert [batch for _, batch in loader().plan_units(files, TABLE_ID)] == [files]
+    assert [len(batch) for _, batch in loader(bq_files_per_job=2).plan_units(
+        files, TABLE_ID)] == [2, 1]
+
+
+def test_merge_files_keeps_every_row(tmp_path):
+    paths = []
+    for index in range(3):
+        path = str(tmp_path / f"part-{index:05d}.parquet")
+        pq.write_table(pa.table({"ID": [f"{index}-a", f"{index}-b"],
+                                 "MW": [float(index)] * 2}), path, row_group_size=1)
+        paths.append(path)
+    merged = BigQueryBulkLoader.merge_files(paths)
+    try:
+        table = pq.read_table(merged)
+        assert table.num_rows == 6
+        assert table.column("ID").to_pylist()[:3] == ["0-a", "0-b", "1-a"]
+    finally:
+        os.remove(merged)
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+from bucket_listing import BucketListing
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self.generations = {}
+
+    def list_blobs(self, bucket_name, **kwargs):
+        page = [SimpleNamespace(name=name, generation=generation, updated=None, size=10)
+                for name, generation in sorted(self.generations.items())]
+        return SimpleNamespace(pages=[page])
+
+
+def listing(tmp_path, storage_client):
+    return BucketListing({"connector_config": {
+        "bucket_name": "bucket",
+        "listing_cache_path": str(tmp_path / "listing.sqlite")}}, storage_client)
+
+
+def test_an_object_overwritten_after_it_was_fetched_is_listed_again(tmp_path):
+    storage_client = FakeStorageClient()
+    storage_client.generations["input.tsv.gz"] = 1
+    bucket_listing = listing(tmp_path, storage_client)
+    assert list(bucket_listing.list_files()) == ["gs://bucket/input.tsv.gz"]
+    fetched = bucket_listing.generation("gs://bucket/input.tsv.gz")
+
+    # Overwritten and listed again while generation 1 was being ingested
+    storage_client.generations["input.tsv.gz"] = 2
+    list(bucket_listing.list_files())
+    bucket_listing.mark_ingested("gs://bucket/input.tsv.gz", fetched)
+
+    assert bucket_listing.is_changed("gs://bucket/input.tsv.gz")
+    assert list(bucket_listing.list_files()) == ["gs://bucket/input.tsv.gz"]
+    bucket_listing.mark_ingested("gs://bucket/input.tsv.gz")
+    assert list(bucket_listing.list_files()) == []
+    bucket_listing.close()
@@ -0,0 +1,13 @@
+import gzip
+import os
+
+from create_data import CreateSampleData
+
+
+def test_sample_files_match_their_row_count_or_size(tmp_path):
+    CreateSampleData({"persistence_file_path": str(tmp_path), "batch_size": "1MB",
+                      "workers": 2, "sample_data": {"rows.tsv.gz": 40, "size.tsv.gz": "2MB"}})
+    with gzip.open(tmp_path / "rows.tsv.gz", "rt") as file:
+        assert sum(1 for _ in file) == 41
+    size = os.path.getsize(tmp_path / "size.tsv.gz")
+    assert 2 * 1024 ** 2 <= size <= 2 * 1024 ** 2 + 64 * 1024
@@ -0,0 +1,62 @@
+import gzip
+import os
+
+from file_batcher import FileBatcher, read_header
+
+HEADER = "ID\tSMILES\tLibrary_ID\tSub_ID_1\tSub_ID_2\tSub_ID_3"
+OTHER_HEADER = "ID\tSMILES\tLibrary_ID\tSub_ID_1\tSub_ID_2"
+
+
+def write_tsv(path, header, rows=2):
+    with gzip.open(path, "wt", encoding="utf8") as file:
+        file.write(header + "\n")
+        for row in range(rows):
+            file.write("\t".join(f"{column}{row}" for column in header.split("\t")) + "\n")
+    return str(path)
+
+
+def batcher(max_files=10, max_bytes="1MB", single=None):
+    return FileBatcher({"connector_config": {"batch_max_files": max_files,
+                                             "batch_max_bytes": max_bytes}},
+                       size=os.path.getsize, single=single)
+
+
+def test_read_header_plain_and_gzip(tmp_path):
+    gz_path = write_tsv(tmp_path / "a.tsv.gz", HEADER)
+    plain_path = tmp_path / "b.tsv"
+    plain_path.write_text(OTHER_HEADER + "\r\nx\n", encoding="utf8")
+    assert read_header(gz_path) == HEADER
+    assert read_header(str(plain_path)) == OTHER_HEADER
+    assert read_header(str(tmp_path / "missing.tsv.gz")) is None
+
+
+def test_files_with_different_headers_are_not_batched(tmp_path):
+    first = write_tsv(tmp_path / "a.tsv.gz", HEADER)
+    second = write_tsv(tmp_path / "b.tsv.gz", OTHER_HEADER)
+    third = write_tsv(tmp_path / "c.tsv.gz", HEADER)
+    batches = list(batcher().batches([first, second, third]))
+    assert sorted(batches) == sorted([[first, third], [second]])
+
+
+def test_batch_limits(tmp_path):
+    paths = [write_tsv(tmp_path / f"{index}.tsv.gz", HEADER) for index in range(5)]
+    assert list(batcher(max_files=2).batches(paths)) == [paths[0:2], paths[2:4], paths[4:]]
+    assert list(batcher(max_files=1).batches(paths)) == [[path] for path in paths]
+
+    size = os.path.getsize(paths[0])
+    batches = list(batcher(max_bytes=size * 2 + 1).batches(paths))
+    assert batches == [paths[0:2], paths[2:4], paths[4:]]
+
+
+def test_oversized_unreadable_and_single_files_go_alone(tmp_path):
+    small = write_tsv(tmp_path / "small.tsv.gz", HEADER)
+    large = write_tsv(tmp_path / "large.tsv.gz", HEADER, rows=2000)
+    broken = tmp_path / "broken.tsv.gz"
+    broken.write_bytes(b"not gzip")
+    arrow = write_tsv(tmp_path / "arrow.tsv.gz", HEADER)
+    other = write_tsv(tmp_path / "other.tsv.gz", HEADER)
+
+    batches = list(batcher(max_bytes=os.path.getsize(large), single=lambda path: path == arrow)
+                   .batches([small, large, str(broken), arrow, other]))
+    assert [large] in batches and [str(broken)] in batches and [arrow] in batches
+    assert [small, other] in batches
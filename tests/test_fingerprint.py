@@ -0,0 +1,40 @@
+import numpy as np
+
+from fingerprint import (FP_BYTES, FP_LENGTH, decode_fingerprints, encode_fingerprints,
+                         fingerprints_to_strings, parse_fingerprints)
+
+
+def fingerprint(value: int = 7) -> str:
+    return ",".join([str(value)] * FP_LENGTH)
+
+
+def test_valid_fingerprints_round_trip():
+    values = [fingerprint(0), ",".join(str(i % 1001) for i in range(FP_LENGTH))]
+    matrix, valid = parse_fingerprints(values)
+    assert valid.tolist() == [True, True]
+    assert fingerprints_to_strings(matrix) == values
+
+    blobs = encode_fingerprints(values)
+    assert all(len(blob) == FP_BYTES for blob in blobs)
+    assert np.array_equal(decode_fingerprints(blobs), matrix)
+
+
+def test_garbage_empty_and_null_values_are_invalid():
+    malformed = ["x", "", "1.5", None, " 1" + "," * (FP_LENGTH - 1),
+                 ",".join(["x"] * FP_LENGTH), ",".join(["1.5"] * FP_LENGTH),
+                 ",".join(["-1"] * FP_LENGTH), fingerprint() + "\n", b"1,2"]
+    matrix, valid = parse_fingerprints(malformed + [fingerprint()])
+    assert valid.tolist() == [False] * len(malformed) + [True]
+    assert not matrix[:-1].any()
+    assert (matrix[-1] == 7).all()
+
+
+def test_wrong_length_and_out_of_range_values_are_invalid():
+    values = [",".join(["1"] * (FP_LENGTH - 1)), ",".join(["1"] * (FP_LENGTH + 1)),
+              fingerprint(1001), fingerprint(9999), fingerprint(1000)]
+    _, valid = parse_fingerprints(values)
+    assert valid.tolist() == [False, False, False, False, True]
+
+
+def test_invalid_rows_encode_as_none():
+    assert encode_fingerprints(["x", fingerprint(), None])[::2] == [None, None]
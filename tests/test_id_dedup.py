@@ -0,0 +1,96 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from id_dedup import IdDeduplicator, check_single_host, drop_duplicate_frames
+
+
+def config(tmp_path, **props):
+    return {"connector_config": dict({"dedup_dir": str(tmp_path / "ids"),
+                                      "dedup_expected_ids": 1000,
+                                      "dedup_false_positive_rate": 0.01}, **props)}
+
+
+def test_ids_of_another_file_are_skipped(tmp_path):
+    deduplicator = IdDeduplicator(config(tmp_path))
+    assert deduplicator.new_rows(["a", "b", "c"], "first.tsv.gz").all()
+    keep = deduplicator.new_rows(["b", "d", "a", "e"], "second.tsv.gz")
+    assert keep.tolist() == [False, True, False, True]
+
+
+def test_rerun_of_the_same_file_keeps_its_rows(tmp_path):
+    deduplicator = IdDeduplicator(config(tmp_path))
+    deduplicator.new_rows(["a", "b", "a"], "first.tsv.gz")
+    assert deduplicator.new_rows(["a", "b", "a"], "first.tsv.gz").all()
+
+
+def test_rows_without_id_are_kept(tmp_path):
+    deduplicator = IdDeduplicator(config(tmp_path))
+    deduplicator.new_rows(["a"], "first.tsv.gz")
+    keep = deduplicator.new_rows(np.array([None, "a", np.nan], dtype=object), "second.tsv.gz")
+    assert keep.tolist() == [True, False, True]
+
+
+def test_filter_is_rebuilt_from_the_exact_set(tmp_path):
+    deduplicator = IdDeduplicator(config(tmp_path))
+    deduplicator.new_rows(["a", "b"], "first.tsv.gz")
+    deduplicator.close()
+    for name in ("bloom.json", "bloom.bits"):
+        os.remove(tmp_path / "ids" / name)
+
+    reopened = IdDeduplicator(config(tmp_path))
+    assert reopened.maybe_seen(np.array(["a", "b"], dtype=object)).all()
+    assert reopened.new_rows(["a", "c"], "second.tsv.gz").tolist() == [False, True]
+
+
+def test_two_stores_on_one_dir_agree(tmp_path):
+    # Two Python workers of a local Spark open their own store on dedup_dir
+    first, second = IdDeduplicator(config(tmp_path)), IdDeduplicator(config(tmp_path))
+    first.new_rows(["a", "b"], "first.tsv.gz")
+    assert second.new_rows(["b", "c"], "second.tsv.gz").tolist() == [False, True]
+    assert first.new_rows(["c"], "third.tsv.gz").tolist() == [False]
+
+
+def test_drop_duplicate_frames_by_source_column(tmp_path):
+    IdDeduplicator(config(tmp_path)).new_rows(["a", "b"], "first.tsv.gz")
+    frames = [pd.DataFrame({"ID": ["a", "b", "x"],
+                            "source_file": ["first.tsv.gz", "second.tsv.gz", "second.tsv.gz"]}),
+              pd.DataFrame({"ID": ["x", "y"], "source_file": ["third.tsv.gz"] * 2})]
+    kept = list(drop_duplicate_frames(iter(frames), config(tmp_path), "batch",
+                                      source_column="source_file"))
+    assert kept[0]["ID"].tolist() == ["a", "x"]
+    assert kept[1]["ID"].tolist() == ["y"]
+
+
+def test_ids_of_a_failed_load_are_released(tmp_path):
+    deduplicator = IdDeduplicator(config(tmp_path))
+    deduplicator.new_rows(["a", "b"], "first.tsv.gz")
+    # Claimed by a file that is not loaded yet
+    assert deduplicator.new_rows(["a"], "second.tsv.gz").tolist() == [False]
+    deduplicator.release("first.tsv.gz")
+    assert deduplicator.new_rows(["a", "b"], "second.tsv.gz").all()
+    deduplicator.mark_loaded("second.tsv.gz")
+    deduplicator.release("second.tsv.gz")
+    assert not deduplicator.new_rows(["a", "b"], "first.tsv.gz").any()
+
+
+def test_ids_recorded_before_claims_count_as_loaded(tmp_path):
+    os.makedirs(tmp_path / "ids")
+    connection = sqlite3.connect(tmp_path / "ids" / "ids.sqlite")
+    connection.execute("CREATE TABLE ids (id TEXT PRIMARY KEY, source_file TEXT)")
+    connection.execute("INSERT INTO ids VALUES ('a', 'first.tsv.gz')")
+    connection.commit()
+    connection.close()
+
+    deduplicator = IdDeduplicator(config(tmp_path))
+    deduplicator.release("first.tsv.gz")
+    assert deduplicator.new_rows(["a"], "second.tsv.gz").tolist() == [False]
+
+
+def test_dedup_needs_a_single_host():
+    check_single_host("local[*]")
+    with pytest.raises(ValueError):
+        check_single_host("yarn")
@@ -0,0 +1,35 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from parquet_index import LocalIdIndex
+
+
+def index(tmp_path):
+    return LocalIdIndex({"connector_config": {
+        "local_index_dir": str(tmp_path / "index" / "parquet"),
+        "local_index_path": str(tmp_path / "index" / "ids.sqlite")}})
+
+
+def write_output(path, ids):
+    os.makedirs(path)
+    pq.write_table(pa.table({"ID": ids, "MW": [1.0] * len(ids)}),
+                   os.path.join(path, "part-00000.parquet"))
+    return str(path)
+
+
+def test_same_named_inputs_are_kept_apart(tmp_path):
+    local_index = index(tmp_path)
+    local_index.add_output("gs://bucket-a/x.tsv.gz", write_output(tmp_path / "a", ["a1", "a2"]))
+    local_index.add_output("gs://bucket-b/x.tsv.gz", write_output(tmp_path / "b", ["b1"]))
+    rows = local_index.lookup(["a1", "a2", "b1"], ["MW"])
+    assert all(rows[target_id] is not None for target_id in ("a1", "a2", "b1"))
+
+
+def test_indexing_a_file_again_replaces_its_entries(tmp_path):
+    local_index = index(tmp_path)
+    local_index.add_output("x.tsv.gz", write_output(tmp_path / "first", ["a1", "a2"]))
+    local_index.add_output("x.tsv.gz", write_output(tmp_path / "second", ["a3"]))
+    rows = local_index.lookup(["a1", "a3"])
+    assert rows["a1"] is None and rows["a3"] is not None
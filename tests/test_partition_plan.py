@@ -0,0 +1,54 @@
+import gzip
+
+from partition_plan import PartitionPlanner
+
+
+def planner(**props):
+    return PartitionPlanner({"connector_config": props})
+
+
+class FakeFrame:
+    def __init__(self):
+        self.calls = []
+
+    def coalesce(self, partitions):
+        self.calls.append(("coalesce", partitions))
+        return self
+
+    def repartition(self, partitions, *columns):
+        self.calls.append(("repartition", partitions))
+        return self
+
+
+def write_chunks(folder, count):
+    folder.mkdir()
+    for index in range(count):
+        with gzip.open(folder / f"chunk-{index:05d}.tsv.gz", "wt") as file:
+            file.write("ID\tMW\n" + "".join(f"{row}\t1.0\n" for row in range(100)))
+
+
+def test_fewer_partitions_than_read_coalesce(tmp_path):
+    path = tmp_path / "input.tsv"
+    path.write_text("ID\tMW\n1\t1.0\n")
+    plan = planner(repartition=2).plan(str(path), 8)
+    assert plan["method"] == "coalesce" and not plan["split"]
+    frame = FakeFrame()
+    PartitionPlanner.apply(frame, plan)
+    assert frame.calls == [("coalesce", 2)]
+
+
+def test_split_input_is_repartitioned_to_keep_one_read_task_per_chunk(tmp_path):
+    write_chunks(tmp_path / "split", 8)
+    plan = planner(repartition=2).plan(str(tmp_path / "split"), 8)
+    assert plan["method"] == "repartition" and plan["split"]
+    frame = FakeFrame()
+    PartitionPlanner.apply(frame, plan)
+    assert frame.calls == [("repartition", 2)]
+
+
+def test_same_partition_count_is_left_as_read(tmp_path):
+    write_chunks(tmp_path / "split", 4)
+    plan = planner(repartition=4).plan(str(tmp_path / "split"), 4)
+    frame = FakeFrame()
+    PartitionPlanner.apply(frame, plan)
+    assert frame.calls == []
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from fingerprint import FP_LENGTH, fingerprints_to_strings
+from similarity import FingerprintIndex
+
+
+def write_output(path, ids, seed):
+    matrix = np.random.default_rng(seed).integers(0, 3, size=(len(ids), FP_LENGTH))
+    os.makedirs(path)
+    pq.write_table(pa.table({"ID": ids, "FP1": fingerprints_to_strings(matrix)}),
+                   os.path.join(path, "part-00000.parquet"))
+    return str(path), matrix
+
+
+def test_same_named_inputs_get_their_own_shards(tmp_path):
+    index = FingerprintIndex({"connector_config": {
+        "similarity_index_dir": str(tmp_path / "index"), "similarity_workers": 1}})
+    first_path, first = write_output(tmp_path / "a", ["a1", "a2"], seed=1)
+    second_path, second = write_output(tmp_path / "b", ["b1"], seed=2)
+    index.add_output("gs://bucket-a/x.tsv.gz", first_path)
+    index.add_output("gs://bucket-b/x.tsv.gz", second_path)
+
+    assert len(index.manifest["shards"]) == 2
+    assert index.search(first[0], k=1)[0][0][0] == "a1"
+    assert index.search(second[0], k=1)[0][0][0] == "b1"
+
+
+def test_adding_a_file_again_replaces_its_shard(tmp_path):
+    index = FingerprintIndex({"connector_config": {
+        "similarity_index_dir": str(tmp_path / "index"), "similarity_workers": 1}})
+    first_path, _ = write_output(tmp_path / "first", ["a1"], seed=1)
+    second_path, _ = write_output(tmp_path / "second", ["a2", "a3"], seed=2)
+    index.add_output("x.tsv.gz", first_path)
+    index.add_output("x.tsv.gz", second_path)
+    assert [shard["rows"] for shard in index.manifest["shards"].values()] == [2]
@@ -0,0 +1,135 @@
+import pytest
+import yaml
+
+from state_store import SQLiteStateStore, open_state_store, read_processed_files
+
+BACKENDS = ["yaml", "log", "sqlite"]
+
+
+def open_store(tmp_path, backend):
+    return open_state_store(backend, str(tmp_path / f"state.{backend}"),
+                            str(tmp_path / "download_data.yaml"))
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_processed_files_survive_reopening(tmp_path, backend):
+    store = open_store(tmp_path, backend)
+    store.mark_processed("a.tsv.gz")
+    store.mark_processed("b.tsv.gz")
+    store.mark_processed("a.tsv.gz")
+    store.close()
+
+    store = open_store(tmp_path, backend)
+    assert store.is_processed("a.tsv.gz") and not store.is_processed("c.tsv.gz")
+    assert store.processed_files() == ["a.tsv.gz", "b.tsv.gz"]
+    store.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_checkpoints_are_kept_until_cleared(tmp_path, backend):
+    store = open_store(tmp_path, backend)
+    store.record_checkpoint("a.tsv.gz", "load", "job_1", "part-00000.parquet")
+    store.record_checkpoint("a.tsv.gz", "load", "job_2")
+    store.record_checkpoint("a.tsv.gz", "output", "parquet", "out/a")
+    store.record_checkpoint("b.tsv.gz", "load", "job_3")
+    store.close()
+
+    store = open_store(tmp_path, backend)
+    assert store.checkpoints("a.tsv.gz", "load") == {"job_1": "part-00000.parquet", "job_2": ""}
+    assert store.checkpoints("a.tsv.gz", "output") == {"parquet": "out/a"}
+    store.clear_checkpoints("a.tsv.gz")
+    store.close()
+
+    store = open_store(tmp_path, backend)
+    assert store.checkpoints("a.tsv.gz", "load") == {}
+    assert store.checkpoints("b.tsv.gz", "load") == {"job_3": ""}
+    store.close()
+
+
+@pytest.mark.parametrize("backend", ["log", "sqlite"])
+def test_first_open_migrates_the_yaml_state(tmp_path, backend):
+    with open(tmp_path / "download_data.yaml", "w", encoding="utf8") as file:
+        yaml.safe_dump({"download_file_list": ["a.tsv.gz", "b.tsv.gz"]}, file)
+    store = open_store(tmp_path, backend)
+    assert store.processed_files() == ["a.tsv.gz", "b.tsv.gz"]
+    store.mark_processed("c.tsv.gz")
+    store.close()
+
+    with open(tmp_path / "download_data.yaml", "w", encoding="utf8") as file:
+        yaml.safe_dump({"download_file_list": ["d.tsv.gz"]}, file)
+    store = open_store(tmp_path, backend)
+    assert store.processed_files() == ["a.tsv.gz", "b.tsv.gz", "c.tsv.gz"]
+    store.close()
+
+
+def test_sqlite_mark_many_skips_known_files(tmp_path):
+    store = SQLiteStateStore(str(tmp_path / "state.sqlite"))
+    store.mark_processed("a.tsv.gz")
+    store.mark_many(["a.tsv.gz", "b.tsv.gz", "c.tsv.gz"])
+    assert store.processed_files() == ["a.tsv.gz", "b.tsv.gz", "c.tsv.gz"]
+    store.close()
+
+
+def test_unknown_backend_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        open_store(tmp_path, "redis")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_read_processed_files_creates_nothing(tmp_path, backend):
+    store = open_store(tmp_path, backend)
+    store.mark_processed("a.tsv.gz")
+    store.mark_processed("b.tsv.gz")
+    store.close()
+    for path in tmp_path.iterdir():
+        if path.name.endswith((".checkpoints", "-wal", "-shm")):
+            path.unlink()
+    before = sorted(path.name for path in tmp_path.iterdir())
+
+    assert read_processed_files(backend, str(tmp_path / f"state.{backend}"),
+                                str(tmp_path / "download_data.yaml")) == ["a.tsv.gz", "b.tsv.gz"]
+    # SQLite may add its -wal and -shm files next to a database in WAL mode
+    assert sorted(path.name for path in tmp_path.iterdir()
+                  if not path.name.endswith(("-wal", "-shm"))) == before
+    assert read_processed_files(backend, str(tmp_path / "missing"),
+                                str(tmp_path / "missing.yaml")) == []
+
+
+def test_log_store_drops_torn_lines(tmp_path):
+    store = open_store(tmp_path, "log")
+    store.mark_processed("a.tsv.gz")
+    store.record_checkpoint("b.tsv.gz", "load", "key-1", "part-0.parquet")
+    store.close()
+    # A crash while appending leaves a line without its newline
+    with open(tmp_path / "state.log", "a", encoding="utf8") as file:
+        file.write("b.tsv")
+    with open(tmp_path / "state.log.checkpoints", "a", encoding="utf8") as file:
+        file.write('{"file": "b.tsv.gz", "kind": "lo')
+
+    store = open_store(tmp_path, "log")
+    assert store.processed_files() == ["a.tsv.gz"]
+    assert store.checkpoints("b.tsv.gz", "load") == {"key-1": "part-0.parquet"}
+    store.mark_processed("c.tsv.gz")
+    store.record_checkpoint("b.tsv.gz", "load", "key-2", "part-1.parquet")
+    store.close()
+
+    store = open_store(tmp_path, "log")
+    assert store.processed_files() == ["a.tsv.gz", "c.tsv.gz"]
+    assert store.checkpoints("b.tsv.gz", "load") == {
+        "key-1": "part-0.parquet", "key-2": "part-1.parquet"}
+    store.close()
+
+
+def test_log_store_compacts_cleared_checkpoints_on_open(tmp_path):
+    store = open_store(tmp_path, "log")
+    for index in range(3):
+        store.record_checkpoint(f"{index}.tsv.gz", "load", "key", "part-0.parquet")
+    store.clear_checkpoints("0.tsv.gz")
+    store.clear_checkpoints("1.tsv.gz")
+    store.close()
+
+    store = open_store(tmp_path, "log")
+    assert store.checkpoints("2.tsv.gz", "load") == {"key": "part-0.parquet"}
+    store.close()
+    with open(tmp_path / "state.log.checkpoints", encoding="utf8") as file:
+        assert len(file.readlines()) == 1
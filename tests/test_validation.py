@@ -0,0 +1,78 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from fingerprint import FP_LENGTH
+from validation import QuarantineWriter, RowValidator, REASONS_COLUMN, SOURCE_COLUMN
+
+FINGERPRINT = ",".join(["1"] * FP_LENGTH)
+
+
+def validator(**props):
+    return RowValidator({"connector_config": props})
+
+
+def batch(**overrides):
+    row = {"ID": "id-1", "Library_ID": "L1", "Sub_ID_1": "s1", "Sub_ID_2": "s2",
+           "MW": "312.5", "LogP": "-1.25", "FP1": FINGERPRINT, "FP2": FINGERPRINT,
+           "FP3": FINGERPRINT}
+    columns = {name: [value] for name, value in row.items()}
+    for name, values in overrides.items():
+        columns[name] = values
+    rows = max(len(values) for values in columns.values())
+    return pa.RecordBatch.from_pydict(
+        {name: pa.array(values * rows if len(values) == 1 else values, type=pa.string())
+         for name, values in columns.items()})
+
+
+def test_valid_rows_pass():
+    valid, reasons = validator().check(batch())
+    assert valid.tolist() == [True] and reasons == []
+
+
+def test_reasons_name_every_failure():
+    valid, reasons = validator().check(batch(
+        ID=["id-1", None, "id-3", "id-4", "id-5"],
+        MW=["1.0", "1.0", "heavy", "1.0", "1.0"],
+        FP1=[FINGERPRINT, FINGERPRINT, FINGERPRINT, "1,2,3", FINGERPRINT],
+        FP2=[FINGERPRINT, FINGERPRINT, FINGERPRINT, FINGERPRINT,
+             ",".join(["1001"] * FP_LENGTH)]))
+    assert valid.tolist() == [True, False, False, False, False]
+    assert reasons == ["ID is missing", "MW is not a number",
+                       f"FP1 does not have {FP_LENGTH} values",
+                       "FP2 has values outside 0..1000"]
+
+
+def test_missing_required_column_rejects_every_row():
+    rows = batch(ID=["a", "b"])
+    names = [name for name in rows.schema.names if name != "LogP"]
+    rows = pa.RecordBatch.from_arrays([rows.column(name) for name in names], names=names)
+    valid, reasons = validator().check(rows)
+    assert valid.tolist() == [False, False] and reasons == ["LogP is missing"] * 2
+
+
+def test_required_columns_are_configurable():
+    valid, _ = validator(validation_required_columns=["ID"]).check(batch(Library_ID=[None]))
+    assert valid.tolist() == [True]
+
+
+def test_quarantine_writer_keeps_valid_rows_and_writes_rejected(tmp_path):
+    path = str(tmp_path / "quarantine" / "input")
+    with QuarantineWriter(path, "input.tsv.gz") as writer:
+        kept = writer.split(validator(), batch(ID=["id-1", None, "id-3"]))
+    assert kept.column("ID").to_pylist() == ["id-1", "id-3"]
+    assert writer.rows == 1
+
+    rejected = pq.read_table(path)
+    assert rejected.column(REASONS_COLUMN).to_pylist() == ["ID is missing"]
+    assert rejected.column(SOURCE_COLUMN).to_pylist() == ["input.tsv.gz"]
+
+
+def test_quarantine_writer_removes_an_earlier_quarantine(tmp_path):
+    path = tmp_path / "quarantine" / "input"
+    os.makedirs(path)
+    (path / "part-00000.parquet").write_bytes(b"stale")
+    with QuarantineWriter(str(path), "input.tsv.gz") as writer:
+        writer.split(validator(), batch())
+    assert not path.exists() and writer.rows == 0
@@ -0,0 +1,83 @@
+import os
+
+from watcher import FileWatcher, file_signature
+
+
+def watcher(tmp_path, listing=None, **props):
+    config = {"connector_config": dict({
+        "search_folder": "gcp" if listing is not None else str(tmp_path),
+        "file_extension": ".tsv.gz", "watch_retry_seconds": 0}, **props)}
+    return FileWatcher(config, listing=listing)
+
+
+def test_local_file_is_handed_out_once_stable_and_again_when_changed(tmp_path):
+    path = tmp_path / "a.tsv.gz"
+    path.write_bytes(b"first")
+    local = watcher(tmp_path)
+    assert local.poll() == []
+    assert local.poll() == [str(path)]
+    assert local.poll() == []
+
+    path.write_bytes(b"second version")
+    os.utime(path, ns=(1, 1))
+    assert local.poll() == []
+    assert local.poll() == [str(path)]
+
+
+def test_failed_local_files_are_handed_out_again(tmp_path):
+    path = tmp_path / "a.tsv.gz"
+    path.write_bytes(b"rows")
+    local = watcher(tmp_path)
+    local.poll()
+    assert local.poll() == [str(path)]
+    local.failed([str(path)])
+    assert local.poll() == [str(path)]
+
+
+def test_file_signature(tmp_path):
+    path = tmp_path / "a.tsv.gz"
+    assert file_signature(str(path)) is None
+    path.write_bytes(b"rows")
+    os.utime(path, ns=(5, 5))
+    assert file_signature(str(path)) == "4:5"
+
+
+class FakeListing:
+    prefix = "in/"
+
+    def __init__(self):
+        self.names = []
+        self.listed = set()
+        self.offsets = []
+
+    def last_name(self):
+        # The greatest name in the listing cache
+        return max(self.listed) if self.listed else None
+
+    def list_files(self, skip_ingested=True, start_offset=None):
+        self.offsets.append(start_offset)
+        names = [name for name in sorted(self.names)
+                 if start_offset is None or name >= start_offset]
+        self.listed.update(names)
+        return [f"gs://bucket/{name}" for name in names]
+
+
+def test_bucket_polls_list_from_the_last_name_between_full_listings(tmp_path):
+    listing = FakeListing()
+    bucket = watcher(tmp_path, listing=listing, watch_full_list_seconds=3600)
+    listing.names = ["in/a.tsv.gz"]
+    assert bucket.poll() == ["gs://bucket/in/a.tsv.gz"]
+    bucket.hand_out(["gs://bucket/in/a.tsv.gz"])
+    listing.names.append("in/b.tsv.gz")
+    assert bucket.poll() == ["gs://bucket/in/b.tsv.gz"]
+    assert listing.offsets == [None, "in/a.tsv.gz"]
+
+
+def test_failed_bucket_objects_trigger_a_full_listing(tmp_path):
+    listing = FakeListing()
+    bucket = watcher(tmp_path, listing=listing, watch_full_list_seconds=3600)
+    listing.names = ["in/a.tsv.gz", "in/b.tsv.gz"]
+    bucket.hand_out(bucket.poll())
+    bucket.failed(["gs://bucket/in/a.tsv.gz"])
+    assert bucket.poll() == ["gs://bucket/in/a.tsv.gz"]
+    assert listing.offsets == [None, None]